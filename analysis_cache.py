@@ -0,0 +1,280 @@
+# analysis_cache.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("AnalysisCache")
+
+# In-memory tier size, entry lifetime, and the optional on-disk tier
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "256"))
+ANALYSIS_CACHE_TTL = float(os.environ.get("ANALYSIS_CACHE_TTL", str(24 * 3600)))
+ANALYSIS_CACHE_DIR = os.environ.get("ANALYSIS_CACHE_DIR", "")
+ANALYSIS_CACHE_DISK_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_DISK_ENTRIES", "10000"))
+
+# How many disk writes between prunes of the on-disk tier
+DISK_PRUNE_EVERY = 64
+
+def cache_key(encoded_image, transcript, prompt_version, models):
+    """
+    Build the content-addressed key for one vision analysis.
+
+    Args:
+        encoded_image (str): Base64 of the preprocessed image
+        transcript (str): Patient's transcribed description
+        prompt_version (str): Identifier of the system prompt in use
+        models (list): Vision fallback chain. Any model in it may produce the
+            answer (after a failover or a hedge), so the key names the chain
+            rather than one model; changing the chain invalidates old results
+
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    for part in (prompt_version, ",".join(models), transcript, encoded_image):
+        data = part.encode("utf-8")
+        # Length-prefix each part so different splits can never collide
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """
+    Two-tier cache of vision analysis results with single-flight.
+
+    Results live in an in-memory LRU and, if a directory is configured, in one
+    JSON file per key on disk. Both tiers expire entries after ttl seconds.
+    stream() coalesces concurrent identical requests so only one upstream call
+    is made; the others wait for its result. It reads and writes the disk tier
+    on worker threads, so file I/O never blocks the event loop.
+    """
+
+    def __init__(self, max_entries=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL, cache_dir=ANALYSIS_CACHE_DIR, max_disk_entries=ANALYSIS_CACHE_DISK_ENTRIES):
+        """
+        Args:
+            max_entries (int): Entries kept in memory
+            ttl (float): Seconds an entry stays valid
+            cache_dir (str): Directory for the on-disk tier; empty disables it
+            max_disk_entries (int): Entries kept on disk
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir or None
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._disk_writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        Look up a cached result in memory, then on disk.
+
+        Returns:
+            str: The cached analysis, or None
+        """
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None:
+            value = self._get_disk(key, now)
+        return value
+
+    async def aget(self, key):
+        """get() for the event loop: a miss in memory is looked up on disk in a worker thread."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None:
+            value = await asyncio.to_thread(self._get_disk, key, now) if self.cache_dir else self._get_disk(key, now)
+        return value
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        return None
+
+    def _get_disk(self, key, now):
+        entry = self._read_disk(key)
+        if entry is not None and now - entry["created"] <= self.ttl:
+            self._remember(key, entry["created"], entry["value"])
+            with self._lock:
+                self.hits += 1
+            return entry["value"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store a result in both tiers."""
+        created = time.time()
+        self._remember(key, created, value)
+        self._write_disk(key, created, value)
+
+    async def aput(self, key, value):
+        """put() for the event loop: the disk write (and any prune) runs in a worker thread."""
+        created = time.time()
+        self._remember(key, created, value)
+        if self.cache_dir:
+            await asyncio.to_thread(self._write_disk, key, created, value)
+
+    async def stream(self, key, produce):
+        """
+        Yield the analysis for key, computing it at most once at a time.
+
+        A cached result is yielded as a single chunk. If the same key is already
+        being computed, wait for that call and yield its result. Otherwise
+        stream the chunks from produce() and cache the joined text.
+
+        Args:
+            key (str): Key from cache_key()
+            produce (callable): Returns an async iterator of text chunks
+        """
+        while True:
+            cached = await self.aget(key)
+            if cached is not None:
+                yield cached
+                return
+
+            leader = self._in_flight.get(key)
+            if leader is None:
+                break
+            self.coalesced += 1
+            try:
+                value = await asyncio.shield(leader)
+            except _LeaderAbandoned:
+                # The leading request went away before finishing; compute it here
+                continue
+            yield value
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        chunks = []
+        try:
+            async for chunk in await produce():
+                chunks.append(chunk)
+                yield chunk
+            value = "".join(chunks)
+            await self.aput(key, value)
+            future.set_result(value)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if not future.done():
+                # Cancelled or closed early by the consumer
+                future.set_exception(_LeaderAbandoned())
+            # Mark any exception as retrieved so a future nobody awaited does not warn
+            future.exception()
+            self._in_flight.pop(key, None)
+
+    def stats(self):
+        """Return hit, miss and single-flight counters and the memory tier size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight)
+            }
+
+    def _remember(self, key, created, value):
+        with self._lock:
+            self._entries[key] = (created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {key}: {str(e)}")
+            return None
+
+    def _write_disk(self, key, created, value):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": created, "value": value}, f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.warning(f"Could not write cache entry {key}: {str(e)}")
+            return
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % DISK_PRUNE_EVERY == 0
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if now - mtime > self.ttl:
+                _remove_quietly(path)
+            else:
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_disk_entries)]:
+            _remove_quietly(path)
+
+class _LeaderAbandoned(Exception):
+    """Raised to single-flight followers when the leading request stopped early."""
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_analysis_cache():
+    """Return the process-wide AnalysisCache configured from the environment."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = AnalysisCache()
+    return _default_cache
@@ -1,12 +1,46 @@
-from dotenv import load_dotenv
-load_dotenv()
+from bootstrap import load_environment, configure, uptime
+load_environment()
 
 import os
-import gradio as gr
+import math
 import time
-from brain_of_the_doctor import encode_image, analyze_image_with_query
-from voice_of_the_patient import record_audio, transcribe_with_groq
-from voice_of_the_doctor import text_to_speech_with_gtts, text_to_speech_with_elevenlabs
+import uuid
+import asyncio
+import shutil
+import hashlib
+import logging
+import tempfile
+import gradio as gr
+from brain_of_the_doctor import prepare_image, analyze_image_with_query_async, MODELS_TO_TRY
+from voice_of_the_patient import transcribe_with_groq_async, preferred_stt_model
+from voice_of_the_doctor import text_to_speech_with_gtts, AsyncSpeechPipeline, prewarm_tts_cache, tts_engine_stats
+from artifact_store import get_artifact_store
+from analysis_cache import get_analysis_cache, cache_key
+from tts_cache import get_tts_cache
+from stage_runner import StageRunner, StageProgress
+from clients import pool_stats
+from model_health import get_model_health
+from warmup import get_readiness, warm_up_lifespan, WARMUP_ENABLED
+from rate_limiter import get_scheduler, Session, SchedulerOverloaded
+from job_queue import get_job_queue, JobQueueFull, JOB_QUEUE_ENABLED, QUEUED, RUNNING, FAILED, FINISHED
+from upload_limits import check_uploads, UploadRejected, UPLOAD_MAX_BYTES
+from metrics import get_metrics, start_metrics_server, register_status_endpoint, CONSULTATIONS, CONSULTATION_SECONDS, TIME_TO_FIRST_AUDIO
+
+logger = logging.getLogger("MediScanApp")
+
+# Gradio queue settings: consultations processed concurrently per process, and
+# the number of waiting requests accepted before new ones are rejected
+CONSULTATION_CONCURRENCY = int(os.environ.get("CONSULTATION_CONCURRENCY", "32"))
+QUEUE_MAX_SIZE = int(os.environ.get("QUEUE_MAX_SIZE", "256"))
+
+# Typical length of a vision response, used to estimate its progress while it streams
+EXPECTED_RESPONSE_CHARS = int(os.environ.get("EXPECTED_RESPONSE_CHARS", "1200"))
+
+# Synthesize the canned phrases into the TTS cache during warm-up
+TTS_PREWARM = os.environ.get("TTS_PREWARM", "1") == "1"
+
+# Seconds between checks on a queued consultation in job-submission mode
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "0.25"))
 
 system_prompt = """You are Dr. AI, a professional medical consultant with extensive clinical experience. Your task is to analyze the provided medical image along with the patient's description.
 
@@ -35,57 +69,308 @@ Always include these important disclaimers:
 
 Patient's description: """
 
-def process_inputs(audio_filepath, image_filepath, progress=gr.Progress()):
+NO_IMAGE_MESSAGE = "No image provided for analysis. Please upload a clear medical image for diagnosis."
+ERROR_SPEECH_MESSAGE = "I'm sorry, there was an error processing your request. Please try again."
+
+# Phrases spoken in (nearly) every consultation, pre-synthesized into the TTS cache
+CANNED_PHRASES = [
+    NO_IMAGE_MESSAGE,
+    "This is an AI consultation and not a replacement for in-person medical care.",
+    "Any medication suggestions should be discussed with a healthcare provider before use.",
+    "Seek immediate medical attention for severe or worsening symptoms."
+]
+
+# Identifies the prompt in analysis cache keys, so editing it invalidates old results
+SYSTEM_PROMPT_VERSION = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+async def process_inputs(audio_filepath, image_filepath, progress=gr.Progress(), request: gr.Request = None):
+    """
+    Gradio handler for a consultation, yielding (transcript, response, audio segment, consultation ID) updates.
+    
+    With JOB_QUEUE=1 the consultation is queued for the job_worker.py processes
+    and followed by its ID, so it outlives a restart of the web app; otherwise
+    it runs in this process and the ID is empty.
+    
+    Args:
+        audio_filepath (str): Recording of the patient's description, or None
+        image_filepath (str): Medical image, or None
+        progress (gr.Progress): Progress callback
+        request (gr.Request): Gradio request; its session shares one turn in the provider queues
+    """
+    session_id = getattr(request, "session_hash", None)
+    if not JOB_QUEUE_ENABLED:
+        async for update in run_consultation(audio_filepath, image_filepath, progress, session_id=session_id):
+            yield (*update, "")
+        return
+    try:
+        # Oversized uploads are refused here rather than copied and queued
+        await asyncio.to_thread(check_uploads, audio_filepath, image_filepath)
+        job_id = await asyncio.to_thread(submit_job, audio_filepath, image_filepath, session_id)
+    except (JobQueueFull, UploadRejected) as e:
+        CONSULTATIONS.inc(outcome="rejected" if isinstance(e, UploadRejected) else "shed")
+        yield "", str(e), None, ""
+        return
+    async for update in follow_job(job_id, progress):
+        yield update
+
+async def resume_consultation(job_id, progress=gr.Progress()):
+    """Gradio handler picking up a queued or finished consultation by its ID."""
+    async for update in follow_job((job_id or "").strip(), progress):
+        yield update
+
+def submit_job(audio_filepath, image_filepath, session_id=None):
+    """
+    Queue a consultation for the worker processes.
+    
+    The uploads are copied into the artifact store first: Gradio's upload
+    directory belongs to the web app, and the workers must still find the
+    files if it restarts.
+    
+    Args:
+        audio_filepath (str): Recording of the patient's description, or None
+        image_filepath (str): Medical image, or None
+        session_id (str): Gradio session, for fair queueing at the providers
+    
+    Returns:
+        str: Job ID
+    """
+    job_dir = get_artifact_store().new_request_dir()
+    inputs = []
+    for name, path in (("patient_audio", audio_filepath), ("patient_image", image_filepath)):
+        if path:
+            inputs.append(shutil.copyfile(path, os.path.join(job_dir, name + os.path.splitext(path)[1])))
+        else:
+            inputs.append(None)
+    return get_job_queue().submit(*inputs, session_id=session_id)
+
+async def follow_job(job_id, progress):
+    """
+    Poll a queued consultation, yielding (transcript, response, audio segment, consultation ID) updates.
+    
+    Each audio segment is yielded once, as soon as the worker has written it.
+    If the job is rerun because its worker died, the rerun's results replace
+    the partial ones.
+    
+    Args:
+        job_id (str): ID returned by submit_job()
+        progress (gr.Progress): Progress callback
+    """
+    queue = get_job_queue()
+    shown = None
+    reported = None
+    sent = 0
+    attempts = None
+    while True:
+        job = await asyncio.to_thread(queue.get, job_id)
+        if job is None:
+            yield "", f"No consultation found with ID {job_id}. It may have expired.", None, job_id
+            return
+        if job["attempts"] != attempts:
+            attempts = job["attempts"]
+            sent = 0
+        if job["status"] == QUEUED:
+            position = await asyncio.to_thread(queue.position, job_id)
+            status = (0.0, f"Waiting for a free doctor: number {position} in line...")
+        elif job["status"] == RUNNING:
+            status = (job["progress"], job["message"] or "Initializing analysis...")
+        else:
+            status = None
+        if status is not None and status != reported:
+            reported = status
+            progress(*status)
+        
+        text = (job["speech_to_text"], job["doctor_response"])
+        if job["status"] == FAILED and job["error"] not in job["doctor_response"]:
+            # The worker gave up before the pipeline could report the error itself
+            text = (job["speech_to_text"], job["error"])
+        if text != shown:
+            shown = text
+            yield (*text, None, job_id)
+        for segment_filepath in job["segments"][sent:]:
+            yield (*text, segment_filepath, job_id)
+        sent = len(job["segments"])
+        if job["status"] in FINISHED:
+            return
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+async def run_consultation(audio_filepath, image_filepath, progress, *, transcript=None, stages=None, session_id=None):
+    """
+    Run one consultation in this process, yielding (transcript, response, audio segment) updates.
+    
+    Args:
+        audio_filepath (str): Recording of the patient's description, or None
+        image_filepath (str): Medical image, or None
+        progress (callable): gr.Progress or any callable taking a fraction and a description
+        transcript (str): Patient's description as text; skips transcription (batch runs)
+        stages (StageRunner): Runner to record stage timings in; its error is set on failure
+        session_id (str): Caller's session; requests from one session share one turn in the provider queues
+    """
     results = {
         "speech_to_text": "",
         "doctor_response": "",
         "voice_filepath": ""
     }
-    output_filepath = "doctor_response.mp3"
+    # Each consultation writes into its own directory so concurrent requests never collide
+    output_filepath = get_artifact_store().new_path("doctor_response.mp3")
+    # Speech is synthesized sentence by sentence while the analysis streams in
+    # Transcription, image preparation and opening the vision connection do not
+    # depend on each other, so they run concurrently
+    stages = stages if stages is not None else StageRunner()
+    tracker = StageProgress(progress, stages)
+    # Provider calls wait their fair turn per browser session and report their place in line
+    session = Session(session_id or uuid.uuid4().hex, lambda status: tracker.notice(_queue_message(status)))
+    speech = AsyncSpeechPipeline(output_filepath, session=session)
+    started = time.perf_counter()
+    first_audio = False
+
+    def with_audio(segment_filepath):
+        nonlocal first_audio
+        if not first_audio:
+            first_audio = True
+            TIME_TO_FIRST_AUDIO.observe(time.perf_counter() - started)
+        return results["speech_to_text"], results["doctor_response"], segment_filepath
+
+    if transcript is not None or not audio_filepath:
+        tracker.skip("stt")
+    if not image_filepath:
+        tracker.skip("image_prep", "vision")
     try:
-        progress(0.05, "Initializing analysis...")
-        time.sleep(0.5)
-        progress(0.1, "Processing your audio description...")
-        if audio_filepath:
-            progress(0.2, "Converting speech to text...")
-            results["speech_to_text"] = transcribe_with_groq(
+        get_scheduler().check_capacity()
+        await asyncio.to_thread(check_uploads, audio_filepath, image_filepath)
+        tracker.update("Initializing analysis...")
+        if audio_filepath and transcript is None:
+            stt_task = stages.start("stt", transcribe_with_groq_async(
                 GROQ_API_KEY=os.environ.get("GROQ_API_KEY"),
                 audio_filepath=audio_filepath,
-                stt_model="whisper-large-v3"
-            )
+                stt_model=preferred_stt_model(),
+                session=session
+            ))
+        if image_filepath:
+            image_task = stages.start("image_prep", asyncio.to_thread(prepare_image, image_filepath))
+        if transcript is not None:
+            results["speech_to_text"] = transcript
+        elif audio_filepath:
+            tracker.update("Converting speech to text...")
+            results["speech_to_text"] = await stt_task
         else:
             results["speech_to_text"] = "No audio provided. Please describe your medical concern."
-        progress(0.3, "Preparing medical image...")
+        yield results["speech_to_text"], results["doctor_response"], None
         if image_filepath:
-            progress(0.4, "Analyzing visual patterns...")
+            tracker.update("Preparing medical image...")
             full_query = system_prompt + results["speech_to_text"]
-            progress(0.5, "Consulting medical knowledge base...")
-            results["doctor_response"] = analyze_image_with_query(
-                query=full_query,
-                encoded_image=encode_image(image_filepath),
-                model="meta-llama/llama-4-scout-17b-16e-instruct"
-            )
+            encoded_image, media_type = await image_task
+            tracker.update("Analyzing visual patterns...")
+            # Stream the analysis so the patient sees text as soon as the first tokens arrive;
+            # identical resubmissions are served from the cache or share one upstream call
+            analysis_key = cache_key(encoded_image, results["speech_to_text"], SYSTEM_PROMPT_VERSION, MODELS_TO_TRY)
+            async with stages.stage("vision", depends_on=("stt", "image_prep")):
+                async for chunk in get_analysis_cache().stream(analysis_key, lambda: analyze_image_with_query_async(
+                    query=full_query,
+                    encoded_image=encoded_image,
+                    model=VISION_MODEL,
+                    stream=True,
+                    media_type=media_type,
+                    session=session
+                )):
+                    results["doctor_response"] += chunk
+                    speech.feed(chunk)
+                    tracker.update("Consulting medical knowledge base...", vision=len(results["doctor_response"]) / EXPECTED_RESPONSE_CHARS)
+                    yield results["speech_to_text"], results["doctor_response"], None
+                    for segment_filepath in speech.ready_segments():
+                        yield with_audio(segment_filepath)
         else:
-            results["doctor_response"] = "No image provided for analysis. Please upload a clear medical image for diagnosis."
-        progress(0.7, "Generating doctor's response...")
-        progress(0.8, "Creating natural voice output...")
-        text_to_speech_with_elevenlabs(
-            input_text=results["doctor_response"],
-            output_filepath=output_filepath
-        )
-        results["voice_filepath"] = output_filepath
-        progress(0.95, "Finalizing results...")
-        time.sleep(0.5)
-        progress(1.0, "Consultation complete!")
+            results["doctor_response"] = NO_IMAGE_MESSAGE
+            speech.feed(results["doctor_response"])
+            yield results["speech_to_text"], results["doctor_response"], None
+        speech.close()
+        tracker.update("Creating natural voice output...")
+        async with stages.stage("tts", depends_on=("vision", "stt")):
+            async for segment_filepath in speech.remaining_segments():
+                done, queued = speech.segment_counts()
+                tracker.update("Creating natural voice output...", tts=done / max(queued, 1))
+                yield with_audio(segment_filepath)
+            results["voice_filepath"] = await speech.combine()
+        tracker.update("Consultation complete!")
+        stages.finish()
+        stages.log_report()
+        CONSULTATIONS.inc(outcome="ok")
+        CONSULTATION_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+    except (asyncio.CancelledError, GeneratorExit):
+        # Timed out, or the consumer went away: stop synthesizing speech nobody will hear
+        stages.cancel()
+        stages.finish()
+        speech.abort()
+        raise
     except Exception as e:
-        error_message = f"An error occurred: {str(e)}"
+        # Shed requests and oversized uploads are turned away before using the providers; say so plainly
+        if isinstance(e, SchedulerOverloaded):
+            outcome = "shed"
+        elif isinstance(e, UploadRejected):
+            outcome = "rejected"
+        else:
+            outcome = "error"
+        CONSULTATIONS.inc(outcome=outcome)
+        CONSULTATION_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+        stages.error = e
+        # A failed transcription leaves image preparation running; stop it and collect its result
+        await stages.shutdown()
+        stages.finish()
+        speech.abort()
+        error_message = f"An error occurred: {str(e)}" if outcome == "error" else str(e)
         results["doctor_response"] = error_message
-        text_to_speech_with_gtts(
-            input_text="I'm sorry, there was an error processing your request. Please try again.",
-            output_filepath=output_filepath
+        # None when gTTS fails too; the text error is still shown
+        results["voice_filepath"] = await asyncio.to_thread(
+            text_to_speech_with_gtts,
+            input_text=ERROR_SPEECH_MESSAGE,
+            output_filepath=output_filepath,
+            autoplay=False
         )
-        results["voice_filepath"] = output_filepath
-    return results["speech_to_text"], results["doctor_response"], results["voice_filepath"]
+        yield results["speech_to_text"], results["doctor_response"], results["voice_filepath"]
+        return
+    # The audio has already been streamed segment by segment
+    yield results["speech_to_text"], results["doctor_response"], None
+
+def _queue_message(status):
+    """Describe a rate_limiter.QueueStatus for the progress bar."""
+    if "whisper" in status.resource:
+        service = "speech recognition"
+    elif status.resource.startswith("elevenlabs"):
+        service = "voice synthesis"
+    else:
+        service = "image analysis"
+    return f"Busy: waiting for {service}, number {status.position} of {status.waiting} in line, about {math.ceil(status.eta)}s"
+
+def collect_runtime_gauges():
+    """Export connection pool, cache, TTS engine and model health statistics as gauges."""
+    for provider, stats in pool_stats().items():
+        for name, value in stats.items():
+            yield "ai_doctor_http_pool", "Shared provider connection pool statistics", {"provider": provider, "stat": name}, value
+    for cache, stats in (("analysis", get_analysis_cache().stats()), ("tts", get_tts_cache().stats())):
+        for name, value in stats.items():
+            yield "ai_doctor_cache", "Analysis and TTS cache statistics", {"cache": cache, "stat": name}, value
+    for engine, count in tts_engine_stats().items():
+        yield "ai_doctor_tts_served", "Speech segments served by each engine since startup", {"engine": engine}, count
+    for model, state in get_model_health().snapshot().items():
+        yield "ai_doctor_model_closed", "1 while a model is neither unavailable, rate limited nor circuit-open", {"model": model}, int(state["state"] == "closed")
+    for resource, waiting in get_scheduler().backlog().items():
+        yield "ai_doctor_scheduler_backlog", "Requests waiting for a provider's rate-limit budget", {"resource": resource}, waiting
+    if JOB_QUEUE_ENABLED:
+        for status, count in get_job_queue().counts().items():
+            yield "ai_doctor_jobs", "Consultations in the job queue by status", {"status": status}, count
+    ready, details = get_readiness().check()
+    yield "ai_doctor_ready", "1 once warm-up has finished and the worker should receive traffic", {}, int(ready)
+    for name, step in details["steps"].items():
+        yield "ai_doctor_warmup_step_seconds", "Duration of each warm-up step, by outcome", {"step": name, "status": step["status"]}, step["seconds"]
+
+def prewarm_canned_speech():
+    """Fill the TTS cache with the canned phrases and the gTTS error message."""
+    try:
+        prewarm_tts_cache(CANNED_PHRASES)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            text_to_speech_with_gtts(ERROR_SPEECH_MESSAGE, os.path.join(temp_dir, "error.mp3"), autoplay=False)
+    except Exception as e:
+        logger.error(f"TTS pre-warm failed: {str(e)}")
 
 custom_css = """
 :root {
@@ -176,6 +461,15 @@ def create_interface():
                 with gr.Row():
                     submit_btn = gr.Button("Begin Analysis", elem_classes="primary-button")
                     clear_btn = gr.Button("New Consultation", elem_classes="secondary-button")
+                
+                # Queued consultations can be picked up again, e.g. after a page reload
+                with gr.Row(visible=JOB_QUEUE_ENABLED):
+                    job_id_input = gr.Textbox(
+                        label="Consultation ID",
+                        placeholder="Paste an ID to pick up an earlier consultation",
+                        scale=3
+                    )
+                    resume_btn = gr.Button("Resume", elem_classes="secondary-button", scale=1)
 
             with gr.Column(scale=1, min_width=400, elem_classes="card"):
                 gr.Markdown(
@@ -216,7 +510,9 @@ def create_interface():
                 )
                 audio_output = gr.Audio(
                     label="Listen to Dr. AI's voice response",
-                    elem_id="audio-output"
+                    elem_id="audio-output",
+                    streaming=True,
+                    autoplay=True
                 )
 
         gr.Markdown(
@@ -229,21 +525,54 @@ def create_interface():
             elem_classes="footer"
         )
 
+        # Following a queued consultation only polls the database, so it needs no limit
         submit_btn.click(
             fn=process_inputs,
             inputs=[audio_input, image_input],
-            outputs=[text_output, response_output, audio_output]
+            outputs=[text_output, response_output, audio_output, job_id_input],
+            concurrency_limit=None if JOB_QUEUE_ENABLED else CONSULTATION_CONCURRENCY
+        )
+
+        resume_btn.click(
+            fn=resume_consultation,
+            inputs=[job_id_input],
+            outputs=[text_output, response_output, audio_output, job_id_input],
+            concurrency_limit=None
         )
 
         clear_btn.click(
-            fn=lambda: (None, None, "", "", None),
+            fn=lambda: (None, None, "", "", None, ""),
             inputs=[],
-            outputs=[audio_input, image_input, text_output, response_output, audio_output]
+            outputs=[audio_input, image_input, text_output, response_output, audio_output, job_id_input]
         )
 
+    iface.queue(max_size=QUEUE_MAX_SIZE)
     return iface
 
 if __name__ == "__main__":
+    configure()
     os.makedirs("examples", exist_ok=True)
+    artifact_store = get_artifact_store()
+    if JOB_QUEUE_ENABLED:
+        # Queued and finished jobs keep their files until the job itself is pruned
+        artifact_store.register_in_use(get_job_queue().referenced_paths)
+    artifact_store.start_sweeper()
+    get_metrics().register_collector(collect_runtime_gauges)
+    # Also answered next to /metrics, for scrapers that only reach that port
+    register_status_endpoint("/ready", get_readiness().check)
+    start_metrics_server()
     iface = create_interface()
-    iface.launch(debug=True, css=custom_css)
+    logger.info(f"Interface built {uptime():.2f}s after the first import")
+    # Warm-up runs on the server's event loop, where the async clients will be used;
+    # in job mode provider calls happen in the job_worker.py processes, which warm up themselves.
+    # Load balancers should route to the app only once its /ready answers 200
+    lifespan = warm_up_lifespan(prewarm_canned_speech if TTS_PREWARM else None, warm=WARMUP_ENABLED and not JOB_QUEUE_ENABLED)
+    app_kwargs = {"lifespan": lifespan}
+    iface.launch(
+        debug=True,
+        css=custom_css,
+        allowed_paths=[artifact_store.root],
+        # Larger uploads are refused while they stream in, before any handler runs
+        max_file_size=UPLOAD_MAX_BYTES,
+        app_kwargs=app_kwargs
+    )
@@ -0,0 +1,174 @@
+# artifact_store.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("ArtifactStore")
+
+# Where per-request audio is written, and how much of it is kept
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "ai-doctor-artifacts"))
+ARTIFACT_MAX_BYTES = int(os.environ.get("ARTIFACT_MAX_BYTES", str(500 * 1024 * 1024)))
+ARTIFACT_MAX_AGE = float(os.environ.get("ARTIFACT_MAX_AGE", "3600"))
+ARTIFACT_SWEEP_INTERVAL = float(os.environ.get("ARTIFACT_SWEEP_INTERVAL", "60"))
+
+# Size-based eviction never removes requests younger than this, so a
+# consultation still streaming its audio is not deleted underneath it
+ARTIFACT_MIN_AGE = 120
+
+class ArtifactStore:
+    """
+    Per-request directories for generated files, with size- and age-based eviction.
+
+    Every consultation gets its own directory, so concurrent requests never
+    write to the same path. sweep() deletes whole request directories once they
+    exceed max_age, then the oldest ones until the store fits in max_bytes.
+    Directories holding files that something still refers to (see
+    register_in_use()) are kept whatever their age.
+    """
+
+    def __init__(self, root=ARTIFACT_DIR, max_bytes=ARTIFACT_MAX_BYTES, max_age=ARTIFACT_MAX_AGE):
+        """
+        Args:
+            root (str): Directory holding the request directories
+            max_bytes (int): Total size the store is trimmed to on each sweep
+            max_age (float): Seconds after which a request directory is deleted
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._stop = threading.Event()
+        self._sweeper = None
+        self._in_use_checks = []
+        os.makedirs(self.root, exist_ok=True)
+
+    def new_request_dir(self):
+        """
+        Create a unique directory for one request.
+
+        Returns:
+            str: Path of the new directory
+        """
+        request_dir = os.path.join(self.root, f"{int(time.time())}-{uuid.uuid4().hex}")
+        os.makedirs(request_dir)
+        return request_dir
+
+    def new_path(self, filename):
+        """
+        Return a path for filename inside a fresh request directory.
+
+        Args:
+            filename (str): Name of the file to create
+
+        Returns:
+            str: Path of the file (not yet created)
+        """
+        return os.path.join(self.new_request_dir(), filename)
+
+    def register_in_use(self, check):
+        """
+        Keep request directories that hold files still referred to elsewhere.
+
+        Args:
+            check (callable): Returns paths of files that must not be evicted; called on every sweep
+        """
+        self._in_use_checks.append(check)
+
+    def _in_use_dirs(self):
+        in_use = set()
+        for check in self._in_use_checks:
+            for path in check():
+                relative = os.path.relpath(os.path.abspath(path), self.root)
+                if not relative.startswith(os.pardir):
+                    in_use.add(os.path.join(self.root, relative.split(os.sep, 1)[0]))
+        return in_use
+
+    def sweep(self):
+        """
+        Evict expired request directories, then the oldest ones beyond max_bytes.
+
+        Returns:
+            dict: Number of directories removed and bytes freed
+        """
+        now = time.time()
+        in_use = self._in_use_dirs()
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+
+        removed = 0
+        freed = 0
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            age = now - mtime
+            expired = age > self.max_age
+            over_budget = total > self.max_bytes and age > ARTIFACT_MIN_AGE
+            if not (expired or over_budget) or path in in_use:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            freed += size
+            total -= size
+
+        if removed:
+            logger.info(f"Evicted {removed} request directories ({freed} bytes), {total} bytes remain")
+        return {"removed": removed, "freed_bytes": freed, "total_bytes": total}
+
+    def start_sweeper(self, interval=ARTIFACT_SWEEP_INTERVAL):
+        """Run sweep() every interval seconds on a daemon thread."""
+        if self._sweeper is not None:
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,), name="artifact-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        """Stop the background sweeper thread."""
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def _sweep_loop(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Artifact sweep failed: {str(e)}")
+            self._stop.wait(interval)
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+    return total
+
+_default_store = None
+_default_lock = threading.Lock()
+
+def get_artifact_store():
+    """Return the process-wide ArtifactStore configured from the environment."""
+    global _default_store
+    if _default_store is None:
+        with _default_lock:
+            if _default_store is None:
+                _default_store = ArtifactStore()
+    return _default_store
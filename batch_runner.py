@@ -0,0 +1,290 @@
+# batch_runner.py
+
+from bootstrap import load_environment, configure
+load_environment()
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from app import run_consultation
+from voice_of_the_doctor import join_segments
+from stage_runner import StageRunner
+
+logger = logging.getLogger("BatchRunner")
+
+# Consultations run at once, and how long one may take before it is abandoned
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_JOB_TIMEOUT = float(os.environ.get("BATCH_JOB_TIMEOUT", "300"))
+
+# Companion files in directory mode, matched to each other by file name stem
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+AUDIO_EXTENSIONS = {".wav", ".mp3", ".m4a", ".ogg", ".flac", ".webm", ".aac"}
+TEXT_EXTENSIONS = {".txt"}
+
+def iter_jobs(source):
+    """
+    Read consultation jobs from a JSONL file or a directory.
+
+    A JSONL job has an "image" path, an "audio" path and/or a "text"
+    description, plus an optional "id"; relative paths are resolved against
+    the file's directory. In a directory, files sharing a name stem (for
+    example case1.jpg, case1.wav and case1.txt) form one job.
+
+    Args:
+        source (str): Path to a .jsonl file or a directory
+
+    Yields:
+        dict: Job with "id", "image", "audio" and "text" keys
+    """
+    if os.path.isdir(source):
+        yield from _iter_directory_jobs(source)
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"Skipping line {line_number} of {source}: {str(e)}")
+                continue
+            job = {
+                "image": _resolve(base_dir, entry.get("image")),
+                "audio": _resolve(base_dir, entry.get("audio")),
+                "text": entry.get("text")
+            }
+            job["id"] = str(entry.get("id") or _job_id(job))
+            yield job
+
+def completed_job_ids(output_path):
+    """
+    Return the IDs of jobs already recorded as successful in a results file.
+
+    A line cut short by an interrupted run is ignored, so that job runs again.
+
+    Args:
+        output_path (str): Results JSONL written by a previous run
+
+    Returns:
+        set: Job IDs with status "ok"
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                completed.add(record.get("id"))
+    return completed
+
+async def run_job(job, audio_dir=None, timeout=BATCH_JOB_TIMEOUT):
+    """
+    Run one consultation through run_consultation and collect its result.
+
+    Args:
+        job (dict): Job from iter_jobs()
+        audio_dir (str): Directory to write the spoken response to as <id>.mp3; None skips it
+        timeout (float): Seconds before the consultation is abandoned
+
+    Returns:
+        dict: Result record for the results file
+    """
+    stages = StageRunner()
+    record = {
+        "id": job["id"],
+        "image": job["image"],
+        "audio": job["audio"],
+        "text": job["text"],
+        "status": "ok",
+        "error": None,
+        "transcript": "",
+        "response": "",
+        "audio_output": None
+    }
+    segments = []
+
+    consultation = run_consultation(
+        job["audio"],
+        job["image"],
+        progress=_no_progress,
+        transcript=job["text"],
+        stages=stages
+    )
+
+    async def consume():
+        async for transcript, response, segment_filepath in consultation:
+            record["transcript"] = transcript
+            record["response"] = response
+            if segment_filepath:
+                segments.append(segment_filepath)
+
+    try:
+        await asyncio.wait_for(consume(), timeout)
+        if audio_dir and segments and stages.error is None:
+            record["audio_output"] = await asyncio.to_thread(join_segments, segments, os.path.join(audio_dir, f"{_safe_name(job['id'])}.mp3"))
+    except asyncio.TimeoutError:
+        stages.error = TimeoutError(f"Consultation took longer than {timeout:.0f}s")
+        stages.cancel()
+    except Exception as e:
+        stages.error = e
+    finally:
+        # Runs the consultation's cleanup, which stops speech segments still being synthesized
+        await consultation.aclose()
+
+    stages.finish()
+    if stages.error is not None:
+        record["status"] = "error"
+        record["error"] = str(stages.error)
+    record["stages"] = stages.report()
+    record["completed_at"] = time.time()
+    return record
+
+async def run_batch(source, output_path, concurrency=BATCH_CONCURRENCY, audio_dir=None, timeout=BATCH_JOB_TIMEOUT, limit=None):
+    """
+    Run every job not yet completed, appending results as they finish.
+
+    Jobs are read lazily and handed to a fixed number of workers, so memory
+    stays flat for runs of thousands of cases. Each result is written and
+    flushed as soon as its consultation finishes; rerunning with the same
+    output file skips jobs that already succeeded.
+
+    Args:
+        source (str): JSONL job file or directory of cases
+        output_path (str): Results JSONL, appended to
+        concurrency (int): Consultations run at once
+        audio_dir (str): Directory for spoken responses; None skips writing them
+        timeout (float): Seconds before a consultation is abandoned
+        limit (int): Maximum number of jobs to run this time
+
+    Returns:
+        dict: Counts of jobs run, succeeded, failed and skipped, and elapsed seconds
+    """
+    completed = completed_job_ids(output_path)
+    if audio_dir:
+        os.makedirs(audio_dir, exist_ok=True)
+    summary = {"run": 0, "ok": 0, "error": 0, "skipped": 0}
+    started = time.perf_counter()
+    jobs = asyncio.Queue(maxsize=concurrency * 2)
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        _terminate_partial_line(output_path, output)
+
+        async def worker():
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                record = await run_job(job, audio_dir=audio_dir, timeout=timeout)
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                summary["run"] += 1
+                summary[record["status"]] += 1
+                logger.info(f"Job {job['id']}: {record['status']} in {record['stages']['total']:.2f}s ({summary['run']} done)")
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        try:
+            queued = 0
+            for job in iter_jobs(source):
+                if job["id"] in completed:
+                    summary["skipped"] += 1
+                    continue
+                if limit is not None and queued >= limit:
+                    break
+                completed.add(job["id"])
+                await jobs.put(job)
+                queued += 1
+            for _ in workers:
+                await jobs.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(f"Batch finished: {summary}")
+    return summary
+
+def _iter_directory_jobs(directory):
+    cases = {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            ext = ext.lower()
+            if ext in IMAGE_EXTENSIONS:
+                kind = "image"
+            elif ext in AUDIO_EXTENSIONS:
+                kind = "audio"
+            elif ext in TEXT_EXTENSIONS:
+                kind = "text"
+            else:
+                continue
+            case_id = os.path.relpath(os.path.join(root, stem), directory)
+            cases.setdefault(case_id, {"id": case_id, "image": None, "audio": None, "text": None})[kind] = os.path.join(root, name)
+    for case_id in sorted(cases):
+        job = cases[case_id]
+        if job["text"]:
+            with open(job["text"], "r", encoding="utf-8") as f:
+                job["text"] = f.read().strip()
+        yield job
+
+def _resolve(base_dir, path):
+    if not path:
+        return None
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+def _job_id(job):
+    """Stable ID for a job without one, so reruns recognize it."""
+    digest = hashlib.sha256(json.dumps([job["image"], job["audio"], job["text"]]).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+def _safe_name(job_id):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in job_id)
+
+def _terminate_partial_line(output_path, output):
+    """Start on a fresh line if the previous run died mid-write."""
+    if output.tell() == 0:
+        return
+    with open(output_path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            output.write("\n")
+
+def _no_progress(*args, **kwargs):
+    pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run consultations in bulk from a JSONL job file or a directory of cases.")
+    parser.add_argument("source", help="JSONL file of jobs, or a directory of images with optional matching audio/.txt files")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="Results JSONL; completed jobs in it are skipped")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="Consultations run at once")
+    parser.add_argument("--audio-dir", help="Write each spoken response to this directory as <id>.mp3")
+    parser.add_argument("--timeout", type=float, default=BATCH_JOB_TIMEOUT, help="Seconds before a consultation is abandoned")
+    parser.add_argument("--limit", type=int, help="Run at most this many jobs")
+    args = parser.parse_args(argv)
+    configure()
+
+    summary = asyncio.run(run_batch(
+        args.source,
+        args.output,
+        concurrency=args.concurrency,
+        audio_dir=args.audio_dir,
+        timeout=args.timeout,
+        limit=args.limit
+    ))
+    return 1 if summary["error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,395 @@
+# benchmarks.py
+
+from bootstrap import load_environment, configure
+load_environment()
+
+import os
+import gc
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import wave
+import multiprocessing
+from collections import OrderedDict
+
+logger = logging.getLogger("Benchmarks")
+
+# Fixed fixtures: the sample images plus generated ones, cached between runs
+TEST_PICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test-pics")
+BENCHMARK_FIXTURE_DIR = os.environ.get("BENCHMARK_FIXTURE_DIR", os.path.join(tempfile.gettempdir(), "ai-doctor-bench-fixtures"))
+BENCHMARK_RESULTS_DIR = "benchmark-results"
+
+# Synthetic recordings: lengths in seconds, at a typical microphone rate
+RECORDING_SECONDS = (30, 120, 600)
+RECORDING_SAMPLE_RATE = 44100
+
+# Maps a random high byte to -8..7, keeping its sign
+QUIET_HIGH_BYTE = bytes((b >> 4) if b < 128 else 0xF0 | (b >> 4) for b in range(256))
+
+# A phone-camera sized photo, the common case the resize path exists for
+SYNTHETIC_PHOTO_SIZE = (4032, 3024)
+
+# Modules whose cold import (in a fresh interpreter) is timed, to catch startup regressions
+STARTUP_MODULES = ("app", "brain_of_the_doctor", "voice_of_the_patient", "voice_of_the_doctor")
+
+# Median slowdowns (and memory growth) beyond this are flagged by --compare
+REGRESSION_THRESHOLD = 0.10
+# Cases faster than this are too noisy to flag
+MIN_COMPARABLE_MS = 1.0
+
+def write_recording_fixture(path, seconds, sample_rate=RECORDING_SAMPLE_RATE, seed=0):
+    """
+    Write a deterministic 16-bit mono WAV of noise bursts separated by pauses.
+
+    The bursts stand in for speech and the pauses for silence, so silence
+    detection and splitting do the same work they do on a real recording.
+
+    Args:
+        path (str): Output file
+        seconds (float): Length of the recording
+        sample_rate (int): Samples per second
+        seed (int): Random seed; the same seed always gives the same file
+    """
+    rng = random.Random(seed)
+    total = int(seconds * sample_rate)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        written = 0
+        while written < total:
+            burst = min(total - written, int(rng.uniform(0.8, 3.0) * sample_rate))
+            # Uniform noise with the high byte shrunk to a speech-like level (about -24 dBFS)
+            noise = bytearray(2 * burst)
+            noise[0::2] = rng.randbytes(burst)
+            noise[1::2] = rng.randbytes(burst).translate(QUIET_HIGH_BYTE)
+            wav.writeframes(noise)
+            pause = min(total - written - burst, int(rng.uniform(0.2, 1.5) * sample_rate))
+            wav.writeframes(bytes(2 * pause))
+            written += burst + pause
+
+def write_photo_fixture(path, size=SYNTHETIC_PHOTO_SIZE, seed=0):
+    """Write a deterministic, photo-like JPEG (smooth gradients plus noise) of the given size."""
+    from PIL import Image, ImageFilter
+    rng = random.Random(seed)
+    small = Image.frombytes("RGB", (size[0] // 16, size[1] // 16), rng.randbytes(3 * (size[0] // 16) * (size[1] // 16)))
+    image = small.resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    image.save(path, format="JPEG", quality=92)
+
+def prepare_fixtures(fixture_dir=BENCHMARK_FIXTURE_DIR):
+    """
+    Create the generated fixtures that do not exist yet.
+
+    Returns:
+        dict: Fixture name to path, for images and recordings
+    """
+    os.makedirs(fixture_dir, exist_ok=True)
+    images = OrderedDict((name, os.path.join(TEST_PICS_DIR, name)) for name in sorted(os.listdir(TEST_PICS_DIR)))
+    photo = os.path.join(fixture_dir, f"photo-{SYNTHETIC_PHOTO_SIZE[0]}x{SYNTHETIC_PHOTO_SIZE[1]}.jpg")
+    if not os.path.exists(photo):
+        write_photo_fixture(photo)
+    images[os.path.basename(photo)] = photo
+
+    recordings = OrderedDict()
+    for seconds in RECORDING_SECONDS:
+        path = os.path.join(fixture_dir, f"recording-{seconds}s.wav")
+        if not os.path.exists(path):
+            logger.info(f"Generating {seconds}s recording fixture")
+            write_recording_fixture(path, seconds)
+        recordings[f"{seconds}s"] = path
+    return {"images": images, "recordings": recordings}
+
+def benchmark_cases(fixtures):
+    """
+    Build the benchmark cases for a set of fixtures.
+
+    Each case maps a name to (setup, needs_ffmpeg). setup() does the untimed
+    preparation and returns the zero-argument callable that is timed.
+
+    Returns:
+        OrderedDict: Case name to (setup, needs_ffmpeg)
+    """
+    from PIL import Image
+    from image_preprocessing import preprocess_image
+    from brain_of_the_doctor import encode_image
+    from pydub import AudioSegment
+    import voice_of_the_patient as patient
+
+    cases = OrderedDict()
+
+    for name, path in fixtures["images"].items():
+        def decode(path=path):
+            def run():
+                with Image.open(path) as image:
+                    image.load()
+            return run
+
+        def preprocess(path=path):
+            return lambda: preprocess_image(path)
+
+        def encode_base64(path=path):
+            data = preprocess_image(path).data
+            return lambda: base64.b64encode(data).decode("utf-8")
+
+        def encode(path=path):
+            return lambda: encode_image(path)
+
+        cases[f"image.decode[{name}]"] = (decode, False)
+        cases[f"image.preprocess[{name}]"] = (preprocess, False)
+        cases[f"image.base64[{name}]"] = (encode_base64, False)
+        cases[f"image.encode_image[{name}]"] = (encode, False)
+
+    for name, path in fixtures["recordings"].items():
+        def decode(path=path):
+            return lambda: AudioSegment.from_file(path)
+
+        def load_for_stt(path=path):
+            return lambda: patient._load_for_stt(path)
+
+        def trim(path=path):
+            audio = patient._load_for_stt(path)
+            return lambda: patient.trim_silence(audio)
+
+        def split(path=path):
+            audio, _ = patient.trim_silence(patient._load_for_stt(path))
+            return lambda: patient.split_on_pauses(audio, int(patient.STT_SEGMENT_SECONDS * 1000))
+
+        def encode_flac(path=path):
+            audio = patient._load_for_stt(path)
+            return lambda: patient._encode_segment(audio, "audio", "flac")
+
+        def prepare_upload(path=path):
+            return lambda: patient._prepare_audio_for_upload(path)
+
+        def wav_to_mp3(path=path):
+            with open(path, "rb") as f:
+                wav_data = f.read()
+            output = os.path.join(tempfile.mkdtemp(), "recording.mp3")
+            return lambda: patient.save_wav_as_mp3(wav_data, output)
+
+        cases[f"audio.decode[{name}]"] = (decode, False)
+        cases[f"audio.load_for_stt[{name}]"] = (load_for_stt, False)
+        cases[f"audio.trim_silence[{name}]"] = (trim, False)
+        cases[f"audio.split_on_pauses[{name}]"] = (split, False)
+        cases[f"audio.encode_flac[{name}]"] = (encode_flac, True)
+        cases[f"audio.prepare_upload[{name}]"] = (prepare_upload, True)
+        cases[f"audio.wav_to_mp3[{name}]"] = (wav_to_mp3, True)
+
+    for module in STARTUP_MODULES:
+        def cold_import(module=module):
+            command = [sys.executable, "-c", f"import {module}"]
+            return lambda: subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+        cases[f"startup.import[{module}]"] = (cold_import, False)
+
+    return cases
+
+def run_case(name, fixtures, repeat=5):
+    """
+    Time one case and measure its peak memory, in the current process.
+
+    Peak resident memory is taken over the first run after setup (where
+    Linux allows resetting the peak), which doubles as the warm-up; the case
+    then runs repeat times for timing, and once more under tracemalloc for
+    peak Python allocations, kept out of the timed runs because it slows them.
+
+    Args:
+        name (str): Case name from benchmark_cases()
+        fixtures (dict): Fixtures from prepare_fixtures()
+        repeat (int): Timed runs
+
+    Returns:
+        dict: Timings in milliseconds and peak memory in MiB
+    """
+    setup, _ = benchmark_cases(fixtures)[name]
+    run = setup()
+
+    # The first run also warms up; measured cold, before the allocator has
+    # memory it can reuse, it shows how much the stage really needs
+    gc.collect()
+    baseline = _current_rss()
+    reset = _reset_peak_rss()
+    run()
+    peak_rss = _peak_rss() - baseline if reset else None
+
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "stdev_ms": round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+        "peak_rss_mib": round(max(peak_rss, 0) / 2 ** 20, 2) if peak_rss is not None else None,
+        "peak_python_mib": round(peak_python / 2 ** 20, 2),
+        "runs": repeat
+    }
+
+def run_benchmarks(fixtures, selected=None, repeat=5):
+    """
+    Run cases, each in a fresh process so memory figures do not leak between them.
+
+    Args:
+        fixtures (dict): Fixtures from prepare_fixtures()
+        selected (list): Substrings; only cases containing one of them run
+        repeat (int): Timed runs per case
+
+    Returns:
+        OrderedDict: Case name to result, or to {"skipped": reason}
+    """
+    has_ffmpeg = _has_ffmpeg()
+    context = multiprocessing.get_context("spawn")
+    results = OrderedDict()
+    for name, (_, needs_ffmpeg) in benchmark_cases(fixtures).items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        if needs_ffmpeg and not has_ffmpeg:
+            results[name] = {"skipped": "ffmpeg not found"}
+            continue
+        with context.Pool(1) as pool:
+            try:
+                results[name] = pool.apply(run_case, (name, fixtures, repeat))
+            except Exception as e:
+                results[name] = {"skipped": f"failed: {str(e)}"}
+        logger.info(f"{name}: {_describe(results[name])}")
+    return results
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare two result files case by case.
+
+    Returns:
+        list: (case, median ratio, peak RSS ratio, regressed) for cases present in both
+    """
+    rows = []
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name)
+        if not previous or "skipped" in result or "skipped" in previous:
+            continue
+        comparable = max(result["median_ms"], previous["median_ms"]) >= MIN_COMPARABLE_MS
+        time_ratio = result["median_ms"] / previous["median_ms"] if comparable and previous["median_ms"] else None
+        rss_ratio = None
+        if result.get("peak_rss_mib") and previous.get("peak_rss_mib"):
+            rss_ratio = result["peak_rss_mib"] / previous["peak_rss_mib"]
+        regressed = any(ratio is not None and ratio > 1 + threshold for ratio in (time_ratio, rss_ratio))
+        rows.append((name, time_ratio, rss_ratio, regressed))
+    return rows
+
+def environment_info():
+    """Describe the code and machine a run was made on."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip())
+    except OSError:
+        commit, dirty = "", False
+    return {
+        "commit": commit or "unknown",
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+def format_results(results):
+    lines = [f"{'case':<48}{'median ms':>12}{'min ms':>10}{'rss MiB':>10}{'py MiB':>10}"]
+    for name, result in results.items():
+        if "skipped" in result:
+            lines.append(f"{name:<48}  skipped ({result['skipped']})")
+            continue
+        rss = f"{result['peak_rss_mib']:.1f}" if result["peak_rss_mib"] is not None else "n/a"
+        lines.append(f"{name:<48}{result['median_ms']:>12.2f}{result['min_ms']:>10.2f}{rss:>10}{result['peak_python_mib']:>10.1f}")
+    return "\n".join(lines)
+
+def format_comparison(rows, baseline_environment):
+    lines = [f"Compared with {baseline_environment.get('commit')} ({baseline_environment.get('timestamp')})",
+             f"{'case':<48}{'time':>10}{'rss':>10}"]
+    for name, time_ratio, rss_ratio, regressed in rows:
+        lines.append(f"{name:<48}{_ratio(time_ratio):>10}{_ratio(rss_ratio):>10}{'  REGRESSED' if regressed else ''}")
+    return "\n".join(lines)
+
+def _ratio(ratio):
+    return "n/a" if ratio is None else f"{(ratio - 1) * 100:+.0f}%"
+
+def _describe(result):
+    if "skipped" in result:
+        return f"skipped ({result['skipped']})"
+    return f"{result['median_ms']:.2f} ms median, peak RSS {result['peak_rss_mib']} MiB, peak Python {result['peak_python_mib']} MiB"
+
+def _has_ffmpeg():
+    from pydub.utils import get_encoder_name
+    return shutil.which(get_encoder_name()) is not None
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux 4.0+); False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-bound image and audio stages and cold imports.")
+    parser.add_argument("-k", "--filter", action="append", help="Only run cases whose name contains this (repeatable)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("-o", "--output", help=f"Result file; defaults to {BENCHMARK_RESULTS_DIR}/<commit>.json")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    args = parser.parse_args(argv)
+    configure()
+
+    fixtures = prepare_fixtures()
+    environment = environment_info()
+    results = run_benchmarks(fixtures, selected=args.filter, repeat=args.repeat)
+    report = {"environment": environment, "results": results}
+
+    output = args.output or os.path.join(BENCHMARK_RESULTS_DIR, f"{environment['commit']}{'-dirty' if environment['dirty'] else ''}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(format_results(results))
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline)
+        print(format_comparison(rows, baseline.get("environment", {})))
+        return 1 if any(regressed for *_, regressed in rows) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
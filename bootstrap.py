@@ -0,0 +1,113 @@
+# bootstrap.py
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+
+# Taken when the first project module is imported, as close to process start as we get
+PROCESS_STARTED = time.perf_counter()
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Cold-import budget for the web app in milliseconds, checked by the import report
+STARTUP_IMPORT_BUDGET_MS = float(os.environ.get("STARTUP_IMPORT_BUDGET_MS", "6000"))
+
+_lock = threading.Lock()
+_environment_loaded = False
+_logging_configured = False
+
+def load_environment():
+    """
+    Load .env into the environment once per process.
+
+    Every module calls this before reading its settings; only the first call
+    reads the file.
+    """
+    global _environment_loaded
+    if _environment_loaded:
+        return
+    with _lock:
+        if not _environment_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _environment_loaded = True
+
+def configure():
+    """
+    Bootstrap an entry point: load .env and configure logging, once.
+
+    Library modules only create their loggers; the script being run calls
+    this so logging is set up in one place. LOG_LEVEL sets the level.
+    """
+    global _logging_configured
+    load_environment()
+    with _lock:
+        if _logging_configured:
+            return
+        logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format=LOG_FORMAT)
+        _logging_configured = True
+
+def uptime():
+    """Seconds since the first project module was imported."""
+    return time.perf_counter() - PROCESS_STARTED
+
+def import_times(module="app", python=sys.executable):
+    """
+    Import a module in a fresh interpreter and measure every import it triggers.
+
+    Args:
+        module (str): Module to import
+        python (str): Interpreter to run
+
+    Returns:
+        dict: "total_ms" for the module and "modules", a list of
+              (name, self ms, cumulative ms, depth) in import order
+    """
+    import subprocess
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$", line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us) / 1000, int(cumulative_us) / 1000, (len(indent) - 1) // 2))
+    total = next((cumulative for name, _, cumulative, depth in reversed(modules) if name == module and depth == 0), 0.0)
+    return {"total_ms": round(total, 1), "modules": modules}
+
+def format_import_report(times, top=20, budget_ms=STARTUP_IMPORT_BUDGET_MS):
+    """Render import_times() as the slowest top-level packages and the total against the budget."""
+    packages = {}
+    for name, _, cumulative, _ in times["modules"]:
+        root = name.split(".")[0]
+        # A package's first import includes its submodules, so keep its largest cumulative time
+        packages[root] = max(packages.get(root, 0.0), cumulative)
+    lines = [f"{'package':<32}{'ms':>10}"]
+    for root, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"{root:<32}{cumulative:>10.1f}")
+    verdict = "within" if times["total_ms"] <= budget_ms else "OVER"
+    lines.append(f"total {times['total_ms']:.0f} ms, {verdict} the {budget_ms:.0f} ms budget")
+    return "\n".join(lines)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Report how long importing a module takes in a fresh interpreter.")
+    parser.add_argument("module", nargs="?", default="app", help="Module to import")
+    parser.add_argument("-n", "--top", type=int, default=20, help="Packages to list")
+    parser.add_argument("--budget", type=float, default=STARTUP_IMPORT_BUDGET_MS, help="Fail if the import takes longer (ms)")
+    args = parser.parse_args(argv)
+
+    times = import_times(args.module)
+    print(format_import_report(times, top=args.top, budget_ms=args.budget))
+    return 1 if times["total_ms"] > args.budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
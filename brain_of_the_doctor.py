@@ -1,37 +1,77 @@
 # brain_of_the_doctor.py
 
-from dotenv import load_dotenv
-load_dotenv()
+from bootstrap import load_environment
+load_environment()
 
 import os
 import base64
 import time
-from groq import Groq
+import asyncio
+from clients import get_groq_client, get_async_groq_client
+from image_preprocessing import preprocess_image
+from model_health import get_model_health, retry_after_header, RETRY, RATE_LIMITED, RAISE, MAX_RETRY_WAIT_SECONDS, CIRCUIT_OPEN_SECONDS
+from rate_limiter import get_scheduler
+from metrics import VISION_TTFT, VISION_TOKENS_PER_SECOND, MODEL_CALLS, FALLBACKS, HEDGES
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("BrainOfDoctor")
 
 # API Key
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 
+# Maximum number of vision calls in flight at once in the async pipeline
+VISION_CONCURRENCY = int(os.environ.get("VISION_CONCURRENCY", "8"))
+_vision_slots = asyncio.Semaphore(VISION_CONCURRENCY)
+
+# Hedged requests (async pipeline): if the first model has not produced its
+# first token within the VISION_HEDGE_PERCENTILE of its recent latency (or
+# VISION_HEDGE_DELAY until enough samples exist), the same request is sent to
+# the next model and whichever answers first is used
+VISION_HEDGING = os.environ.get("VISION_HEDGING", "0") == "1"
+VISION_HEDGE_PERCENTILE = float(os.environ.get("VISION_HEDGE_PERCENTILE", "95"))
+VISION_HEDGE_DELAY = float(os.environ.get("VISION_HEDGE_DELAY", "2.0"))
+
+# Longest response requested from the vision model
+MAX_COMPLETION_TOKENS = 1024
+
+# Rough prompt size of one image, for charging requests against a tokens-per-minute budget
+IMAGE_TOKEN_ESTIMATE = int(os.environ.get("IMAGE_TOKEN_ESTIMATE", "1500"))
+
+# Fallback chain; get_model_health() reorders it per request
+MODELS_TO_TRY = [
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+    "meta-llama/llama-4-maverick-17b-128e-instruct"
+]
+
 def encode_image(image_path):
     """
     Convert image to base64 encoding for API submission.
     Handles different image formats and includes error handling.
+    The image is downscaled and re-encoded first; see prepare_image.
+    """
+    return prepare_image(image_path)[0]
+
+def prepare_image(image_path):
+    """
+    Preprocess an image and base64-encode it for API submission.
+    
+    Args:
+        image_path (str): Path to the image file
+    
+    Returns:
+        tuple: (base64 encoded image, media type of the encoded bytes)
     """
     try:
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"Image file not found: {image_path}")
             
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        prepared = preprocess_image(image_path)
+        return base64.b64encode(prepared.data).decode('utf-8'), prepared.media_type
     except Exception as e:
         logger.error(f"Error encoding image: {str(e)}")
         raise
 
-def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", max_retries=3):
+def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", max_retries=3, stream=False, media_type="image/jpeg"):
     """
     Analyze medical image with enhanced error handling and retry mechanism.
     
@@ -40,13 +80,56 @@ def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-sco
         encoded_image (str): Base64 encoded image string
         model (str): Model to use for analysis (updated to current supported models)
         max_retries (int): Maximum number of retry attempts
+        stream (bool): Yield response chunks as they are generated instead of
+            returning the complete text
+        media_type (str): MIME type of the encoded image
+    
+    Returns:
+        str: The analysis response, or a generator of text chunks when stream=True
+    """
+    client = get_groq_client(GROQ_API_KEY)
+    
+    messages = _build_messages(query, encoded_image, media_type)
+    
+    chunks = _generate_analysis(client, messages, max_retries, stream)
+    if stream:
+        return chunks
+    return "".join(chunks)
+
+async def analyze_image_with_query_async(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", max_retries=3, stream=False, media_type="image/jpeg", hedge=None, session=None):
+    """
+    Async version of analyze_image_with_query for the async consultation pipeline.
+    
+    Uses the pooled AsyncGroq client, waits between retries without blocking the
+    event loop, waits for each model's rate budget (see rate_limiter) and holds
+    one of VISION_CONCURRENCY slots while an attempt is in flight.
+    
+    Args:
+        query (str): The prompt or question to send with the image
+        encoded_image (str): Base64 encoded image string
+        model (str): Model to use for analysis (updated to current supported models)
+        max_retries (int): Maximum number of retry attempts
+        stream (bool): Return an async generator of text chunks instead of the complete text
+        media_type (str): MIME type of the encoded image
+        hedge (bool): Hedge slow calls to the next model; defaults to VISION_HEDGING
+        session (Session): Caller, for fair queueing and queue position updates
     
     Returns:
-        str: The analysis response
+        str: The analysis response, or an async generator of text chunks when stream=True
     """
-    client = Groq(api_key=GROQ_API_KEY)
+    client = get_async_groq_client(GROQ_API_KEY)
+    messages = _build_messages(query, encoded_image, media_type)
     
-    messages = [
+    if VISION_HEDGING if hedge is None else hedge:
+        chunks = _ahedged_analysis(client, messages, max_retries, stream, session)
+    else:
+        chunks = _agenerate_analysis(client, messages, max_retries, stream, session=session)
+    if stream:
+        return chunks
+    return "".join([chunk async for chunk in chunks])
+
+def _build_messages(query, encoded_image, media_type):
+    return [
         {
             "role": "user",
             "content": [
@@ -57,56 +140,313 @@ def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-sco
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{encoded_image}",
+                        "url": f"data:{media_type};base64,{encoded_image}",
                     },
                 },
             ],
         }
     ]
+
+def _next_retry_delay(model_name, attempt, max_retries, error):
+    """
+    Record a failed attempt and decide what to do next.
     
-    # Retry logic with fallback models
-    models_to_try = [
-        "meta-llama/llama-4-scout-17b-16e-instruct",
-        "meta-llama/llama-4-maverick-17b-128e-instruct"
-    ]
+    Only transient errors are retried on the same model, and only while the
+    wait is short; rate limits, unavailable models and other provider errors
+    fail over to the next model straight away. Errors that did not come from
+    the provider are raised again.
+    
+    Returns:
+        float: Seconds to wait before retrying model_name, or None to move to the next model
+    """
+    health = get_model_health()
+    verdict = health.record_failure(model_name, error)
+    MODEL_CALLS.inc(stage="vision", model=model_name, outcome=verdict)
+    if verdict == RAISE:
+        raise error
+    logger.warning(f"Attempt {attempt+1} failed with {model_name} ({verdict}): {str(error)}")
+    
+    retry_after = retry_after_header(error)
+    if verdict == RATE_LIMITED and retry_after is not None:
+        # The provider asked everyone to back off; hold other requests back too,
+        # but never for longer than the circuit stays open
+        get_scheduler().pause(f"groq:{model_name}", min(retry_after, CIRCUIT_OPEN_SECONDS))
+    if verdict != RETRY:
+        logger.info(f"Trying next model after {verdict} error from {model_name}...")
+        FALLBACKS.inc(stage="vision", from_choice=model_name)
+        return None
+    if attempt >= max_retries - 1:
+        logger.error(f"All {max_retries} attempts failed for {model_name}")
+        FALLBACKS.inc(stage="vision", from_choice=model_name)
+        return None
+    
+    wait_time = health.backoff_delay(attempt, error)
+    if wait_time > MAX_RETRY_WAIT_SECONDS:
+        logger.info(f"{model_name} asked to wait {wait_time:.1f}s, trying next model instead...")
+        FALLBACKS.inc(stage="vision", from_choice=model_name)
+        return None
+    logger.info(f"Retrying in {wait_time:.2f} seconds...")
+    return wait_time
+
+def _generate_analysis(client, messages, max_retries, stream):
+    """
+    Run the completion against the fallback models, yielding response text.
+    
+    In non-streaming mode the full response is yielded as a single chunk. Once a
+    streamed response has started producing text it is not retried, since the
+    caller has already shown the partial output.
+    """
+    health = get_model_health()
+    models_to_try = health.ordered(MODELS_TO_TRY)
+    # Retries are decided here, not by the SDK's own blocking retry loop
+    client = client.with_options(max_retries=0)
     
     for model_name in models_to_try:
         for attempt in range(max_retries):
+            started = False
             try:
                 logger.info(f"Analyzing image with {model_name} (attempt {attempt+1}/{max_retries})")
                 
                 # Add temperature parameter for more stable medical analysis
+                request_started = time.monotonic()
                 chat_completion = client.chat.completions.create(
                     messages=messages,
                     model=model_name,
                     temperature=0.2,  # Lower temperature for more deterministic medical advice
-                    max_completion_tokens=1024   # Updated parameter name
+                    max_completion_tokens=MAX_COMPLETION_TOKENS,   # Updated parameter name
+                    stream=stream
                 )
                 
-                response = chat_completion.choices[0].message.content
+                if stream:
+                    tokens = 0
+                    try:
+                        for chunk in chat_completion:
+                            tokens = _completion_tokens(chunk, tokens)
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                if not started:
+                                    first_token_at = time.monotonic()
+                                    _record_first_token(model_name, first_token_at - request_started)
+                                started = True
+                                yield delta
+                    finally:
+                        chat_completion.close()
+                    if started:
+                        _record_stream_speed(model_name, tokens, time.monotonic() - first_token_at)
+                else:
+                    _record_first_token(model_name, time.monotonic() - request_started)
+                    yield chat_completion.choices[0].message.content
+                health.record_success(model_name)
+                MODEL_CALLS.inc(stage="vision", model=model_name, outcome="ok")
                 logger.info(f"Analysis completed successfully with {model_name}")
-                return response
+                return
                 
             except Exception as e:
-                error_msg = str(e)
-                logger.warning(f"Attempt {attempt+1} failed with {model_name}: {error_msg}")
+                if started:
+                    health.record_failure(model_name, e)
+                    MODEL_CALLS.inc(stage="vision", model=model_name, outcome="stream_error")
+                    logger.error(f"Stream from {model_name} failed mid-response: {str(e)}")
+                    raise
                 
-                # If model is deprecated/decommissioned, try next model immediately
-                if "decommissioned" in error_msg.lower() or "not supported" in error_msg.lower():
-                    logger.info(f"Model {model_name} is deprecated, trying next model...")
+                wait_time = _next_retry_delay(model_name, attempt, max_retries, e)
+                if wait_time is None:
                     break
-                
-                if attempt < max_retries - 1:
-                    # Exponential backoff
-                    wait_time = 2 ** attempt
-                    logger.info(f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"All {max_retries} attempts failed for {model_name}")
+                time.sleep(wait_time)
     
     # If all models fail, raise final exception
     raise Exception(f"Failed to analyze image after trying all available models: {models_to_try}")
 
+async def _agenerate_analysis(client, messages, max_retries, stream, models=None, session=None):
+    """Async counterpart of _generate_analysis with non-blocking backoff and rate budgets."""
+    health = get_model_health()
+    scheduler = get_scheduler()
+    models_to_try = models if models is not None else health.ordered(MODELS_TO_TRY)
+    client = client.with_options(max_retries=0)
+    tokens = _estimate_tokens(messages)
+    
+    for index, model_name in enumerate(models_to_try):
+        resource = f"groq:{model_name}"
+        if index < len(models_to_try) - 1 and scheduler.estimated_wait(resource, tokens) > MAX_RETRY_WAIT_SECONDS:
+            logger.info(f"{model_name} is over its rate budget, trying next model instead...")
+            FALLBACKS.inc(stage="vision", from_choice=model_name)
+            continue
+        for attempt in range(max_retries):
+            started = False
+            # Waits its fair turn within the model's budget; raises SchedulerOverloaded when shedding
+            await scheduler.acquire(resource, tokens, session)
+            try:
+                async with _vision_slots:
+                    logger.info(f"Analyzing image with {model_name} (attempt {attempt+1}/{max_retries})")
+                    
+                    request_started = time.monotonic()
+                    chat_completion = await client.chat.completions.create(
+                        messages=messages,
+                        model=model_name,
+                        temperature=0.2,
+                        max_completion_tokens=MAX_COMPLETION_TOKENS,
+                        stream=stream
+                    )
+                    
+                    if stream:
+                        tokens_streamed = 0
+                        try:
+                            async for chunk in chat_completion:
+                                tokens_streamed = _completion_tokens(chunk, tokens_streamed)
+                                if not chunk.choices:
+                                    continue
+                                delta = chunk.choices[0].delta.content
+                                if delta:
+                                    if not started:
+                                        first_token_at = time.monotonic()
+                                        _record_first_token(model_name, first_token_at - request_started)
+                                    started = True
+                                    yield delta
+                        finally:
+                            await chat_completion.close()
+                        if started:
+                            _record_stream_speed(model_name, tokens_streamed, time.monotonic() - first_token_at)
+                    else:
+                        _record_first_token(model_name, time.monotonic() - request_started)
+                        yield chat_completion.choices[0].message.content
+                health.record_success(model_name)
+                MODEL_CALLS.inc(stage="vision", model=model_name, outcome="ok")
+                logger.info(f"Analysis completed successfully with {model_name}")
+                return
+                
+            except Exception as e:
+                if started:
+                    health.record_failure(model_name, e)
+                    MODEL_CALLS.inc(stage="vision", model=model_name, outcome="stream_error")
+                    logger.error(f"Stream from {model_name} failed mid-response: {str(e)}")
+                    raise
+                
+                wait_time = _next_retry_delay(model_name, attempt, max_retries, e)
+                if wait_time is None:
+                    break
+                await asyncio.sleep(wait_time)
+    
+    raise Exception(f"Failed to analyze image after trying all available models: {models_to_try}")
+
+async def _ahedged_analysis(client, messages, max_retries, stream, session=None):
+    """
+    Run the analysis on the first model, hedging to the rest of the chain if it is slow.
+    
+    The hedge fires when the primary has not produced its first chunk within
+    the hedge delay, or straight away if the primary fails first. The first
+    chain to produce a chunk wins; every other stream is closed, whether it
+    was still waiting or had finished in the same round as the winner.
+    """
+    health = get_model_health()
+    models_to_try = health.ordered(MODELS_TO_TRY)
+    if len(models_to_try) < 2:
+        async for chunk in _agenerate_analysis(client, messages, max_retries, stream, models=models_to_try, session=session):
+            yield chunk
+        return
+    
+    primary, fallback = models_to_try[:1], models_to_try[1:]
+    hedge_delay = health.latency_percentile(primary[0], VISION_HEDGE_PERCENTILE) or VISION_HEDGE_DELAY
+    generators = {}
+    
+    def launch(chain):
+        generator = _agenerate_analysis(client, messages, max_retries, stream, models=chain, session=session)
+        task = asyncio.ensure_future(generator.__anext__())
+        generators[task] = (generator, chain)
+        return task
+    
+    started = time.monotonic()
+    pending = {launch(primary)}
+    hedged = False
+    winner = None
+    first_chunk = None
+    error = None
+    try:
+        while pending and winner is None:
+            timeout = None if hedged else max(0.0, hedge_delay - (time.monotonic() - started))
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"No response from {primary[0]} after {hedge_delay:.2f}s, hedging to {fallback[0]}")
+                hedged = True
+                pending.add(launch(fallback))
+                continue
+            for task in done:
+                try:
+                    first_chunk = task.result()
+                    winner = task
+                    break
+                except StopAsyncIteration:
+                    winner = task
+                    break
+                except Exception as e:
+                    error = e
+            if winner is None and not hedged:
+                logger.info(f"{primary[0]} failed, sending the request to {fallback[0]}")
+                hedged = True
+                pending.add(launch(fallback))
+    finally:
+        # Cancel the loser (or everything, if we are being cancelled), then close
+        # every stream but the winner's so their connections and slots are released
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in list(generators):
+            if task is not winner:
+                await generators.pop(task)[0].aclose()
+    
+    if winner is None:
+        if hedged:
+            HEDGES.inc(stage="vision", winner="none")
+        raise error or Exception(f"Failed to analyze image after trying all available models: {models_to_try}")
+    generator, chain = generators[winner]
+    if hedged:
+        logger.info(f"Hedged request won by {chain[0]}")
+        HEDGES.inc(stage="vision", winner=chain[0])
+    try:
+        if first_chunk is None:
+            return
+        yield first_chunk
+        async for chunk in generator:
+            yield chunk
+    finally:
+        await generator.aclose()
+
+def _estimate_tokens(messages):
+    """Upper estimate of the tokens a vision request uses: prompt text, images and the longest response."""
+    tokens = MAX_COMPLETION_TOKENS
+    for message in messages:
+        for part in message["content"]:
+            if part["type"] == "text":
+                # About four characters per token for English text
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def _record_first_token(model_name, seconds):
+    """Record time to first token (or to the whole response when not streaming)."""
+    get_model_health().record_latency(model_name, seconds)
+    VISION_TTFT.observe(seconds, model=model_name)
+
+def _completion_tokens(chunk, counted):
+    """
+    Running count of completion tokens in a stream.
+    
+    Groq reports the exact count in the last chunk's x_groq.usage; until then
+    each chunk with content is counted as one token.
+    """
+    usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+    if usage is not None and getattr(usage, "completion_tokens", None):
+        return usage.completion_tokens
+    if chunk.choices and chunk.choices[0].delta.content:
+        return counted + 1
+    return counted
+
+def _record_stream_speed(model_name, tokens, seconds):
+    """Record tokens per second after the first token of a finished stream."""
+    if tokens > 1 and seconds > 0:
+        VISION_TOKENS_PER_SECOND.observe((tokens - 1) / seconds, model=model_name)
+
 # Example usage (commented out for import)
 """
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+# clients.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import logging
+import threading
+import httpx
+
+logger = logging.getLogger("ClientRegistry")
+
+# Connection pool sizing, shared by every provider client
+POOL_MAX_CONNECTIONS = int(os.environ.get("CLIENT_POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("CLIENT_POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("CLIENT_POOL_KEEPALIVE_EXPIRY", "60"))
+
+# ElevenLabs' own default request timeout
+ELEVENLABS_TIMEOUT = 240
+
+# Alternative ElevenLabs endpoint, e.g. a local stub server (the Groq SDK reads GROQ_BASE_URL itself)
+ELEVENLABS_BASE_URL = os.environ.get("ELEVENLABS_BASE_URL") or None
+
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_clients = {}
+_http_clients = {}
+_request_counts = {}
+
+def _pool_limits():
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+    )
+
+def _count_requests(provider):
+    """Build an httpx request hook that counts requests sent by a provider."""
+    def hook(request):
+        with _stats_lock:
+            _request_counts[provider] = _request_counts.get(provider, 0) + 1
+    return hook
+
+def _count_requests_async(provider):
+    """Async variant of _count_requests for httpx.AsyncClient hooks."""
+    count = _count_requests(provider)
+    async def hook(request):
+        count(request)
+    return hook
+
+def _get_or_create(provider, api_key, factory):
+    key = (provider, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            logger.info(f"Creating pooled {provider} client")
+            client, http_client = factory()
+            _clients[key] = client
+            _http_clients[key] = http_client
+        return client
+
+def get_groq_client(api_key=None):
+    """
+    Return the shared Groq client for an API key, creating it on first use.
+
+    Args:
+        api_key (str): Groq API key; defaults to the GROQ_API_KEY environment variable
+
+    Returns:
+        Groq: Client backed by a keep-alive connection pool
+    """
+    api_key = api_key or os.environ.get("GROQ_API_KEY")
+
+    def factory():
+        # Provider SDKs are imported when their first client is built, not at startup
+        from groq import Groq, DefaultHttpxClient
+        http_client = DefaultHttpxClient(
+            limits=_pool_limits(),
+            event_hooks={"request": [_count_requests("groq")]}
+        )
+        return Groq(api_key=api_key, http_client=http_client), http_client
+
+    return _get_or_create("groq", api_key, factory)
+
+def get_elevenlabs_client(api_key=None):
+    """
+    Return the shared ElevenLabs client for an API key, creating it on first use.
+
+    Args:
+        api_key (str): ElevenLabs API key; defaults to the ELEVENLABS_API_KEY environment variable
+
+    Returns:
+        ElevenLabs: Client backed by a keep-alive connection pool
+    """
+    api_key = api_key or os.environ.get("ELEVENLABS_API_KEY")
+
+    def factory():
+        http_client = httpx.Client(
+            limits=_pool_limits(),
+            timeout=ELEVENLABS_TIMEOUT,
+            follow_redirects=True,
+            event_hooks={"request": [_count_requests("elevenlabs")]}
+        )
+        from elevenlabs.client import ElevenLabs
+        return ElevenLabs(api_key=api_key, base_url=ELEVENLABS_BASE_URL, httpx_client=http_client), http_client
+
+    return _get_or_create("elevenlabs", api_key, factory)
+
+def get_async_groq_client(api_key=None):
+    """
+    Return the shared AsyncGroq client for an API key, creating it on first use.
+
+    Args:
+        api_key (str): Groq API key; defaults to the GROQ_API_KEY environment variable
+
+    Returns:
+        AsyncGroq: Client backed by a keep-alive connection pool
+    """
+    api_key = api_key or os.environ.get("GROQ_API_KEY")
+
+    def factory():
+        from groq import AsyncGroq, DefaultAsyncHttpxClient
+        http_client = DefaultAsyncHttpxClient(
+            limits=_pool_limits(),
+            event_hooks={"request": [_count_requests_async("groq-async")]}
+        )
+        return AsyncGroq(api_key=api_key, http_client=http_client), http_client
+
+    return _get_or_create("groq-async", api_key, factory)
+
+def get_async_elevenlabs_client(api_key=None):
+    """
+    Return the shared AsyncElevenLabs client for an API key, creating it on first use.
+
+    Args:
+        api_key (str): ElevenLabs API key; defaults to the ELEVENLABS_API_KEY environment variable
+
+    Returns:
+        AsyncElevenLabs: Client backed by a keep-alive connection pool
+    """
+    api_key = api_key or os.environ.get("ELEVENLABS_API_KEY")
+
+    def factory():
+        http_client = httpx.AsyncClient(
+            limits=_pool_limits(),
+            timeout=ELEVENLABS_TIMEOUT,
+            follow_redirects=True,
+            event_hooks={"request": [_count_requests_async("elevenlabs-async")]}
+        )
+        from elevenlabs.client import AsyncElevenLabs
+        return AsyncElevenLabs(api_key=api_key, base_url=ELEVENLABS_BASE_URL, httpx_client=http_client), http_client
+
+    return _get_or_create("elevenlabs-async", api_key, factory)
+
+def pool_stats():
+    """
+    Report connection pool usage for every client created so far.
+
+    Returns:
+        dict: Per-provider counts of open, idle and in-use connections and requests sent
+    """
+    stats = {}
+    for (provider, _), http_client in list(_http_clients.items()):
+        pool = getattr(http_client._transport, "_pool", None)
+        connections = list(pool.connections) if pool is not None else []
+        idle = sum(1 for connection in connections if connection.is_idle())
+        entry = stats.setdefault(provider, {
+            "clients": 0,
+            "connections": 0,
+            "idle": 0,
+            "active": 0,
+            "max_connections": POOL_MAX_CONNECTIONS,
+            "max_keepalive": POOL_MAX_KEEPALIVE,
+            "requests": _request_counts.get(provider, 0)
+        })
+        entry["clients"] += 1
+        entry["connections"] += len(connections)
+        entry["idle"] += idle
+        entry["active"] += len(connections) - idle
+    return stats
+
+def close_clients():
+    """
+    Close every pooled synchronous connection and forget the shared clients.
+
+    Async clients are dropped without closing; use aclose_clients() from a
+    running event loop to close them as well.
+    """
+    with _lock:
+        for http_client in _http_clients.values():
+            if isinstance(http_client, httpx.Client):
+                http_client.close()
+        _clients.clear()
+        _http_clients.clear()
+
+async def aclose_clients():
+    """Close every pooled connection, sync and async, and forget the shared clients."""
+    with _lock:
+        http_clients = list(_http_clients.values())
+        _clients.clear()
+        _http_clients.clear()
+    for http_client in http_clients:
+        if isinstance(http_client, httpx.AsyncClient):
+            await http_client.aclose()
+        else:
+            http_client.close()
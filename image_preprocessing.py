@@ -0,0 +1,90 @@
+# image_preprocessing.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import io
+import logging
+import mimetypes
+from collections import namedtuple
+from PIL import Image, ImageOps
+
+logger = logging.getLogger("ImagePreprocessing")
+
+# Longest edge sent to the vision model; larger images only add upload time
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "1120"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+
+# Formats the vision API accepts as-is when no resize or rotation is needed
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# data is bytes-like: bytes for passed-through files, a memoryview of the JPEG encoder's output otherwise
+PreparedImage = namedtuple("PreparedImage", ["data", "media_type", "width", "height", "original_size"])
+
+def preprocess_image(image_path, max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY):
+    """
+    Decode, orient, downscale and re-encode an image for the vision model.
+
+    The EXIF orientation is applied, the longest edge is limited to
+    max_dimension and the result is encoded as JPEG. A small, upright image
+    already in an accepted format is passed through unchanged when that is
+    smaller. Images Pillow cannot decode are passed through with their media
+    type guessed from the file name.
+
+    The file is decoded straight from disk, and a large JPEG is decoded at a
+    reduced scale (the smallest one still at least max_dimension on each
+    side), so neither the raw file nor the full-resolution pixels are held.
+
+    Args:
+        image_path (str): Path to the image file
+        max_dimension (int): Maximum width or height in pixels
+        quality (int): JPEG quality (1-95)
+
+    Returns:
+        PreparedImage: Encoded bytes, media type, final dimensions and original size in bytes
+    """
+    original_size = os.path.getsize(image_path)
+    try:
+        with Image.open(image_path) as image:
+            source_format = image.format
+            needs_resize = max(image.size) > max_dimension
+            if needs_resize and source_format == "JPEG":
+                image.draft("RGB", (max_dimension, max_dimension))
+            image.load()
+    except Exception as e:
+        media_type = mimetypes.guess_type(image_path)[0] or "image/jpeg"
+        logger.warning(f"Could not decode {image_path} ({str(e)}), sending it unchanged as {media_type}")
+        return PreparedImage(_read_file(image_path), media_type, None, None, original_size)
+
+    # EXIF orientation tag; 1 means the pixels are already upright
+    upright = image.getexif().get(0x0112, 1) == 1
+    oriented = image if upright else ImageOps.exif_transpose(image)
+    if not needs_resize and upright and source_format in PASSTHROUGH_FORMATS:
+        passthrough = PreparedImage(_read_file(image_path), PASSTHROUGH_FORMATS[source_format], image.width, image.height, original_size)
+    else:
+        passthrough = None
+
+    if needs_resize:
+        oriented.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    if oriented.mode != "RGB":
+        # JPEG has no alpha channel; flatten transparency onto white
+        background = Image.new("RGB", oriented.size, (255, 255, 255))
+        rgba = oriented.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        oriented = background
+
+    buffer = io.BytesIO()
+    oriented.save(buffer, format="JPEG", quality=quality, optimize=True)
+    # A view of the encoder's buffer rather than a copy of it
+    data = buffer.getbuffer()
+
+    if passthrough is not None and len(passthrough.data) <= len(data):
+        return passthrough
+
+    logger.info(f"Preprocessed {image_path}: {original_size} -> {len(data)} bytes at {oriented.width}x{oriented.height}")
+    return PreparedImage(data, "image/jpeg", oriented.width, oriented.height, original_size)
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
@@ -0,0 +1,311 @@
+# job_queue.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger("JobQueue")
+
+# Job-submission mode: the web app enqueues consultations here and
+# job_worker.py processes run them; with JOB_QUEUE=0 they run in the app
+JOB_QUEUE_ENABLED = os.environ.get("JOB_QUEUE", "0") == "1"
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", "jobs.db")
+
+# A running job whose worker has not checked in for JOB_LEASE_SECONDS is
+# handed to another worker, up to JOB_MAX_ATTEMPTS runs in all
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "30"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# Queued jobs accepted before new submissions are refused, and how long
+# finished jobs are kept for patients to come back to
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", "256"))
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", str(24 * 3600)))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+# Written by the worker while a consultation runs and read by the web app
+RESULT_FIELDS = ("progress", "message", "speech_to_text", "doctor_response", "segments")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    session_id TEXT,
+    audio_filepath TEXT,
+    image_filepath TEXT,
+    transcript TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    speech_to_text TEXT NOT NULL DEFAULT '',
+    doctor_response TEXT NOT NULL DEFAULT '',
+    segments TEXT NOT NULL DEFAULT '[]',
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+"""
+
+class JobQueueFull(Exception):
+    """Raised instead of accepting a job when JOB_MAX_PENDING are already waiting."""
+
+class JobQueue:
+    """
+    Durable queue of consultations in a SQLite database.
+
+    Any number of web app and worker processes on one host can share the
+    database. A worker claims a job with a lease and renews it with
+    heartbeat() while the consultation runs, writing its progress and partial
+    results as it goes; the web app reads them with get(). If a worker dies,
+    its lease runs out and the next claim() hands the job to another worker.
+    """
+
+    def __init__(self, path=JOB_DB_PATH, lease=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS, max_pending=JOB_MAX_PENDING):
+        """
+        Args:
+            path (str): SQLite database file, created if missing
+            lease (float): Seconds a claimed job stays with its worker without a heartbeat
+            max_attempts (int): Runs of a job before it is marked failed
+            max_pending (int): Queued jobs before submit() refuses new ones
+        """
+        self.path = os.path.abspath(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self):
+        # One connection per thread; sqlite3 connections must not be shared
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            # WAL lets the web app read while a worker writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def submit(self, audio_filepath, image_filepath, transcript=None, session_id=None):
+        """
+        Enqueue a consultation.
+
+        Args:
+            audio_filepath (str): Recording of the patient's description, or None
+            image_filepath (str): Medical image, or None
+            transcript (str): Patient's description as text; skips transcription
+            session_id (str): Caller's session, for fair queueing at the providers
+
+        Returns:
+            str: Job ID
+
+        Raises:
+            JobQueueFull: max_pending jobs are already queued
+        """
+        job_id = uuid.uuid4().hex[:12]
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            pending = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if pending >= self.max_pending:
+                raise JobQueueFull("The service is very busy right now. Please try again in a minute.")
+            connection.execute(
+                "INSERT INTO jobs (id, status, session_id, audio_filepath, image_filepath, transcript, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, session_id, audio_filepath, image_filepath, transcript, time.time())
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        logger.info(f"Queued job {job_id} ({pending + 1} waiting)")
+        return job_id
+
+    def claim(self, worker_id):
+        """
+        Take the oldest queued job, first returning jobs whose worker's lease ran out.
+
+        Args:
+            worker_id (str): Claiming worker
+
+        Returns:
+            dict: The claimed job (see get()), or None if nothing is queued
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._expire_leases(connection, now)
+            row = connection.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            # A rerun starts from scratch, so results from an earlier attempt are cleared
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, started_at = ?, attempts = attempts + 1, "
+                "progress = 0, message = NULL, speech_to_text = '', doctor_response = '', segments = '[]' WHERE id = ?",
+                (RUNNING, worker_id, now + self.lease, now, row["id"])
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return self.get(row["id"])
+
+    def heartbeat(self, job_id, worker_id, **results):
+        """
+        Renew a claimed job's lease and record its progress.
+
+        Args:
+            job_id (str): Job being run
+            worker_id (str): Worker running it
+            **results: Any of RESULT_FIELDS
+
+        Returns:
+            bool: False if the job is no longer this worker's (its lease ran out and it was reassigned)
+        """
+        assignments, values = self._result_columns(results)
+        cursor = self._connection().execute(
+            f"UPDATE jobs SET lease_until = ?{assignments} WHERE id = ? AND worker = ? AND status = ?",
+            (time.time() + self.lease, *values, job_id, worker_id, RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, worker_id, error=None, **results):
+        """
+        Record a job's final results.
+
+        Args:
+            job_id (str): Job that was run
+            worker_id (str): Worker that ran it
+            error (str): Failure message; None marks the job done
+            **results: Any of RESULT_FIELDS
+
+        Returns:
+            bool: False if the job had already been reassigned
+        """
+        assignments, values = self._result_columns(results)
+        cursor = self._connection().execute(
+            f"UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_until = NULL{assignments} WHERE id = ? AND worker = ? AND status = ?",
+            (FAILED if error else DONE, error, time.time(), *values, job_id, worker_id, RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, job_id, worker_id):
+        """Put a claimed job back in the queue without counting the attempt, e.g. on shutdown."""
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1 WHERE id = ? AND worker = ? AND status = ?",
+            (QUEUED, job_id, worker_id, RUNNING)
+        )
+
+    def get(self, job_id):
+        """
+        Look up a job.
+
+        Returns:
+            dict: Job columns, with segments as a list of audio file paths; None if unknown
+        """
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["segments"] = json.loads(job["segments"])
+        return job
+
+    def position(self, job_id):
+        """Return a queued job's place in line (1 is next), or 0 if it is not queued."""
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= (SELECT created_at FROM jobs WHERE id = ? AND status = ?)",
+            (QUEUED, job_id, QUEUED)
+        ).fetchone()
+        return row[0]
+
+    def counts(self):
+        """Return the number of jobs in each status."""
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for row in self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[row[0]] = row[1]
+        return counts
+
+    def referenced_paths(self):
+        """
+        Return the uploads and speech segments of every job still in the database.
+
+        The web app keeps these from being swept from the artifact store until
+        prune() deletes the job.
+        """
+        paths = []
+        for row in self._connection().execute("SELECT audio_filepath, image_filepath, segments FROM jobs"):
+            paths.extend(path for path in (row["audio_filepath"], row["image_filepath"]) if path)
+            paths.extend(json.loads(row["segments"]))
+        return paths
+
+    def prune(self, retention=JOB_RETENTION_SECONDS):
+        """
+        Delete finished jobs older than retention seconds.
+
+        Returns:
+            int: Number of jobs deleted
+        """
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+            (*FINISHED, time.time() - retention)
+        )
+        if cursor.rowcount:
+            logger.info(f"Pruned {cursor.rowcount} finished jobs")
+        return cursor.rowcount
+
+    def _expire_leases(self, connection, now):
+        expired = connection.execute(
+            "SELECT id, worker, attempts FROM jobs WHERE status = ? AND lease_until < ?", (RUNNING, now)
+        ).fetchall()
+        for row in expired:
+            if row["attempts"] >= self.max_attempts:
+                logger.error(f"Job {row['id']} lost its worker {row['worker']} on attempt {row['attempts']}; giving up")
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                    (FAILED, f"The consultation was interrupted {row['attempts']} times. Please try again.", now, row["id"])
+                )
+            else:
+                logger.warning(f"Job {row['id']} lost its worker {row['worker']}; requeueing")
+                connection.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL WHERE id = ?", (QUEUED, row["id"])
+                )
+
+    def _result_columns(self, results):
+        assignments = ""
+        values = []
+        for name, value in results.items():
+            if name not in RESULT_FIELDS:
+                raise ValueError(f"Unknown job result field: {name}")
+            assignments += f", {name} = ?"
+            values.append(json.dumps(value) if name == "segments" else value)
+        return assignments, values
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Return the process-wide JobQueue on JOB_DB_PATH."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue()
+    return _job_queue
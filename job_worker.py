@@ -0,0 +1,278 @@
+# job_worker.py
+
+from bootstrap import load_environment, configure
+load_environment()
+
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from job_queue import JobQueue, JOB_DB_PATH
+
+logger = logging.getLogger("JobWorker")
+
+# Worker processes started by main(), and consultations each runs at once
+JOB_WORKER_PROCESSES = int(os.environ.get("JOB_WORKER_PROCESSES", "2"))
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", "8"))
+
+# Seconds an idle worker waits before looking for new jobs again
+JOB_IDLE_POLL_SECONDS = float(os.environ.get("JOB_IDLE_POLL_SECONDS", "0.5"))
+
+# Seconds before a consultation is abandoned, and how long a stopping
+# worker lets running ones finish before handing them back to the queue
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "300"))
+JOB_SHUTDOWN_GRACE = float(os.environ.get("JOB_SHUTDOWN_GRACE", "30"))
+
+# Partial results are written at most this often, and whenever an audio segment is ready
+JOB_FLUSH_INTERVAL = 0.25
+
+# How often a stopped worker process is restarted at most
+RESTART_BACKOFF_SECONDS = 1.0
+
+async def run_job(queue, job, worker_id, timeout=JOB_TIMEOUT):
+    """
+    Run one claimed consultation, writing progress and partial results to the queue.
+
+    Args:
+        queue (JobQueue): Queue the job was claimed from
+        job (dict): Claimed job
+        worker_id (str): This worker
+        timeout (float): Seconds before the consultation is abandoned
+
+    Returns:
+        bool: True if the consultation succeeded
+    """
+    # Imported here so the pipeline modules load in the worker processes only
+    from app import run_consultation
+    from stage_runner import StageRunner
+
+    stages = StageRunner()
+    results = {"progress": 0.0, "message": None, "speech_to_text": "", "doctor_response": "", "segments": []}
+    lease_lost = asyncio.Event()
+
+    def progress(fraction, description=None):
+        results["progress"] = fraction
+        results["message"] = description
+
+    async def flush():
+        if not await asyncio.to_thread(queue.heartbeat, job["id"], worker_id, **results):
+            lease_lost.set()
+
+    async def heartbeat():
+        # Keeps the lease while a stage runs for a long time without yielding
+        while True:
+            await asyncio.sleep(queue.lease / 3)
+            await flush()
+
+    async def consume():
+        flushed_at = time.monotonic()
+        async for speech_to_text, doctor_response, segment_filepath in run_consultation(
+            job["audio_filepath"],
+            job["image_filepath"],
+            progress,
+            transcript=job["transcript"],
+            stages=stages,
+            session_id=job["session_id"]
+        ):
+            results["speech_to_text"] = speech_to_text
+            results["doctor_response"] = doctor_response
+            if segment_filepath:
+                results["segments"].append(segment_filepath)
+            if segment_filepath or time.monotonic() - flushed_at >= JOB_FLUSH_INTERVAL:
+                await flush()
+                flushed_at = time.monotonic()
+            if lease_lost.is_set():
+                raise RuntimeError("Lease lost: the job was handed to another worker")
+
+    heartbeat_task = asyncio.ensure_future(heartbeat())
+    try:
+        await asyncio.wait_for(consume(), timeout)
+    except asyncio.TimeoutError:
+        stages.error = TimeoutError(f"Consultation took longer than {timeout:.0f}s")
+        stages.cancel()
+    except asyncio.CancelledError:
+        stages.cancel()
+        raise
+    except Exception as e:
+        stages.error = e
+    finally:
+        heartbeat_task.cancel()
+        stages.finish()
+
+    if lease_lost.is_set():
+        logger.warning(f"Job {job['id']} was reassigned while running; dropping its results")
+        return False
+    error = str(stages.error) if stages.error is not None else None
+    if error and not results["doctor_response"]:
+        results["doctor_response"] = f"An error occurred: {error}"
+    await asyncio.to_thread(queue.finish, job["id"], worker_id, error=error, **results)
+    logger.info(f"Job {job['id']} {'failed' if error else 'done'} in {stages.report()['total']:.2f}s (attempt {job['attempts']})")
+    return error is None
+
+async def serve(queue, worker_id, concurrency=JOB_WORKER_CONCURRENCY, stop=None, grace=JOB_SHUTDOWN_GRACE):
+    """
+    Claim and run jobs until stop is set.
+
+    Args:
+        queue (JobQueue): Queue to take jobs from
+        worker_id (str): Name recorded on claimed jobs
+        concurrency (int): Consultations run at once
+        stop (asyncio.Event): Set to stop claiming; running jobs get grace seconds to finish
+        grace (float): Seconds running jobs may take to finish after stop is set
+    """
+    from app import prewarm_canned_speech, TTS_PREWARM
+    from warmup import warm_up
+
+    stop = stop or asyncio.Event()
+    await warm_up(prewarm_canned_speech if TTS_PREWARM else None)
+    slots = asyncio.Semaphore(concurrency)
+    running = {}
+    pruned_at = 0.0
+
+    def finished(task):
+        running.pop(task, None)
+        slots.release()
+
+    logger.info(f"Worker {worker_id} taking jobs from {queue.path}, {concurrency} at a time")
+
+    while not stop.is_set():
+        if not await _wait_for_slot(slots, stop):
+            break
+        if stop.is_set():
+            # Stopped while the claim was being set up: take nothing more
+            slots.release()
+            break
+        if time.monotonic() - pruned_at > 3600:
+            pruned_at = time.monotonic()
+            await asyncio.to_thread(queue.prune)
+        job = await asyncio.to_thread(queue.claim, worker_id)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop.wait(), JOB_IDLE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        logger.info(f"Claimed job {job['id']} (attempt {job['attempts']})")
+        task = asyncio.ensure_future(run_job(queue, job, worker_id))
+        running[task] = job["id"]
+        task.add_done_callback(finished)
+
+    if running:
+        logger.info(f"Stopping: waiting up to {grace:.0f}s for {len(running)} running jobs")
+        done, pending = await asyncio.wait(list(running), timeout=grace)
+        job_ids = [running.get(task) for task in pending]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for job_id in job_ids:
+            await asyncio.to_thread(queue.release, job_id, worker_id)
+            logger.info(f"Handed job {job_id} back to the queue")
+
+async def _wait_for_slot(slots, stop):
+    """
+    Wait for a free slot, giving up when stop is set.
+
+    With every slot busy, a stopping worker must not wait for a job to finish
+    before it starts its shutdown grace period.
+
+    Returns:
+        bool: True if a slot was acquired, False if stop was set first
+    """
+    acquire = asyncio.ensure_future(slots.acquire())
+    stopping = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait((acquire, stopping), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopping.cancel()
+        if not acquire.done():
+            acquire.cancel()
+    if acquire.done() and not acquire.cancelled():
+        return True
+    return False
+
+def _worker_process(index, db_path, concurrency):
+    """Entry point of one worker process."""
+    configure()
+    from metrics import start_metrics_server, METRICS_PORT
+
+    # Each worker serves its own metrics, on the ports after the web app's
+    if METRICS_PORT:
+        start_metrics_server(port=METRICS_PORT + 1 + index)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await serve(JobQueue(db_path), worker_id, concurrency, stop)
+
+    asyncio.run(main())
+
+def run_pool(processes=JOB_WORKER_PROCESSES, concurrency=JOB_WORKER_CONCURRENCY, db_path=JOB_DB_PATH):
+    """
+    Run worker processes until SIGTERM or SIGINT, restarting any that die.
+
+    Each process gets an equal share of the provider rate budgets (see
+    rate_limiter.RATE_LIMIT_SHARE). Processes are spawned rather than forked,
+    so none inherits another's clients or event loop.
+
+    Args:
+        processes (int): Worker processes
+        concurrency (int): Consultations each process runs at once
+        db_path (str): Job queue database
+    """
+    os.environ["RATE_LIMIT_SHARE"] = str(float(os.environ.get("RATE_LIMIT_SHARE", "1")) / processes)
+    context = multiprocessing.get_context("spawn")
+    stopping = False
+
+    def start(index):
+        process = context.Process(target=_worker_process, args=(index, db_path, concurrency), name=f"job-worker-{index}")
+        process.start()
+        return process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    workers = [start(index) for index in range(processes)]
+    logger.info(f"Started {processes} worker processes on {os.path.abspath(db_path)}")
+    while not stopping:
+        time.sleep(RESTART_BACKOFF_SECONDS)
+        for index, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                logger.error(f"Worker process {process.pid} exited with code {process.exitcode}; restarting")
+                workers[index] = start(index)
+
+    logger.info("Stopping worker processes")
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+    for process in workers:
+        process.join(JOB_SHUTDOWN_GRACE + 5)
+        if process.is_alive():
+            process.kill()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run queued consultations in worker processes (start the app with JOB_QUEUE=1).")
+    parser.add_argument("-p", "--processes", type=int, default=JOB_WORKER_PROCESSES, help="Worker processes")
+    parser.add_argument("-c", "--concurrency", type=int, default=JOB_WORKER_CONCURRENCY, help="Consultations each process runs at once")
+    parser.add_argument("--db", default=JOB_DB_PATH, help="Job queue database shared with the app")
+    args = parser.parse_args(argv)
+    configure()
+
+    # Create the database before the workers race to
+    JobQueue(args.db)
+    run_pool(args.processes, args.concurrency, args.db)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# load_test.py
+
+from bootstrap import load_environment, configure
+load_environment()
+
+import os
+import sys
+import json
+import glob
+import time
+import wave
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from stub_servers import StubServer, TRANSCRIPT_TEMPLATE
+
+logger = logging.getLogger("LoadTest")
+
+# Percentiles reported for every metric
+PERCENTILES = (50, 95, 99)
+
+# Stage timings reported first, in pipeline order; any other stage follows
+STAGE_ORDER = ["stt", "image_prep", "vision", "tts"]
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), int(round(p / 100 * len(ordered) + 0.5))))
+    return ordered[rank - 1]
+
+def summarize(samples, elapsed):
+    """
+    Aggregate consultation samples into per-metric percentiles and throughput.
+
+    Args:
+        samples (list): Dicts with "ok", "stages", "first_text", "first_audio" and "total", and "memory" when run in-process
+        elapsed (float): Wall-clock seconds the run took
+
+    Returns:
+        dict: Per-metric count and percentiles in seconds, plus run totals and the highest RSS seen
+    """
+    metrics = {}
+    for sample in samples:
+        for name, seconds in sample["stages"].items():
+            metrics.setdefault(f"stage:{name}", []).append(seconds)
+        for name in ("first_text", "first_audio", "total"):
+            if sample[name] is not None:
+                metrics.setdefault(name, []).append(sample[name])
+
+    def order(name):
+        stage = name.split(":", 1)[-1]
+        return (0, STAGE_ORDER.index(stage)) if name.startswith("stage:") and stage in STAGE_ORDER else (1, name)
+
+    completed = sum(1 for sample in samples if sample["ok"])
+    peaks = [sample["memory"]["peak_rss_bytes"] for sample in samples if sample.get("memory")]
+    return {
+        "consultations": len(samples),
+        "errors": len(samples) - completed,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(completed / elapsed, 3) if elapsed > 0 else 0.0,
+        "peak_rss_bytes": max(peaks) if peaks else None,
+        "metrics": {
+            name: dict(count=len(values), **{f"p{p}": round(percentile(values, p), 4) for p in PERCENTILES}, max=round(max(values), 4))
+            for name, values in sorted(metrics.items(), key=lambda item: order(item[0]))
+        }
+    }
+
+def format_report(report):
+    """Render a summary from summarize() as a plain-text table in milliseconds."""
+    lines = [f"{'metric':<24}{'n':>7}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES) + f"{'max':>10}"]
+    for name, values in report["metrics"].items():
+        lines.append(f"{name:<24}{values['count']:>7}" + "".join(f"{values[f'p{p}'] * 1000:>10.0f}" for p in PERCENTILES) + f"{values['max'] * 1000:>10.0f}")
+    lines.append(f"{report['consultations']} consultations, {report['errors']} errors in {report['elapsed']:.1f}s: {report['throughput']:.2f} consultations/s")
+    if report.get("peak_rss_bytes"):
+        lines.append(f"Peak RSS {report['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+    return "\n".join(lines)
+
+def write_synthetic_recording(path, seconds, sample_rate=16000):
+    """
+    Write a WAV that looks like speech to the pipeline: noise bursts separated by pauses.
+
+    Args:
+        path (str): Output file
+        seconds (float): Length of the recording
+        sample_rate (int): Samples per second
+    """
+    rng = random.Random(0)
+    frames = bytearray()
+    total = int(seconds * sample_rate)
+    position = 0
+    while position < total:
+        burst = min(total - position, int(rng.uniform(0.8, 2.0) * sample_rate))
+        for _ in range(burst):
+            frames += rng.randint(-6000, 6000).to_bytes(2, "little", signed=True)
+        pause = min(total - position - burst, int(rng.uniform(0.2, 0.9) * sample_rate))
+        frames += bytes(2 * max(0, pause))
+        position += burst + max(0, pause)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(bytes(frames))
+
+async def run_pipeline_load(patients, consultations, images, audio_filepath=None, think_time=0.0):
+    """
+    Drive run_consultation with simulated patients in this process.
+
+    Each patient runs its consultations one after another, pausing think_time
+    seconds between them; patients run concurrently.
+
+    Args:
+        patients (int): Concurrent simulated patients
+        consultations (int): Consultations per patient
+        images (list): Image paths, used in turn
+        audio_filepath (str): Recording to transcribe; None sends a typed description instead
+        think_time (float): Seconds a patient waits between consultations
+
+    Returns:
+        tuple: (samples, elapsed seconds)
+    """
+    # Imported here so the provider base URLs are set before the clients read them
+    from app import run_consultation
+    from stage_runner import StageRunner
+
+    samples = []
+
+    async def patient(number):
+        for index in range(consultations):
+            image = images[(number * consultations + index) % len(images)] if images else None
+            transcript = None if audio_filepath else TRANSCRIPT_TEMPLATE.format(days=random.randint(2, 9999))
+            stages = StageRunner()
+            started = time.perf_counter()
+            first_text = first_audio = None
+            async for _, response, segment_filepath in run_consultation(
+                audio_filepath,
+                image,
+                progress=_no_progress,
+                transcript=transcript,
+                stages=stages
+            ):
+                now = time.perf_counter() - started
+                if response and first_text is None:
+                    first_text = now
+                if segment_filepath and first_audio is None:
+                    first_audio = now
+            stages.finish()
+            report = stages.report()
+            samples.append({
+                "ok": stages.error is None,
+                "stages": report["stages"],
+                "memory": report["memory"],
+                "first_text": first_text,
+                "first_audio": first_audio,
+                "total": time.perf_counter() - started
+            })
+            if think_time:
+                await asyncio.sleep(random.uniform(0, 2 * think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(patient(number) for number in range(patients)))
+    return samples, time.perf_counter() - started
+
+def run_gradio_load(url, patients, consultations, images, audio_filepath=None, think_time=0.0):
+    """
+    Drive a running app's Gradio endpoint with simulated patients.
+
+    Stage timings are not visible from outside the server, so only time to
+    first text, time to first audio and the total are measured.
+
+    Args:
+        url (str): Base URL of the running app
+        patients (int): Concurrent simulated patients (one thread each)
+        consultations (int): Consultations per patient
+        images (list): Image paths, used in turn
+        audio_filepath (str): Recording to upload, or None
+        think_time (float): Seconds a patient waits between consultations
+
+    Returns:
+        tuple: (samples, elapsed seconds)
+    """
+    from gradio_client import Client, handle_file
+
+    samples = []
+    samples_lock = threading.Lock()
+
+    def patient(number):
+        client = Client(url, verbose=False)
+        for index in range(consultations):
+            image = images[(number * consultations + index) % len(images)] if images else None
+            started = time.perf_counter()
+            first_text = first_audio = None
+            ok = True
+            try:
+                job = client.submit(
+                    handle_file(audio_filepath) if audio_filepath else None,
+                    handle_file(image) if image else None,
+                    api_name="/process_inputs"
+                )
+                # The fourth output is the consultation ID in job-submission mode
+                for _, response, segment, _ in job:
+                    now = time.perf_counter() - started
+                    if response and first_text is None:
+                        first_text = now
+                    if segment and first_audio is None:
+                        first_audio = now
+                    if response and response.startswith("An error occurred"):
+                        ok = False
+            except Exception as e:
+                logger.warning(f"Patient {number} request failed: {str(e)}")
+                ok = False
+            with samples_lock:
+                samples.append({
+                    "ok": ok,
+                    "stages": {},
+                    "first_text": first_text,
+                    "first_audio": first_audio,
+                    "total": time.perf_counter() - started
+                })
+            if think_time:
+                time.sleep(random.uniform(0, 2 * think_time))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=patients, thread_name_prefix="patient") as executor:
+        list(executor.map(patient, range(patients)))
+    return samples, time.perf_counter() - started
+
+def _no_progress(*args, **kwargs):
+    pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the consultation pipeline against local provider stubs.")
+    parser.add_argument("-p", "--patients", type=int, default=16, help="Concurrent simulated patients")
+    parser.add_argument("-n", "--consultations", type=int, default=5, help="Consultations per patient")
+    parser.add_argument("--images", default="test-pics", help="Directory or glob of images to send")
+    parser.add_argument("--audio-seconds", type=float, default=0, help="Length of a synthetic recording to transcribe; 0 sends typed descriptions")
+    parser.add_argument("--think-time", type=float, default=0, help="Mean seconds between a patient's consultations")
+    parser.add_argument("--gradio-url", help="Drive a running app's Gradio endpoint instead of calling run_consultation in-process")
+    parser.add_argument("--no-stub", action="store_true", help="Use the provider URLs from the environment instead of starting the stubs")
+    parser.add_argument("--stub-port", type=int, default=0, help="Port for the in-process stubs; 0 picks a free one")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--rate-limits", help="RATE_LIMITS for the in-process pipeline; defaults to off against the stubs, so the scheduler does not cap throughput")
+    args = parser.parse_args(argv)
+    configure()
+
+    stub = None
+    if not args.no_stub and not args.gradio_url:
+        port = args.stub_port or _free_port()
+        stub = StubServer(port=port).start()
+        os.environ["GROQ_BASE_URL"] = stub.url
+        os.environ["ELEVENLABS_BASE_URL"] = stub.url
+        os.environ.setdefault("GROQ_API_KEY", "stub")
+        os.environ.setdefault("ELEVENLABS_API_KEY", "stub")
+        os.environ.setdefault("RATE_LIMITS", "off")
+    if args.rate_limits is not None:
+        os.environ["RATE_LIMITS"] = args.rate_limits
+
+    pattern = os.path.join(args.images, "*") if os.path.isdir(args.images) else args.images
+    images = sorted(glob.glob(pattern))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        audio_filepath = None
+        if args.audio_seconds > 0:
+            audio_filepath = os.path.join(temp_dir, "patient.wav")
+            write_synthetic_recording(audio_filepath, args.audio_seconds)
+
+        logger.info(f"Running {args.patients} patients x {args.consultations} consultations with {len(images)} images")
+        if args.gradio_url:
+            samples, elapsed = run_gradio_load(args.gradio_url, args.patients, args.consultations, images, audio_filepath, args.think_time)
+        else:
+            samples, elapsed = asyncio.run(run_pipeline_load(args.patients, args.consultations, images, audio_filepath, args.think_time))
+
+    if stub is not None:
+        stub.stop()
+    report = summarize(samples, elapsed)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["errors"] else 0
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# memory_monitor.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import logging
+import threading
+import weakref
+from metrics import get_metrics
+
+logger = logging.getLogger("MemoryMonitor")
+
+# Seconds between RSS samples while a consultation is running; 0 turns sampling off
+MEMORY_SAMPLE_INTERVAL = float(os.environ.get("MEMORY_SAMPLE_INTERVAL", "0.05"))
+
+# Histogram buckets in bytes, from a small upload to a container's worth
+MEMORY_BUCKETS = tuple(mib * 2 ** 20 for mib in (1, 4, 16, 64, 128, 256, 512, 1024, 2048, 4096))
+
+REQUEST_PEAK_RSS = get_metrics().histogram(
+    "ai_doctor_request_peak_rss_bytes", "Highest process RSS seen while a consultation ran", buckets=MEMORY_BUCKETS)
+REQUEST_RSS_GROWTH = get_metrics().histogram(
+    "ai_doctor_request_rss_growth_bytes", "Highest process RSS while a consultation ran, above the RSS when it started", buckets=MEMORY_BUCKETS)
+
+def current_rss():
+    """Return the process's resident set size in bytes, or 0 where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+class RequestMemory:
+    """RSS when a request started and the highest RSS seen while it ran."""
+
+    def __init__(self, rss):
+        self.start_rss = rss
+        self.peak_rss = rss
+
+    def observe(self, rss):
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+
+    def report(self):
+        return {
+            "start_rss_bytes": self.start_rss,
+            "peak_rss_bytes": self.peak_rss,
+            "rss_growth_bytes": max(0, self.peak_rss - self.start_rss)
+        }
+
+class MemoryMonitor:
+    """
+    Track each consultation's peak memory by sampling the process RSS.
+
+    A daemon thread reads the RSS every interval while any request is being
+    tracked and raises each one's peak. RSS is process-wide, so while
+    consultations overlap, a request's growth includes what the others
+    allocated meanwhile: the peak says how large the process got, which is
+    what containers are sized by. Run one consultation at a time (for
+    example batch_runner.py -c 1) to see a single request's own footprint.
+    Requests that are dropped without finish() stop being tracked once
+    garbage collected.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        """
+        Args:
+            interval (float): Seconds between samples; 0 samples only at start and finish
+        """
+        self.interval = interval
+        self._active = weakref.WeakSet()
+        self._condition = threading.Condition()
+        self._sampler = None
+
+    def track(self):
+        """
+        Start tracking a request.
+
+        Returns:
+            RequestMemory: Pass to finish() when the request is done
+        """
+        request = RequestMemory(current_rss())
+        with self._condition:
+            self._active.add(request)
+            if self.interval > 0 and self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="memory-sampler", daemon=True)
+                self._sampler.start()
+            self._condition.notify()
+        return request
+
+    def finish(self, request):
+        """
+        Stop tracking a request and record its peak in the metrics.
+
+        Returns:
+            dict: Start and peak RSS and the growth between them, in bytes
+        """
+        request.observe(current_rss())
+        with self._condition:
+            self._active.discard(request)
+        report = request.report()
+        REQUEST_PEAK_RSS.observe(report["peak_rss_bytes"])
+        REQUEST_RSS_GROWTH.observe(report["rss_growth_bytes"])
+        return report
+
+    def _sample_loop(self):
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+                # Sleeping on the condition lets track() and finish() run meanwhile
+                self._condition.wait(self.interval)
+                requests = list(self._active)
+            rss = current_rss()
+            for request in requests:
+                request.observe(rss)
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+def get_memory_monitor():
+    """Return the process-wide MemoryMonitor."""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = MemoryMonitor()
+    return _monitor
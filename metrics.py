@@ -0,0 +1,263 @@
+# metrics.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("Metrics")
+
+# Where /metrics is served in Prometheus text format; port 0 disables it
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+# Histogram buckets in seconds, from a cached lookup to a slow long recording
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter:
+    """A monotonically increasing count, kept separately per label combination."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count for the given labels."""
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return the current count for the given labels."""
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+class Histogram:
+    """Observed values counted into cumulative buckets, per label combination."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record one observation for the given labels."""
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the enclosed block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(bound)), cumulative))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+class MetricsRegistry:
+    """
+    The metrics of this process, rendered in Prometheus text format.
+
+    Counters and histograms are registered once at import time by the modules
+    that update them. Collectors are called at render time for values that
+    already live elsewhere (cache and pool statistics) and are exported as gauges.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        """Register (or return the already registered) counter called name."""
+        return self._register(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Register (or return the already registered) histogram called name."""
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def register_collector(self, collect):
+        """
+        Add a callable producing gauge values at render time.
+
+        Args:
+            collect (callable): Returns (name, help, labels dict, value) tuples
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        gauges = {}
+        for collect in collectors:
+            try:
+                for name, help, labels, value in collect():
+                    gauges.setdefault(name, (help, []))[1].append((labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {str(e)}")
+        for name, (help, values) in gauges.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return f"{value:.1f}"
+    return str(value)
+
+_registry = MetricsRegistry()
+
+def get_metrics():
+    """Return the process-wide MetricsRegistry."""
+    return _registry
+
+# Metrics shared by the pipeline modules
+STAGE_SECONDS = _registry.histogram(
+    "ai_doctor_stage_duration_seconds", "Duration of each consultation stage", ["stage", "outcome"])
+CONSULTATION_SECONDS = _registry.histogram(
+    "ai_doctor_consultation_duration_seconds", "End-to-end duration of a consultation", ["outcome"])
+CONSULTATIONS = _registry.counter(
+    "ai_doctor_consultations_total", "Consultations handled", ["outcome"])
+TIME_TO_FIRST_AUDIO = _registry.histogram(
+    "ai_doctor_time_to_first_audio_seconds", "Time from submission to the first speech segment")
+VISION_TTFT = _registry.histogram(
+    "ai_doctor_vision_time_to_first_token_seconds", "Time to the first token of a vision response", ["model"])
+VISION_TOKENS_PER_SECOND = _registry.histogram(
+    "ai_doctor_vision_tokens_per_second", "Streaming speed of vision responses after the first token", ["model"],
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600))
+MODEL_CALLS = _registry.counter(
+    "ai_doctor_model_calls_total", "Provider calls by outcome (ok, or the retry verdict of a failure)", ["stage", "model", "outcome"])
+FALLBACKS = _registry.counter(
+    "ai_doctor_fallbacks_total", "Requests moved off their first choice, by stage and the choice that was left", ["stage", "from_choice"])
+HEDGES = _registry.counter(
+    "ai_doctor_hedges_total", "Hedged requests launched, by stage and the choice that won", ["stage", "winner"])
+TTS_SECONDS = _registry.histogram(
+    "ai_doctor_tts_duration_seconds", "Time to synthesize one speech segment, by serving engine", ["engine"])
+
+_status_endpoints = {}
+
+def register_status_endpoint(path, check):
+    """
+    Serve a JSON status check next to /metrics, e.g. a readiness probe.
+
+    Args:
+        path (str): URL path, such as "/ready"
+        check (callable): Returns (ok, details dict); answered 200 when ok, else 503
+    """
+    _status_endpoints[path] = check
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in _status_endpoints:
+            ok, details = _status_endpoints[path]()
+            self._respond(200 if ok else 503, "application/json", json.dumps(details).encode("utf-8"))
+        elif path == "/metrics":
+            self._respond(200, "text/plain; version=0.0.4; charset=utf-8", get_metrics().render().encode("utf-8"))
+        else:
+            self.send_error(404)
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serve /metrics and the registered status endpoints on a daemon thread.
+
+    Args:
+        host (str): Interface to listen on
+        port (int): Port to listen on; 0 disables the endpoint
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if disabled or the port is taken
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not serve metrics on {host}:{port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
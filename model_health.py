@@ -0,0 +1,345 @@
+# model_health.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import re
+import sys
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("ModelHealth")
+
+# Circuit breaker: consecutive retryable failures before a model is skipped,
+# and how long it is skipped before one trial request is let through
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Full-jitter exponential backoff between retries of the same model
+BACKOFF_BASE_SECONDS = 0.25
+BACKOFF_MAX_SECONDS = 4.0
+
+# A model that asks us to wait longer than this is failed over instead of waited for
+MAX_RETRY_WAIT_SECONDS = float(os.environ.get("MAX_RETRY_WAIT_SECONDS", "2"))
+
+# How an error affects the model that raised it
+RETRY = "retry"              # transient: retry the same model after a backoff
+RATE_LIMITED = "rate_limited"  # skip the model until its limit resets
+UNAVAILABLE = "unavailable"  # decommissioned or unknown to the provider: stop using it
+FAILOVER = "failover"        # not worth retrying on this model; try the next one
+RAISE = "raise"              # not a provider error (e.g. a bug or a bad file): re-raise it
+
+# Number of recent time-to-first-token samples kept per model
+LATENCY_WINDOW = 200
+# Samples needed before a percentile is trusted
+LATENCY_MIN_SAMPLES = 20
+
+# Error codes with which the provider says the model itself is gone, as opposed
+# to something being wrong with one request
+UNAVAILABLE_CODES = ("model_decommissioned", "model_not_found")
+
+class ModelState:
+    """Health of one model as seen by this process."""
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.blocked_until = 0.0
+        self.unavailable_reason = None
+        # When an expiring unavailable mark lapses; 0 while the mark is permanent
+        self.unavailable_until = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def unavailable(self, now):
+        """True while the model is marked unavailable; clears a mark that has expired."""
+        if self.unavailable_reason and self.unavailable_until and self.unavailable_until <= now:
+            self.unavailable_reason = None
+            self.unavailable_until = 0.0
+        return self.unavailable_reason is not None
+
+    def as_dict(self, now):
+        return {
+            "state": "unavailable" if self.unavailable(now) else
+                     "rate_limited" if self.blocked_until > now else
+                     "open" if self.open_until > now else "closed",
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "unavailable_reason": self.unavailable_reason,
+            "latency_samples": len(self.latencies)
+        }
+
+class ModelHealthRegistry:
+    """
+    Process-wide health tracking for the models in a fallback chain.
+
+    Decommissioned or unknown models are remembered and skipped for good
+    (or until an expiring mark lapses); rate-limited models are skipped until their limit resets; models that keep
+    failing trip a circuit breaker and are skipped for CIRCUIT_OPEN_SECONDS,
+    after which a single trial request decides whether they recover.
+    """
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, model):
+        state = self._states.get(model)
+        if state is None:
+            state = self._states[model] = ModelState()
+        return state
+
+    def ordered(self, models):
+        """
+        Order a fallback chain for the next request.
+
+        Healthy models keep their order and come first; models with an open
+        circuit or an active rate limit follow, soonest-available first, so a
+        request is never refused outright. Unavailable models are dropped,
+        unless that would leave nothing to try: then the first of them is
+        kept as a last resort.
+
+        Args:
+            models (list): Fallback chain in preference order
+
+        Returns:
+            list: Models to try, in order
+        """
+        now = time.monotonic()
+        healthy = []
+        degraded = []
+        unavailable = []
+        with self._lock:
+            for model in models:
+                state = self._state(model)
+                if state.unavailable(now):
+                    unavailable.append(model)
+                    continue
+                resume_at = max(state.open_until, state.blocked_until)
+                if resume_at > now:
+                    degraded.append((resume_at, model))
+                else:
+                    healthy.append(model)
+                    if state.open_until:
+                        # Half-open: let this request through as the trial
+                        state.open_until = now + self.open_seconds
+        ordered = healthy + [model for _, model in sorted(degraded)]
+        return ordered or unavailable[:1]
+
+    def record_success(self, model):
+        """Close the model's circuit after a successful call."""
+        with self._lock:
+            state = self._state(model)
+            state.consecutive_failures = 0
+            state.open_until = 0.0
+            state.successes += 1
+
+    def record_failure(self, model, error):
+        """
+        Classify an error and update the model's health.
+
+        Args:
+            model (str): Model that raised the error
+            error (Exception): The error
+
+        Returns:
+            str: RETRY, RATE_LIMITED, UNAVAILABLE, FAILOVER or RAISE
+        """
+        verdict = classify_error(error)
+        if verdict == RAISE:
+            # Says nothing about the model's health
+            return verdict
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(model)
+            state.failures += 1
+            if verdict == UNAVAILABLE:
+                state.unavailable_reason = str(error)[:200]
+                state.unavailable_until = 0.0
+                logger.warning(f"Model {model} is unavailable and will be skipped: {state.unavailable_reason}")
+            elif verdict == RATE_LIMITED:
+                wait = retry_after_seconds(error) or self.open_seconds
+                state.blocked_until = now + wait
+                logger.warning(f"Model {model} is rate limited for {wait:.1f}s")
+            else:
+                state.consecutive_failures += 1
+                if state.consecutive_failures >= self.failure_threshold:
+                    state.open_until = now + self.open_seconds
+                    logger.warning(f"Circuit opened for {model} after {state.consecutive_failures} consecutive failures")
+        return verdict
+
+    def mark_unavailable(self, model, reason, seconds=None):
+        """
+        Skip a model without waiting for a request to fail on it (e.g. after a model-list probe).
+
+        Args:
+            model (str): Model name
+            reason (str): Why the model is skipped
+            seconds (float): How long to skip it; None skips it for good
+        """
+        with self._lock:
+            state = self._state(model)
+            state.unavailable_reason = reason
+            state.unavailable_until = time.monotonic() + seconds if seconds else 0.0
+        duration = f"for {seconds:.0f}s" if seconds else "for good"
+        logger.warning(f"Model {model} is unavailable and will be skipped {duration}: {reason}")
+
+    def record_latency(self, model, seconds):
+        """Record a model's time to first token (or to the full response when not streaming)."""
+        with self._lock:
+            self._state(model).latencies.append(seconds)
+
+    def latency_percentile(self, model, percentile):
+        """
+        Return a percentile of a model's recent time to first token.
+
+        Args:
+            model (str): Model name
+            percentile (float): Percentile between 0 and 100
+
+        Returns:
+            float: Latency in seconds, or None until LATENCY_MIN_SAMPLES are recorded
+        """
+        with self._lock:
+            samples = sorted(self._state(model).latencies)
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def backoff_delay(self, attempt, error=None):
+        """
+        Delay before retrying the same model.
+
+        Honors the provider's wait for a rate limit (429); transient errors
+        (408, 409, 5xx, connection failures) use full-jitter exponential
+        backoff, whatever rate-limit headers they carry.
+
+        Args:
+            attempt (int): Zero-based attempt number that just failed
+            error (Exception): The error, checked for a rate-limit wait
+
+        Returns:
+            float: Seconds to wait
+        """
+        if error is not None and getattr(error, "status_code", None) == 429:
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                return retry_after
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+    def snapshot(self):
+        """Return the health of every model seen so far."""
+        now = time.monotonic()
+        with self._lock:
+            return {model: state.as_dict(now) for model, state in self._states.items()}
+
+def classify_error(error):
+    """
+    Decide how an exception from a model call should be handled.
+
+    Only the provider's model-specific error codes mark a model unavailable;
+    any other client error fails this request over to the next model.
+    Exceptions that did not come from the provider are re-raised.
+    """
+    # SDK and transport exceptions can only exist once their modules have been imported
+    groq = sys.modules.get("groq")
+    httpx = sys.modules.get("httpx")
+    if groq is not None and isinstance(error, (groq.APITimeoutError, groq.APIConnectionError)):
+        return RETRY
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        # Connection dropped or timed out while a response was being read
+        return RETRY
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        return RAISE
+    if error_code(error) in UNAVAILABLE_CODES:
+        return UNAVAILABLE
+    if status == 429:
+        return RATE_LIMITED
+    if status in (408, 409) or status >= 500:
+        return RETRY
+    return FAILOVER
+
+def error_code(error):
+    """Return the "code" of a provider error body such as {"error": {"code": "model_not_found"}}, or None."""
+    body = getattr(error, "body", None)
+    if isinstance(body, dict):
+        body = body.get("error", body)
+    if isinstance(body, dict):
+        return body.get("code")
+    return None
+
+def retry_after_seconds(error):
+    """
+    Read how long the provider asked us to wait, if it did.
+
+    Retry-After wins when present. A 429 without it falls back to Groq's
+    x-ratelimit-reset-tokens (a value such as "7.66s" or "500ms").
+    x-ratelimit-reset-requests is never used: Groq sends it on every
+    response, and it counts down to the daily request limit's reset, often
+    hours away.
+
+    Returns:
+        float: Seconds to wait, or None
+    """
+    retry_after = retry_after_header(error)
+    if retry_after is not None:
+        return retry_after
+    if getattr(error, "status_code", None) == 429:
+        response = getattr(error, "response", None)
+        value = getattr(response, "headers", {}).get("x-ratelimit-reset-tokens")
+        if value:
+            return parse_duration(value)
+    return None
+
+def retry_after_header(error):
+    """
+    Read the error's Retry-After header, in seconds.
+
+    Unlike retry_after_seconds, this ignores Groq's x-ratelimit-reset-*
+    estimates, so it is only set when the provider explicitly asked every
+    caller to back off.
+
+    Returns:
+        float: Seconds to wait, or None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return None
+
+def parse_duration(value):
+    """Parse a Go-style duration such as "1m2.5s" or "300ms" into seconds."""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value.strip())
+    if not parts or "".join(number + unit for number, unit in parts) != value.strip():
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+_default_registry = None
+_default_lock = threading.Lock()
+
+def get_model_health():
+    """Return the process-wide ModelHealthRegistry."""
+    global _default_registry
+    if _default_registry is None:
+        with _default_lock:
+            if _default_registry is None:
+                _default_registry = ModelHealthRegistry()
+    return _default_registry
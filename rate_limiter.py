@@ -0,0 +1,348 @@
+# rate_limiter.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque, namedtuple
+from metrics import get_metrics
+
+logger = logging.getLogger("RateLimiter")
+
+# Provider budgets per resource ("provider:model"): requests and tokens per
+# minute, 0 meaning unlimited. Nothing is limited unless RATE_LIMITS sets
+# comma-separated key=rpm/tpm pairs, e.g. "groq:whisper-large-v3=300/0,elevenlabs=100/0";
+# the entry "free-tier" stands for Groq's free-tier limits below, and
+# RATE_LIMITS=off disables scheduling altogether
+FREE_TIER_RATE_LIMITS = {
+    "groq:meta-llama/llama-4-scout-17b-16e-instruct": (30, 30000),
+    "groq:meta-llama/llama-4-maverick-17b-128e-instruct": (30, 6000),
+    "groq:whisper-large-v3": (20, 0),
+    "groq:whisper-large-v3-turbo": (20, 0)
+}
+RATE_LIMITS = os.environ.get("RATE_LIMITS", "")
+
+# Fraction of each budget this process may use; job_worker.py sets it when
+# several worker processes share one API key
+RATE_LIMIT_SHARE = float(os.environ.get("RATE_LIMIT_SHARE", "1"))
+
+# Load shedding: a request is refused rather than queued when this many are
+# already waiting for the same resource, or when its estimated wait is longer
+SCHEDULER_MAX_BACKLOG = int(os.environ.get("SCHEDULER_MAX_BACKLOG", "64"))
+SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get("SCHEDULER_MAX_WAIT_SECONDS", "60"))
+
+# Who is asking: requests with the same id share one fair-queueing turn, and
+# on_wait (if set) is called with a QueueStatus while they wait
+Session = namedtuple("Session", ["id", "on_wait"])
+QueueStatus = namedtuple("QueueStatus", ["resource", "position", "waiting", "eta"])
+
+SCHEDULER_WAIT_SECONDS = get_metrics().histogram(
+    "ai_doctor_scheduler_wait_seconds", "Time requests waited for a provider budget", ["resource"])
+SCHEDULER_SHED = get_metrics().counter(
+    "ai_doctor_scheduler_shed_total", "Requests refused because the backlog was too long", ["resource"])
+
+class SchedulerOverloaded(Exception):
+    """Raised instead of queueing a request when the backlog is over its limit."""
+
+class TokenBucket:
+    """A budget of amount per minute, refilled continuously, that may burst up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount, now):
+        """Seconds until amount can be taken (amounts over capacity are capped, so they wait for a full bucket)."""
+        self.refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount, now):
+        self.refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def drain(self, seconds, now):
+        """Empty the bucket so nothing can be taken for seconds."""
+        self.refill(now)
+        self.level = min(self.level, -seconds * self.rate)
+
+class _Waiter:
+    def __init__(self, tokens, session):
+        self.tokens = tokens
+        self.session = session
+        self.future = asyncio.get_running_loop().create_future()
+
+class _Resource:
+    """Budgets and the fair queue of one provider model."""
+
+    def __init__(self, key, requests_per_minute, tokens_per_minute):
+        self.key = key
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # One queue per session, in the order their turns come up
+        self.queues = OrderedDict()
+        self.waiting = 0
+        self.dispatcher = None
+
+    def wait_time(self, tokens, now):
+        wait = self.requests.time_until(1, now) if self.requests else 0.0
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.time_until(tokens, now))
+        return wait
+
+    def take(self, tokens, now):
+        if self.requests:
+            self.requests.take(1, now)
+        if self.tokens and tokens:
+            self.tokens.take(tokens, now)
+
+    def enqueue(self, waiter, session_key):
+        self.queues.setdefault(session_key, deque()).append(waiter)
+        self.waiting += 1
+
+    def remove(self, waiter, session_key):
+        queue = self.queues.get(session_key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[session_key]
+
+    def pop_next(self):
+        """Take the next waiter round-robin: one per session per turn."""
+        session_key, queue = next(iter(self.queues.items()))
+        waiter = queue.popleft()
+        self.waiting -= 1
+        del self.queues[session_key]
+        if queue:
+            # The session goes to the back of the line for its next request
+            self.queues[session_key] = queue
+        return waiter
+
+    def peek_next(self):
+        return next(iter(self.queues.values()))[0]
+
+    def in_order(self):
+        """Waiters in the order they will be let through."""
+        queues = [list(queue) for queue in self.queues.values()]
+        for turn in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if turn < len(queue):
+                    yield queue[turn]
+
+    def estimated_waits(self, now, extra_tokens=None):
+        """
+        Estimate each waiter's wait from the refill rates.
+
+        Args:
+            extra_tokens (int): Also estimate for a new request of this size joining the back
+
+        Returns:
+            list: (waiter, seconds) in dispatch order, plus (None, seconds) for the new request
+        """
+        estimates = []
+        requests = tokens = 0
+        waiters = list(self.in_order())
+        if extra_tokens is not None:
+            waiters.append(None)
+        for waiter in waiters:
+            requests += 1
+            tokens += waiter.tokens if waiter is not None else extra_tokens
+            wait = 0.0
+            if self.requests:
+                self.requests.refill(now)
+                wait = max(wait, (requests - self.requests.level) / self.requests.rate)
+            if self.tokens and tokens:
+                self.tokens.refill(now)
+                wait = max(wait, (tokens - self.tokens.level) / self.tokens.rate)
+            estimates.append((waiter, max(0.0, wait)))
+        return estimates
+
+class RateLimitScheduler:
+    """
+    Admit provider calls within per-model request and token budgets.
+
+    Calls that fit the budget go straight through. Otherwise they wait in a
+    per-resource queue served round-robin across sessions, so one patient's
+    burst of requests cannot starve another's, and are told their position
+    and estimated wait. When the queue is too long the call is refused with
+    SchedulerOverloaded instead of making everyone wait longer. Runs on one
+    event loop.
+    """
+
+    def __init__(self, limits=None, max_backlog=SCHEDULER_MAX_BACKLOG, max_wait=SCHEDULER_MAX_WAIT_SECONDS):
+        """
+        Args:
+            limits (dict): Resource key to (requests per minute, tokens per minute)
+            max_backlog (int): Waiting requests per resource before new ones are refused
+            max_wait (float): Estimated wait in seconds beyond which new requests are refused
+        """
+        self.limits = dict(limits if limits is not None else parse_rate_limits(RATE_LIMITS))
+        self.max_backlog = max_backlog
+        self.max_wait = max_wait
+        self._resources = {}
+
+    def _resource(self, key):
+        resource = self._resources.get(key)
+        if resource is None:
+            requests_per_minute, tokens_per_minute = self.limits.get(key, (0, 0))
+            if not requests_per_minute and not tokens_per_minute:
+                return None
+            resource = self._resources[key] = _Resource(key, requests_per_minute, tokens_per_minute)
+        return resource
+
+    async def acquire(self, key, tokens=0, session=None):
+        """
+        Wait until a call to resource key fits its budget, and charge it.
+
+        Args:
+            key (str): Resource, e.g. "groq:whisper-large-v3"
+            tokens (int): Estimated tokens the call will use
+            session (Session): Caller, for fair queueing and wait notifications
+
+        Returns:
+            float: Seconds waited
+
+        Raises:
+            SchedulerOverloaded: The backlog for key is over its limit
+        """
+        resource = self._resource(key)
+        if resource is None:
+            return 0.0
+        started = time.monotonic()
+        if not resource.waiting and resource.wait_time(tokens, started) == 0:
+            resource.take(tokens, started)
+            SCHEDULER_WAIT_SECONDS.observe(0.0, resource=key)
+            return 0.0
+
+        if resource.waiting >= self.max_backlog:
+            self._shed(key, f"{resource.waiting} requests already waiting")
+        eta = resource.estimated_waits(started, extra_tokens=tokens)[-1][1]
+        if eta > self.max_wait:
+            self._shed(key, f"estimated wait {eta:.0f}s")
+
+        waiter = _Waiter(tokens, session)
+        session_key = session.id if session is not None and session.id is not None else waiter
+        resource.enqueue(waiter, session_key)
+        if resource.dispatcher is None:
+            resource.dispatcher = asyncio.ensure_future(self._dispatch(resource))
+        self._notify(resource)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            resource.remove(waiter, session_key)
+            raise
+        waited = time.monotonic() - started
+        SCHEDULER_WAIT_SECONDS.observe(waited, resource=key)
+        return waited
+
+    def estimated_wait(self, key, tokens=0):
+        """Seconds a call to key would wait if it joined the queue now; 0 for unlimited resources."""
+        resource = self._resource(key)
+        if resource is None:
+            return 0.0
+        return resource.estimated_waits(time.monotonic(), extra_tokens=tokens)[-1][1]
+
+    def pause(self, key, seconds):
+        """Hold back calls to key for seconds, e.g. after the provider answered 429 anyway."""
+        resource = self._resource(key)
+        if resource is not None and resource.requests and seconds:
+            resource.requests.drain(seconds, time.monotonic())
+            logger.info(f"Pausing {key} for {seconds:.1f}s after a rate-limit response")
+
+    def check_capacity(self):
+        """
+        Refuse new work up front when any resource's backlog is full.
+
+        Raises:
+            SchedulerOverloaded: Some resource has max_backlog requests waiting
+        """
+        for key, resource in self._resources.items():
+            if resource.waiting >= self.max_backlog:
+                self._shed(key, f"{resource.waiting} requests already waiting")
+
+    def backlog(self):
+        """Return the number of waiting requests per resource."""
+        return {key: resource.waiting for key, resource in self._resources.items()}
+
+    def _shed(self, key, reason):
+        SCHEDULER_SHED.inc(resource=key)
+        logger.warning(f"Shedding a request for {key}: {reason}")
+        raise SchedulerOverloaded("The service is very busy right now. Please try again in a minute.")
+
+    async def _dispatch(self, resource):
+        try:
+            while resource.waiting:
+                waiter = resource.peek_next()
+                now = time.monotonic()
+                delay = resource.wait_time(waiter.tokens, now)
+                if delay > 0:
+                    # Re-evaluated after the sleep: the head may have been cancelled meanwhile
+                    await asyncio.sleep(delay)
+                    continue
+                resource.pop_next()
+                if waiter.future.done():
+                    continue
+                resource.take(waiter.tokens, now)
+                waiter.future.set_result(None)
+                self._notify(resource)
+        finally:
+            resource.dispatcher = None
+
+    def _notify(self, resource):
+        now = time.monotonic()
+        for position, (waiter, eta) in enumerate(resource.estimated_waits(now), start=1):
+            if waiter.session is not None and waiter.session.on_wait is not None:
+                try:
+                    waiter.session.on_wait(QueueStatus(resource.key, position, resource.waiting, eta))
+                except Exception as e:
+                    logger.warning(f"Queue status callback failed: {str(e)}")
+
+def parse_rate_limits(value, share=RATE_LIMIT_SHARE):
+    """
+    Build the budget table from a RATE_LIMITS string.
+
+    Args:
+        value (str): Comma-separated key=rpm/tpm pairs and "free-tier" entries, or "off"
+        share (float): Fraction of each budget to keep (at least 1 of each limited amount)
+
+    Returns:
+        dict: Resource key to (requests per minute, tokens per minute)
+    """
+    if value.strip().lower() in ("off", "0", "none"):
+        return {}
+    limits = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        if entry.lower() == "free-tier":
+            limits.update(FREE_TIER_RATE_LIMITS)
+            continue
+        try:
+            key, budget = entry.rsplit("=", 1)
+            requests_per_minute, _, tokens_per_minute = budget.partition("/")
+            limits[key.strip()] = (int(requests_per_minute or 0), int(tokens_per_minute or 0))
+        except ValueError:
+            logger.error(f"Ignoring malformed RATE_LIMITS entry: {entry}")
+    if share != 1:
+        limits = {key: tuple(max(1, int(limit * share)) if limit else 0 for limit in budget) for key, budget in limits.items()}
+    return limits
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Return the process-wide RateLimitScheduler."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RateLimitScheduler()
+    return _scheduler
@@ -0,0 +1,213 @@
+# stage_runner.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import time
+import asyncio
+import logging
+import contextlib
+from metrics import STAGE_SECONDS
+from memory_monitor import get_memory_monitor
+
+logger = logging.getLogger("StageRunner")
+
+# Share of the progress bar each consultation stage accounts for
+PROGRESS_WEIGHTS = {"stt": 0.25, "image_prep": 0.1, "vision": 0.4, "tts": 0.25}
+
+# Minimum seconds between progress bar updates while a stage reports partial progress
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", "0.25"))
+
+class StageRunner:
+    """
+    Run the independent stages of one consultation concurrently and time them.
+
+    start() launches a stage as an asyncio task straight away; stage() times
+    work done inline (such as a streamed response). Every stage records which
+    stages it waited on, so critical_path() can tell which chain of stages
+    actually determined the request's latency. The process's peak memory is
+    tracked from construction until finish().
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings = {}
+        self._dependencies = {}
+        self._tasks = {}
+        # Exception that ended the request, if any
+        self.error = None
+        self._memory = get_memory_monitor().track()
+        # Peak memory report, set by finish()
+        self.memory = None
+
+    def start(self, name, coroutine, depends_on=()):
+        """
+        Start a stage as a background task.
+
+        Args:
+            name (str): Stage name
+            coroutine: Awaitable doing the stage's work
+            depends_on (tuple): Stages whose results this stage uses
+
+        Returns:
+            asyncio.Task: Task resolving to the stage's result
+        """
+        async def run():
+            async with self.stage(name, depends_on):
+                return await coroutine
+        task = asyncio.ensure_future(run())
+        self._tasks[name] = task
+        return task
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name, depends_on=()):
+        """Time the enclosed block as stage name and export its duration."""
+        self._dependencies[name] = tuple(depends_on)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except (asyncio.CancelledError, GeneratorExit):
+            # Cancelled, or the consumer of a streaming stage went away
+            outcome = "cancelled"
+            raise
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = (start - self.started_at, end - self.started_at)
+            STAGE_SECONDS.observe(end - start, stage=name, outcome=outcome)
+
+    def finished(self, name):
+        """True once stage name has completed, successfully or not."""
+        task = self._tasks.get(name)
+        return name in self.timings and (task is None or task.done())
+
+    def cancel(self):
+        """Cancel every stage still running."""
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def shutdown(self):
+        """
+        Cancel every stage still running and wait until they have stopped.
+
+        Errors of stages nobody awaited are collected here rather than left
+        for asyncio to report as never retrieved.
+        """
+        self.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def critical_path(self):
+        """
+        Work out the chain of stages that bounded the total latency.
+
+        Starting from the stage that finished last, repeatedly step to the
+        dependency that finished last, i.e. the one the stage was waiting for.
+
+        Returns:
+            list: (stage name, start, end) tuples in execution order, seconds since the runner started
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        path = []
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, start, end))
+            finished = [dep for dep in self._dependencies.get(name, ()) if dep in self.timings]
+            name = max(finished, key=lambda dep: self.timings[dep][1]) if finished else None
+        return list(reversed(path))
+
+    def finish(self):
+        """Stop tracking memory and record the request's peak; later calls do nothing."""
+        if self.memory is None:
+            self.memory = get_memory_monitor().finish(self._memory)
+
+    def report(self):
+        """
+        Summarize stage durations, the critical path and peak memory.
+
+        Returns:
+            dict: Per-stage durations, the critical path, the total elapsed time, any error and the memory report
+        """
+        return {
+            "stages": {name: round(end - start, 3) for name, (start, end) in self.timings.items()},
+            "critical_path": [name for name, _, _ in self.critical_path()],
+            "total": round(time.perf_counter() - self.started_at, 3),
+            "error": str(self.error) if self.error is not None else None,
+            "memory": self.memory if self.memory is not None else self._memory.report()
+        }
+
+    def log_report(self):
+        """Log the critical path and peak memory of this request."""
+        path = " -> ".join(f"{name} {end - start:.2f}s" for name, start, end in self.critical_path())
+        memory = self.memory if self.memory is not None else self._memory.report()
+        logger.info(
+            f"Critical path: {path} (total {time.perf_counter() - self.started_at:.2f}s, "
+            f"peak RSS {memory['peak_rss_bytes'] / 2 ** 20:.0f} MiB, +{memory['rss_growth_bytes'] / 2 ** 20:.1f} MiB)"
+        )
+
+class StageProgress:
+    """
+    Drive a Gradio progress bar from the stages a consultation has completed.
+
+    Each stage owns a share of the bar (PROGRESS_WEIGHTS); finished and skipped
+    stages count in full, running ones by the fraction passed to update().
+    The bar never moves backwards, and updates that only advance a partial
+    fraction are throttled so a fast token stream does not flood the queue.
+    """
+
+    def __init__(self, progress, stages, weights=PROGRESS_WEIGHTS, min_interval=PROGRESS_MIN_INTERVAL):
+        """
+        Args:
+            progress (callable): gr.Progress (or any callable taking fraction and description)
+            stages (StageRunner): Runner whose completed stages are counted
+            weights (dict): Share of the bar per stage name
+            min_interval (float): Minimum seconds between partial updates
+        """
+        self.progress = progress
+        self.stages = stages
+        self.weights = weights
+        self.min_interval = min_interval
+        self._skipped = set()
+        self._fraction = 0.0
+        self._description = None
+        self._updated_at = 0.0
+
+    def skip(self, *names):
+        """Count stages that will not run in this consultation as done."""
+        self._skipped.update(names)
+
+    def update(self, description, **partial):
+        """
+        Report progress.
+
+        Args:
+            description (str): Text shown with the bar
+            **partial: Fraction (0-1) completed of stages still running, by stage name
+        """
+        fraction = 0.0
+        for name, weight in self.weights.items():
+            if name in self._skipped or self.stages.finished(name):
+                fraction += weight
+            elif name in partial:
+                # A running stage never fills its share until it actually finishes
+                fraction += weight * min(max(partial[name], 0.0), 0.95)
+        fraction = max(self._fraction, min(fraction, 1.0))
+        now = time.monotonic()
+        if description == self._description and now - self._updated_at < self.min_interval:
+            return
+        self._fraction = fraction
+        self._description = description
+        self._updated_at = now
+        self.progress(round(fraction, 3), description)
+
+    def notice(self, description):
+        """Show a message, such as a queue position, without moving the bar; throttled like partial updates."""
+        now = time.monotonic()
+        if now - self._updated_at < self.min_interval:
+            return
+        self._description = description
+        self._updated_at = now
+        self.progress(round(self._fraction, 3), description)
@@ -0,0 +1,325 @@
+# stub_servers.py
+
+from bootstrap import load_environment, configure
+load_environment()
+
+import os
+import math
+import time
+import json
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+logger = logging.getLogger("StubServers")
+
+# Where the stub listens; point GROQ_BASE_URL and ELEVENLABS_BASE_URL at it
+STUB_HOST = os.environ.get("STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.environ.get("STUB_PORT", "8765"))
+
+# One valid, silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, mono): 1152
+# samples, about 26 ms. Concatenated frames make a playable MP3 of any length.
+MP3_FRAME = b"\xff\xfb\x90\xc0" + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+
+# Spoken English runs at roughly this many characters per second of audio
+SPEECH_CHARS_PER_SECOND = 15
+
+RESPONSE_TEMPLATE = (
+    "Based on what I can see, the image shows an area of redness with small raised bumps, "
+    "which you say has been bothering you for about {days} days. "
+    "The most likely causes are contact dermatitis, a mild fungal infection or an early eczema flare. "
+    "For dermatitis, a 1% hydrocortisone cream applied twice daily for up to seven days usually helps. "
+    "If it is fungal, clotrimazole cream twice daily for two weeks is a common option. "
+    "An oral antihistamine such as cetirizine 10 mg once daily can ease the itching. "
+    "Please see a doctor within the next {weeks} weeks if it spreads, blisters or does not improve. "
+    "This is an AI consultation and not a replacement for in-person medical care. "
+    "Any medication suggestions should be discussed with a healthcare provider before use. "
+    "Seek immediate medical attention for severe or worsening symptoms."
+)
+
+TRANSCRIPT_TEMPLATE = "I have had this itchy rash on my arm for about {days} days and it is getting worse."
+
+class LatencyDistribution:
+    """
+    Log-normal latency described by its median and 95th percentile.
+
+    Log-normal matches the long right tail of real API latencies; a p95 equal
+    to the median gives a constant delay.
+    """
+
+    def __init__(self, median, p95):
+        """
+        Args:
+            median (float): Median latency in seconds
+            p95 (float): 95th percentile latency in seconds (at least the median)
+        """
+        self.median = median
+        self.sigma = math.log(max(p95, median) / median) / 1.645 if median > 0 else 0.0
+
+    def sample(self):
+        """Draw one latency in seconds."""
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+    @classmethod
+    def parse(cls, value):
+        """Parse "median" or "median,p95" in milliseconds."""
+        parts = [float(part) / 1000 for part in value.split(",")]
+        return cls(parts[0], parts[-1])
+
+class StubConfig:
+    """Latency and failure behaviour of the stub endpoints."""
+
+    def __init__(self,
+                 chat_ttft=LatencyDistribution(0.4, 1.2),
+                 chat_tokens_per_second=250.0,
+                 stt_latency=LatencyDistribution(0.3, 0.9),
+                 tts_first_byte=LatencyDistribution(0.25, 0.8),
+                 tts_realtime_factor=10.0,
+                 error_rate=0.0,
+                 rate_limit_rate=0.0,
+                 retry_after=1.0,
+                 unavailable_models=()):
+        """
+        Args:
+            chat_ttft (LatencyDistribution): Time to the first chat token (or full response when not streaming)
+            chat_tokens_per_second (float): Streaming speed after the first token
+            stt_latency (LatencyDistribution): Transcription latency
+            tts_first_byte (LatencyDistribution): Time to the first audio byte
+            tts_realtime_factor (float): Seconds of audio produced per second after the first byte
+            error_rate (float): Fraction of requests answered with HTTP 500
+            rate_limit_rate (float): Fraction of requests answered with HTTP 429
+            retry_after (float): Retry-After seconds sent with 429 responses
+            unavailable_models (tuple): Models answered with a model-not-found error
+        """
+        self.chat_ttft = chat_ttft
+        self.chat_tokens_per_second = chat_tokens_per_second
+        self.stt_latency = stt_latency
+        self.tts_first_byte = tts_first_byte
+        self.tts_realtime_factor = tts_realtime_factor
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.unavailable_models = set(unavailable_models)
+
+    @classmethod
+    def from_env(cls):
+        """Build a config from STUB_* environment variables (latencies in ms as "median,p95")."""
+        env = os.environ.get
+        return cls(
+            chat_ttft=LatencyDistribution.parse(env("STUB_CHAT_TTFT_MS", "400,1200")),
+            chat_tokens_per_second=float(env("STUB_CHAT_TOKENS_PER_SECOND", "250")),
+            stt_latency=LatencyDistribution.parse(env("STUB_STT_LATENCY_MS", "300,900")),
+            tts_first_byte=LatencyDistribution.parse(env("STUB_TTS_FIRST_BYTE_MS", "250,800")),
+            tts_realtime_factor=float(env("STUB_TTS_REALTIME_FACTOR", "10")),
+            error_rate=float(env("STUB_ERROR_RATE", "0")),
+            rate_limit_rate=float(env("STUB_RATE_LIMIT_RATE", "0")),
+            retry_after=float(env("STUB_RETRY_AFTER", "1")),
+            unavailable_models=[model for model in env("STUB_UNAVAILABLE_MODELS", "").split(",") if model]
+        )
+
+def create_stub_app(config=None):
+    """
+    Build an app that imitates the Groq and ElevenLabs endpoints the pipeline uses.
+
+    Groq (OpenAI-compatible, under /openai/v1): model list, chat completions
+    with and without SSE streaming, and audio transcriptions. ElevenLabs
+    (under /v1): voice list and text-to-speech, plain and streaming. Responses
+    carry a random number of days so the analysis and TTS caches miss as they
+    would for real patients. Request and injected error counts are served at
+    /stub/stats.
+
+    Args:
+        config (StubConfig): Latency and failure settings; defaults to StubConfig.from_env()
+
+    Returns:
+        FastAPI: The stub application
+    """
+    config = config or StubConfig.from_env()
+    app = FastAPI(title="AI Doctor provider stubs")
+    app.state.config = config
+    stats = {"requests": {}, "injected_errors": 0, "injected_rate_limits": 0}
+
+    def count(endpoint):
+        stats["requests"][endpoint] = stats["requests"].get(endpoint, 0) + 1
+
+    def injected_failure():
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            stats["injected_rate_limits"] += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached (stub)", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": str(config.retry_after)}
+            )
+        if roll < config.rate_limit_rate + config.error_rate:
+            stats["injected_errors"] += 1
+            return JSONResponse({"error": {"message": "Internal server error (stub)", "type": "internal_server_error"}}, status_code=500)
+        return None
+
+    @app.get("/openai/v1/models")
+    async def list_models():
+        count("models")
+        models = ["meta-llama/llama-4-scout-17b-16e-instruct", "meta-llama/llama-4-maverick-17b-128e-instruct", "whisper-large-v3", "whisper-large-v3-turbo"]
+        return {"object": "list", "data": [
+            {"id": model, "object": "model", "created": 0, "owned_by": "stub", "active": model not in config.unavailable_models, "context_window": 131072}
+            for model in models
+        ]}
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        count("chat")
+        body = await request.json()
+        model = body.get("model", "")
+        if model in config.unavailable_models:
+            return JSONResponse({"error": {
+                "message": f"The model `{model}` does not exist or you do not have access to it.",
+                "type": "invalid_request_error",
+                "code": "model_not_found"
+            }}, status_code=404)
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+
+        text = RESPONSE_TEMPLATE.format(days=random.randint(2, 9999), weeks=random.randint(1, 4))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        ttft = config.chat_ttft.sample()
+
+        if not body.get("stream"):
+            tokens = len(text.split())
+            await asyncio.sleep(ttft + tokens / config.chat_tokens_per_second)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1000, "completion_tokens": tokens, "total_tokens": 1000 + tokens}
+            }
+
+        async def events():
+            await asyncio.sleep(ttft)
+            words = text.split(" ")
+            for index, word in enumerate(words):
+                if index:
+                    await asyncio.sleep(1 / config.chat_tokens_per_second)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"role": "assistant", "content": word if index == 0 else " " + word}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/openai/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        count("transcriptions")
+        form = await request.form()
+        upload = form.get("file")
+        size = len(await upload.read()) if upload is not None else 0
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        # Bigger uploads take a little longer, as they do upstream
+        await asyncio.sleep(config.stt_latency.sample() + size / 50_000_000)
+        return {"text": TRANSCRIPT_TEMPLATE.format(days=random.randint(2, 9999))}
+
+    @app.get("/v1/voices")
+    async def voices():
+        count("voices")
+        return {"voices": [
+            {"voice_id": "9BWtsMINqrJLrRacOk9x", "name": "Aria", "category": "premade"},
+            {"voice_id": "EXAVITQu4vr4xnVa6Ejs", "name": "Sarah", "category": "premade"}
+        ]}
+
+    @app.post("/v1/text-to-speech/{voice_id}")
+    @app.post("/v1/text-to-speech/{voice_id}/stream")
+    async def text_to_speech(voice_id: str, request: Request):
+        count("tts")
+        body = await request.json()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        frames = max(1, int(len(body.get("text", "")) / SPEECH_CHARS_PER_SECOND / MP3_FRAME_SECONDS))
+        first_byte = config.tts_first_byte.sample()
+
+        async def audio():
+            await asyncio.sleep(first_byte)
+            # Deliver about a quarter second of audio per chunk at the configured speed
+            per_chunk = 10
+            for start in range(0, frames, per_chunk):
+                if start:
+                    await asyncio.sleep(per_chunk * MP3_FRAME_SECONDS / config.tts_realtime_factor)
+                yield MP3_FRAME * min(per_chunk, frames - start)
+
+        return StreamingResponse(audio(), media_type="audio/mpeg")
+
+    @app.get("/stub/stats")
+    async def stub_stats():
+        return stats
+
+    return app
+
+class StubServer:
+    """A stub app served by uvicorn on a background thread, for use inside another process."""
+
+    def __init__(self, config=None, host=STUB_HOST, port=STUB_PORT):
+        self.host = host
+        self.port = port
+        self._server = uvicorn.Server(uvicorn.Config(create_stub_app(config), host=host, port=port, log_level="warning"))
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self, timeout=10.0):
+        """Start serving and wait until the socket accepts connections."""
+        self._thread = threading.Thread(target=self._server.run, name="stub-server", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError(f"Stub server did not start on {self.url}")
+            time.sleep(0.05)
+        logger.info(f"Stub servers listening on {self.url}")
+        return self
+
+    def stop(self):
+        """Stop serving and wait for the thread to exit."""
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve local stand-ins for the Groq and ElevenLabs APIs.")
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    args = parser.parse_args(argv)
+    configure()
+    logger.info(f"Set GROQ_BASE_URL=http://{args.host}:{args.port} and ELEVENLABS_BASE_URL=http://{args.host}:{args.port} to use the stubs")
+    uvicorn.run(create_stub_app(), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
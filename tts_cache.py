@@ -0,0 +1,189 @@
+# tts_cache.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("TTSCache")
+
+# Where synthesized audio is kept and how much of it
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ai-doctor-tts-cache"))
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# List markers and emphasis the model puts in front of a sentence ("- ", "2. ", "**")
+LEADING_MARKERS = re.compile(r"^(?:[-*+\u2022]\s+|\d+[.)]\s+|[*_]+)+")
+# Closing punctuation and emphasis, which the model may or may not write
+TRAILING_MARKERS = re.compile(r"[\s.!?,;:\u2026*_]+$")
+
+def normalize_text(text):
+    """
+    Reduce text to the words that are spoken, so renderings of a sentence
+    that differ only in whitespace, list markers, emphasis or closing
+    punctuation share an entry.
+    """
+    text = re.sub(r"\s+", " ", text).strip()
+    text = TRAILING_MARKERS.sub("", LEADING_MARKERS.sub("", text))
+    return text
+
+def tts_cache_key(text, engine, voice, model, output_format):
+    """
+    Build the cache key for one synthesis.
+
+    Args:
+        text (str): Text to speak (normalized before hashing)
+        engine (str): "elevenlabs" or "gtts"
+        voice (str): Voice name or ID (language for gTTS)
+        model (str): Synthesis model
+        output_format (str): Audio format identifier
+
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    for part in (engine, voice or "", model or "", output_format or "", normalize_text(text)):
+        data = part.encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+class TTSCache:
+    """
+    Disk-backed cache of synthesized audio files, evicted LRU by total bytes.
+
+    The index of entries and sizes is rebuilt from the directory at startup
+    (ordered by last access time), so the cache survives restarts.
+    """
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        """
+        Args:
+            cache_dir (str): Directory holding the cached audio files
+            max_bytes (int): Total size the cache is kept under
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def get(self, text, engine, voice, model, output_format, output_filepath):
+        """
+        Copy cached audio to output_filepath if present.
+
+        Returns:
+            bool: True on a cache hit
+        """
+        key = tts_cache_key(text, engine, voice, model, output_format)
+        path = self._path(key)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            shutil.copyfile(path, output_filepath)
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            self._forget(key)
+            return False
+
+    def contains(self, text, engine, voice, model, output_format):
+        """Return True if the synthesis is cached, without counting a hit or miss."""
+        with self._lock:
+            return tts_cache_key(text, engine, voice, model, output_format) in self._entries
+
+    def put(self, text, engine, voice, model, output_format, audio_filepath):
+        """Store a copy of a freshly synthesized audio file."""
+        key = tts_cache_key(text, engine, voice, model, output_format)
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(audio_filepath, temp_path)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            logger.warning(f"Could not cache audio for {engine}: {str(e)}")
+            return
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            evicted = self._evict_locked()
+        for evicted_path in evicted:
+            _remove_quietly(evicted_path)
+
+    def stats(self):
+        """Return hit and miss counters and the cache size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes
+            }
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                _remove_quietly(path)
+                continue
+            if not name.endswith(".audio"):
+                continue
+            stat = os.stat(path)
+            entries.append((max(stat.st_atime, stat.st_mtime), name[:-len(".audio")], stat.st_size))
+        entries.sort()
+        with self._lock:
+            for _, key, size in entries:
+                self._entries[key] = size
+                self._total_bytes += size
+            evicted = self._evict_locked()
+        for path in evicted:
+            _remove_quietly(path)
+
+    def _evict_locked(self):
+        evicted = []
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(self._path(key))
+        return evicted
+
+    def _forget(self, key):
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_tts_cache():
+    """Return the process-wide TTSCache configured from the environment."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = TTSCache()
+    return _default_cache
@@ -0,0 +1,127 @@
+# upload_limits.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import re
+import wave
+import logging
+import subprocess
+from functools import lru_cache
+from PIL import Image
+from pydub.utils import get_encoder_name
+
+logger = logging.getLogger("UploadLimits")
+
+# Largest uploads accepted. Sizes and durations are read from file headers,
+# so an oversized upload is refused before anything decodes it
+IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get("IMAGE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(50 * 1000 * 1000)))
+AUDIO_MAX_UPLOAD_BYTES = int(os.environ.get("AUDIO_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+AUDIO_MAX_SECONDS = float(os.environ.get("AUDIO_MAX_SECONDS", "600"))
+
+# Limit for Gradio's upload endpoint, which rejects larger files while they stream in
+UPLOAD_MAX_BYTES = max(IMAGE_MAX_UPLOAD_BYTES, AUDIO_MAX_UPLOAD_BYTES)
+
+# Decoding a larger image needs more memory than any upload we accept would
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+class UploadRejected(ValueError):
+    """Raised for an upload over the size, pixel or duration limits; the message is meant for the patient."""
+
+def check_image_upload(image_path, max_bytes=IMAGE_MAX_UPLOAD_BYTES, max_pixels=IMAGE_MAX_PIXELS):
+    """
+    Check an image's file size and dimensions without decoding its pixels.
+
+    Files Pillow cannot identify are only checked for size; preprocessing
+    passes them through unchanged.
+
+    Args:
+        image_path (str): Path to the image file
+        max_bytes (int): Largest file accepted
+        max_pixels (int): Largest width x height accepted
+
+    Returns:
+        tuple: (width, height), or None if the format is not recognized
+
+    Raises:
+        UploadRejected: The image is over a limit
+    """
+    size = os.path.getsize(image_path)
+    if size > max_bytes:
+        raise UploadRejected(f"The image is too large ({_megabytes(size)}). Please upload one under {_megabytes(max_bytes)}.")
+    try:
+        # Only the header is parsed until the pixels are loaded
+        with Image.open(image_path) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        width = height = None
+        pixels = max_pixels + 1
+    except Exception:
+        return None
+    else:
+        pixels = width * height
+    if pixels > max_pixels:
+        raise UploadRejected(f"The image resolution is too high. Please upload one under {max_pixels / 1e6:.0f} megapixels.")
+    return width, height
+
+def check_audio_upload(audio_filepath, max_bytes=AUDIO_MAX_UPLOAD_BYTES, max_seconds=AUDIO_MAX_SECONDS):
+    """
+    Check a recording's file size and duration from its header.
+
+    Args:
+        audio_filepath (str): Path to the audio file
+        max_bytes (int): Largest file accepted
+        max_seconds (float): Longest recording accepted
+
+    Returns:
+        float: Duration in seconds, or None if the header does not say
+
+    Raises:
+        UploadRejected: The recording is over a limit
+    """
+    size = os.path.getsize(audio_filepath)
+    if size > max_bytes:
+        raise UploadRejected(f"The recording is too large ({_megabytes(size)}). Please keep it under {_megabytes(max_bytes)}.")
+    duration = probe_duration(audio_filepath)
+    if duration is not None and duration > max_seconds:
+        raise UploadRejected(f"The recording is too long ({duration / 60:.0f} minutes). Please keep it under {max_seconds / 60:.0f} minutes.")
+    return duration
+
+def check_uploads(audio_filepath, image_filepath):
+    """Check whichever of a consultation's uploads are present; raises UploadRejected."""
+    if audio_filepath:
+        check_audio_upload(audio_filepath)
+    if image_filepath:
+        check_image_upload(image_filepath)
+
+def probe_duration(audio_filepath):
+    """Read a recording's duration in seconds from its header, or None if unknown."""
+    try:
+        stat = os.stat(audio_filepath)
+    except OSError:
+        return None
+    # Checked on upload and again when deciding how to transcribe
+    return _probe_duration(audio_filepath, stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=256)
+def _probe_duration(audio_filepath, size, mtime_ns):
+    try:
+        if audio_filepath.lower().endswith(".wav"):
+            with wave.open(audio_filepath, "rb") as wav_file:
+                return wav_file.getnframes() / float(wav_file.getframerate())
+        result = subprocess.run(
+            [get_encoder_name(), "-nostdin", "-hide_banner", "-i", audio_filepath],
+            capture_output=True
+        )
+        match = re.search(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+        if match:
+            hours, minutes, seconds = match.groups()
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except Exception as e:
+        logger.warning(f"Could not read duration of {audio_filepath}: {str(e)}")
+    return None
+
+def _megabytes(size):
+    return f"{size / 2 ** 20:.0f} MB"
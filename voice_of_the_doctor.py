@@ -1,25 +1,69 @@
 # voice_of_the_doctor.py
 
-from dotenv import load_dotenv
-load_dotenv()
+from bootstrap import load_environment
+load_environment()
 
 import os
+import re
+import asyncio
+import functools
 import logging
 import platform
+import shutil
 import subprocess
 import tempfile
-from gtts import gTTS
-import elevenlabs
-from elevenlabs.client import ElevenLabs
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from clients import get_elevenlabs_client, get_async_elevenlabs_client
+from tts_cache import get_tts_cache
+from rate_limiter import get_scheduler
+from metrics import TTS_SECONDS, FALLBACKS, HEDGES
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("VoiceOfDoctor")
 
 # API Key for ElevenLabs
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
 
-def text_to_speech_with_gtts(input_text, output_filepath):
+# Audio format requested from ElevenLabs (also part of the TTS cache key)
+ELEVENLABS_OUTPUT_FORMAT = "mp3_44100_128"
+
+# Maximum number of ElevenLabs syntheses in flight at once in the async pipeline
+TTS_CONCURRENCY = int(os.environ.get("TTS_CONCURRENCY", "16"))
+_tts_slots = asyncio.Semaphore(TTS_CONCURRENCY)
+
+# Seconds a synthesis may take before it is given up on, and how long
+# ElevenLabs runs alone before gTTS is started alongside it as a hedge
+TTS_LATENCY_BUDGET = float(os.environ.get("TTS_LATENCY_BUDGET", "8"))
+TTS_HEDGE_AFTER = float(os.environ.get("TTS_HEDGE_AFTER", "2.5"))
+
+TTSResult = namedtuple("TTSResult", ["path", "engine", "seconds"])
+
+# Syntheses served per engine ("none" when no engine finished within the budget)
+_engine_counts = Counter()
+_engine_lock = threading.Lock()
+
+# Playback policy for generated speech on this machine: "off" (default; the
+# server never plays audio itself), "background" (start the player and return
+# immediately, for local CLI use) or "blocking" (wait for playback to finish)
+AUDIO_PLAYBACK = os.environ.get("AUDIO_PLAYBACK", "off").lower()
+
+# Command-line players to look for, in order of preference
+PLAYER_COMMANDS = {
+    "Darwin": [["afplay"]],
+    "Linux": [
+        ["mpg123", "-q"],
+        ["ffplay", "-nodisp", "-autoexit", "-loglevel", "quiet"],
+        ["aplay", "-q"]
+    ]
+}
+
+# Sentence boundaries: terminal punctuation followed by whitespace, or a line break.
+# Common abbreviations are excluded so "Dr. AI" is not split mid-phrase.
+SENTENCE_BOUNDARY = re.compile(r'(?<!\bDr\.)(?<!\bMr\.)(?<!\bMs\.)(?<!\bvs\.)(?<!e\.g\.)(?<!i\.e\.)(?<=[.!?])\s+|\n+')
+
+def text_to_speech_with_gtts(input_text, output_filepath, autoplay=True):
     """
     Generate speech from text using Google's Text-to-Speech service.
     Fallback option when ElevenLabs is unavailable.
@@ -27,38 +71,25 @@ def text_to_speech_with_gtts(input_text, output_filepath):
     Args:
         input_text (str): Text to convert to speech
         output_filepath (str): File path to save the audio
+        autoplay (bool): Play the generated audio per the AUDIO_PLAYBACK policy
     
     Returns:
-        str: Path to the generated audio file
+        str: Path to the generated audio file, or None if synthesis failed
     """
     try:
-        logger.info("Generating speech with gTTS...")
-        
-        # Create TTS object
-        audio_obj = gTTS(
-            text=input_text,
-            lang="en",
-            slow=False
-        )
-        
-        # Save audio file
-        audio_obj.save(output_filepath)
-        logger.info(f"Speech generated and saved to {output_filepath}")
+        _synthesize_gtts(input_text, output_filepath)
         
-        # Auto-play based on OS
-        play_audio_file(output_filepath)
+        # Auto-play based on OS and the playback policy
+        if autoplay:
+            play_audio_file(output_filepath)
         
         return output_filepath
         
     except Exception as e:
         logger.error(f"gTTS error: {str(e)}")
-        # Create simple error message if TTS fails
-        error_filepath = "error_message.txt"
-        with open(error_filepath, "w") as f:
-            f.write("Speech generation failed. Please check logs.")
-        return error_filepath
+        return None
 
-def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria", model="eleven_turbo_v2"):
+def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria", model="eleven_turbo_v2", autoplay=True):
     """
     Generate high-quality speech using ElevenLabs API with extended options.
     
@@ -67,74 +98,633 @@ def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria", mo
         output_filepath (str): File path to save the audio
         voice (str): Voice ID or name to use
         model (str): Model to use for synthesis
+        autoplay (bool): Play the generated audio per the AUDIO_PLAYBACK policy
     
     Returns:
-        str: Path to the generated audio file
+        str: Path to the generated audio file, or None if both engines failed
     """
     try:
         if not ELEVENLABS_API_KEY:
             logger.warning("ElevenLabs API key not found, falling back to gTTS")
-            return text_to_speech_with_gtts(input_text, output_filepath)
-            
-        logger.info(f"Generating speech with ElevenLabs using voice '{voice}'...")
+            return text_to_speech_with_gtts(input_text, output_filepath, autoplay=autoplay)
         
-        # Initialize ElevenLabs client
-        client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+        _synthesize_elevenlabs(input_text, output_filepath, voice, model)
         
-        # Generate audio with more parameters for better medical voice
-        audio = client.generate(
-            text=input_text,
-            voice=voice,
-            output_format="mp3_44100_128",
-            model=model,
-            voice_settings={
-                "stability": 0.71,      # More stable for medical advice
-                "similarity_boost": 0.5, # Balanced voice characteristics
-                "style": 0.0,            # Neutral style for medical context
-                "use_speaker_boost": True
-            }
-        )
+        # Auto-play based on OS and the playback policy
+        if autoplay:
+            play_audio_file(output_filepath)
+        
+        return output_filepath
+        
+    except Exception as e:
+        logger.error(f"ElevenLabs error: {str(e)}")
+        logger.info("Falling back to gTTS...")
+        return text_to_speech_with_gtts(input_text, output_filepath, autoplay=autoplay)
+
+async def text_to_speech_with_elevenlabs_async(input_text, output_filepath, voice="Aria", model="eleven_turbo_v2", autoplay=True):
+    """
+    Async version of text_to_speech_with_elevenlabs for the async consultation pipeline.
+    
+    Uses the pooled AsyncElevenLabs client and falls back to gTTS in a worker thread.
+    
+    Args:
+        input_text (str): Text to convert to speech
+        output_filepath (str): File path to save the audio
+        voice (str): Voice ID or name to use
+        model (str): Model to use for synthesis
+        autoplay (bool): Play the generated audio per the AUDIO_PLAYBACK policy
+    
+    Returns:
+        str: Path to the generated audio file, or None if both engines failed
+    """
+    try:
+        if not ELEVENLABS_API_KEY:
+            logger.warning("ElevenLabs API key not found, falling back to gTTS")
+            return await asyncio.to_thread(text_to_speech_with_gtts, input_text, output_filepath, autoplay)
         
-        # Save the audio file
-        elevenlabs.save(audio, output_filepath)
-        logger.info(f"Speech generated and saved to {output_filepath}")
+        await _asynthesize_elevenlabs(input_text, output_filepath, voice, model)
         
-        # Auto-play based on OS
-        play_audio_file(output_filepath)
+        if autoplay:
+            await asyncio.to_thread(play_audio_file, output_filepath)
         
         return output_filepath
         
     except Exception as e:
         logger.error(f"ElevenLabs error: {str(e)}")
         logger.info("Falling back to gTTS...")
-        return text_to_speech_with_gtts(input_text, output_filepath)
+        return await asyncio.to_thread(text_to_speech_with_gtts, input_text, output_filepath, autoplay)
 
-def play_audio_file(filepath):
+def synthesize_speech(input_text, output_filepath, voice="Aria", model="eleven_turbo_v2", budget=None, hedge_after=None):
     """
-    Play an audio file based on the operating system.
+    Synthesize speech within a latency budget, hedging ElevenLabs with gTTS.
+    
+    ElevenLabs is started first; if it has not finished after hedge_after
+    seconds, or fails, gTTS is started alongside it and whichever engine
+    finishes first serves the request. Each engine writes to its own file and
+    only the winner's is moved to output_filepath. Nothing is returned past
+    the budget, so a stalled provider cannot hold up the response.
+    
+    Args:
+        input_text (str): Text to convert to speech
+        output_filepath (str): File path to save the audio
+        voice (str): Voice ID or name to use
+        model (str): Model to use for synthesis
+        budget (float): Seconds to wait for audio; defaults to TTS_LATENCY_BUDGET
+        hedge_after (float): Seconds before gTTS is started; defaults to TTS_HEDGE_AFTER
+    
+    Returns:
+        TTSResult: Audio path (None if no engine finished in time), serving engine and elapsed seconds
+    """
+    budget = TTS_LATENCY_BUDGET if budget is None else budget
+    hedge_after = TTS_HEDGE_AFTER if hedge_after is None else hedge_after
+    paths = _engine_paths(output_filepath)
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tts-hedge")
+    attempts = {}
+    start_gtts = not ELEVENLABS_API_KEY
+    if ELEVENLABS_API_KEY:
+        attempts[executor.submit(_synthesize_elevenlabs, input_text, paths["elevenlabs"], voice, model)] = "elevenlabs"
+    try:
+        while True:
+            elapsed = time.monotonic() - started
+            hedged = "gtts" in attempts.values()
+            if not hedged and (start_gtts or elapsed >= hedge_after):
+                attempts[executor.submit(_synthesize_gtts, input_text, paths["gtts"])] = "gtts"
+                hedged = True
+            pending = [future for future in attempts if not future.done()]
+            if not pending or elapsed >= budget:
+                break
+            timeout = budget - elapsed if hedged else min(budget, hedge_after) - elapsed
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                engine = attempts[future]
+                if future.exception() is None:
+                    return _serve(engine, paths[engine], output_filepath, started, hedged=len(attempts) > 1)
+                logger.warning(f"{engine} synthesis failed: {str(future.exception())}")
+                start_gtts = True
+    finally:
+        for future in attempts:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return _no_speech(output_filepath, budget, started, hedged=len(attempts) > 1)
+
+async def synthesize_speech_async(input_text, output_filepath, voice="Aria", model="eleven_turbo_v2", budget=None, hedge_after=None, session=None):
+    """
+    Async version of synthesize_speech for the async consultation pipeline.
+    
+    ElevenLabs runs on the pooled async client and gTTS in a worker thread;
+    a losing ElevenLabs request is cancelled. Time spent waiting for the
+    ElevenLabs rate budget counts towards the hedge, and a request refused by
+    the scheduler is served by gTTS. session is passed to the scheduler.
+    
+    Returns:
+        TTSResult: Audio path (None if no engine finished in time), serving engine and elapsed seconds
+    """
+    budget = TTS_LATENCY_BUDGET if budget is None else budget
+    hedge_after = TTS_HEDGE_AFTER if hedge_after is None else hedge_after
+    paths = _engine_paths(output_filepath)
+    started = time.monotonic()
+    attempts = {}
+    start_gtts = not ELEVENLABS_API_KEY
+    if ELEVENLABS_API_KEY:
+        attempts[asyncio.ensure_future(_asynthesize_elevenlabs(input_text, paths["elevenlabs"], voice, model, session))] = "elevenlabs"
+    try:
+        while True:
+            elapsed = time.monotonic() - started
+            hedged = "gtts" in attempts.values()
+            if not hedged and (start_gtts or elapsed >= hedge_after):
+                attempts[asyncio.ensure_future(asyncio.to_thread(_synthesize_gtts, input_text, paths["gtts"]))] = "gtts"
+                hedged = True
+            pending = [task for task in attempts if not task.done()]
+            if not pending or elapsed >= budget:
+                break
+            timeout = budget - elapsed if hedged else min(budget, hedge_after) - elapsed
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                engine = attempts[task]
+                if task.exception() is None:
+                    return _serve(engine, paths[engine], output_filepath, started, hedged=len(attempts) > 1)
+                logger.warning(f"{engine} synthesis failed: {str(task.exception())}")
+                start_gtts = True
+    finally:
+        for task in attempts:
+            task.cancel()
+    return _no_speech(output_filepath, budget, started, hedged=len(attempts) > 1)
+
+def tts_engine_stats():
+    """Return how many syntheses each engine served, and how many got no audio."""
+    with _engine_lock:
+        return dict(_engine_counts)
+
+def _synthesize_gtts(input_text, output_filepath):
+    """Synthesize with gTTS (or the cache), raising on failure."""
+    tts_cache = get_tts_cache()
+    if tts_cache.get(input_text, "gtts", "en", None, "mp3", output_filepath):
+        logger.info(f"Speech served from cache to {output_filepath}")
+        return output_filepath
+    
+    logger.info("Generating speech with gTTS...")
+    from gtts import gTTS
+    
+    # Create TTS object
+    audio_obj = gTTS(
+        text=input_text,
+        lang="en",
+        slow=False
+    )
+    
+    # Save audio file
+    audio_obj.save(output_filepath)
+    tts_cache.put(input_text, "gtts", "en", None, "mp3", output_filepath)
+    logger.info(f"Speech generated and saved to {output_filepath}")
+    return output_filepath
+
+def _synthesize_elevenlabs(input_text, output_filepath, voice, model):
+    """Synthesize with ElevenLabs (or the cache), raising on failure."""
+    tts_cache = get_tts_cache()
+    if tts_cache.get(input_text, "elevenlabs", voice, model, ELEVENLABS_OUTPUT_FORMAT, output_filepath):
+        logger.info(f"Speech served from cache to {output_filepath}")
+        return output_filepath
+    
+    logger.info(f"Generating speech with ElevenLabs using voice '{voice}'...")
+    
+    # Reuse the pooled ElevenLabs client
+    client = get_elevenlabs_client(ELEVENLABS_API_KEY)
+    
+    # Generate audio with more parameters for better medical voice
+    audio = client.generate(
+        text=input_text,
+        voice=voice,
+        output_format=ELEVENLABS_OUTPUT_FORMAT,
+        model=model,
+        voice_settings={
+            "stability": 0.71,      # More stable for medical advice
+            "similarity_boost": 0.5, # Balanced voice characteristics
+            "style": 0.0,            # Neutral style for medical context
+            "use_speaker_boost": True
+        }
+    )
+    
+    # Save the audio file
+    from elevenlabs import save
+    save(audio, output_filepath)
+    tts_cache.put(input_text, "elevenlabs", voice, model, ELEVENLABS_OUTPUT_FORMAT, output_filepath)
+    logger.info(f"Speech generated and saved to {output_filepath}")
+    return output_filepath
+
+async def _asynthesize_elevenlabs(input_text, output_filepath, voice, model, session=None):
+    """Async _synthesize_elevenlabs on the pooled AsyncElevenLabs client."""
+    tts_cache = get_tts_cache()
+    if tts_cache.get(input_text, "elevenlabs", voice, model, ELEVENLABS_OUTPUT_FORMAT, output_filepath):
+        logger.info(f"Speech served from cache to {output_filepath}")
+        return output_filepath
+    
+    # Charged in characters, so RATE_LIMITS can hold a characters-per-minute budget
+    await get_scheduler().acquire("elevenlabs", tokens=len(input_text), session=session)
+    logger.info(f"Generating speech with ElevenLabs using voice '{voice}'...")
+    client = get_async_elevenlabs_client(ELEVENLABS_API_KEY)
+    
+    async with _tts_slots:
+        audio = await client.generate(
+            text=input_text,
+            voice=voice,
+            output_format=ELEVENLABS_OUTPUT_FORMAT,
+            model=model,
+            voice_settings={
+                "stability": 0.71,
+                "similarity_boost": 0.5,
+                "style": 0.0,
+                "use_speaker_boost": True
+            }
+        )
+        with open(output_filepath, "wb") as f:
+            async for chunk in audio:
+                f.write(chunk)
+    tts_cache.put(input_text, "elevenlabs", voice, model, ELEVENLABS_OUTPUT_FORMAT, output_filepath)
+    logger.info(f"Speech generated and saved to {output_filepath}")
+    return output_filepath
+
+def _engine_paths(output_filepath):
+    """Give each engine its own file so a late loser never overwrites the winner."""
+    base, ext = os.path.splitext(output_filepath)
+    return {engine: f"{base}.{engine}{ext or '.mp3'}" for engine in ("elevenlabs", "gtts")}
+
+def _serve(engine, engine_filepath, output_filepath, started, hedged=False):
+    os.replace(engine_filepath, output_filepath)
+    seconds = time.monotonic() - started
+    with _engine_lock:
+        _engine_counts[engine] += 1
+    TTS_SECONDS.observe(seconds, engine=engine)
+    if hedged:
+        HEDGES.inc(stage="tts", winner=engine)
+    if engine == "gtts" and ELEVENLABS_API_KEY:
+        FALLBACKS.inc(stage="tts", from_choice="elevenlabs")
+    logger.info(f"Speech for {output_filepath} served by {engine} in {seconds:.2f}s")
+    return TTSResult(output_filepath, engine, seconds)
+
+def _no_speech(output_filepath, budget, started, hedged=False):
+    seconds = time.monotonic() - started
+    with _engine_lock:
+        _engine_counts["none"] += 1
+    TTS_SECONDS.observe(seconds, engine="none")
+    if hedged:
+        HEDGES.inc(stage="tts", winner="none")
+    logger.error(f"No speech for {output_filepath}: every engine failed or the {budget:.1f}s budget ran out")
+    return TTSResult(None, None, seconds)
+
+@functools.lru_cache(maxsize=None)
+def _find_player(os_name):
+    """Return the first installed player command for the OS, looked up once per process."""
+    for command in PLAYER_COMMANDS.get(os_name, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+def play_audio_file(filepath, mode=None):
+    """
+    Play an audio file based on the operating system and the playback policy.
     
     Args:
         filepath (str): Path to the audio file
+        mode (str): "off", "background" or "blocking"; defaults to AUDIO_PLAYBACK
+    
+    Returns:
+        subprocess.Popen: The player process in background mode, otherwise None
     """
+    mode = (mode or AUDIO_PLAYBACK).lower()
+    if mode == "off":
+        return None
+    if mode not in ("background", "blocking"):
+        logger.warning(f"Unknown audio playback mode: {mode}")
+        return None
+    
     os_name = platform.system()
     try:
-        if os_name == "Darwin":  # macOS
-            subprocess.run(['afplay', filepath], check=True)
-        elif os_name == "Windows":  # Windows
-            # Use the Windows default player
+        if os_name == "Windows":  # Windows
+            # Use the Windows default player, which never blocks
             os.startfile(filepath)
-        elif os_name == "Linux":  # Linux
-            # Try multiple players in case one is not available
-            for player in ['aplay', 'mpg123', 'ffplay']:
-                try:
-                    subprocess.run([player, filepath], check=True)
-                    break
-                except (subprocess.SubprocessError, FileNotFoundError):
-                    continue
-        else:
-            logger.warning(f"Unsupported operating system: {os_name}")
+            return None
+        
+        command = _find_player(os_name)
+        if command is None:
+            logger.warning(f"No audio player available on {os_name}")
+            return None
+        
+        if mode == "blocking":
+            subprocess.run(command + [filepath], check=True)
+            return None
+        return subprocess.Popen(
+            command + [filepath],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
     except Exception as e:
         logger.error(f"Error playing audio: {str(e)}")
+        return None
+
+def prewarm_tts_cache(phrases, voice="Aria", model="eleven_turbo_v2"):
+    """
+    Synthesize phrases that are not cached yet, so later requests for them are free.
+    
+    Args:
+        phrases (list): Texts to pre-synthesize; each is also split into sentences
+        voice (str): Voice ID or name to use
+        model (str): Model to use for synthesis
+    
+    Returns:
+        int: Number of phrases synthesized
+    """
+    tts_cache = get_tts_cache()
+    texts = []
+    for phrase in phrases:
+        texts.append(phrase)
+        texts.extend(sentence for sentence in split_sentences(phrase) if sentence != phrase.strip())
+    
+    synthesized = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for index, text in enumerate(dict.fromkeys(texts)):
+            if tts_cache.contains(text, "elevenlabs", voice, model, ELEVENLABS_OUTPUT_FORMAT):
+                continue
+            text_to_speech_with_elevenlabs(
+                input_text=text,
+                output_filepath=os.path.join(temp_dir, f"prewarm_{index}.mp3"),
+                voice=voice,
+                model=model,
+                autoplay=False
+            )
+            synthesized += 1
+    logger.info(f"TTS cache pre-warmed with {synthesized} new phrases")
+    return synthesized
+
+def split_sentences(text):
+    """
+    Split text into sentences for segment-wise synthesis.
+    
+    Args:
+        text (str): Text to split
+    
+    Returns:
+        list: Non-empty, stripped sentences in order
+    """
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+def join_segments(segment_filepaths, output_filepath):
+    """
+    Join synthesized segments into one file.
+    
+    MP3 frames are self-contained, so segments in the same format are
+    concatenated byte-wise without decoding. When a fallback mixed engines
+    (ElevenLabs at 44.1 kHz, gTTS at 24 kHz), the segments are decoded and
+    re-encoded at the highest sample rate instead, since players assume one
+    format per stream.
+    
+    Args:
+        segment_filepaths (list): Segment files in order
+        output_filepath (str): Path of the combined audio file
+    
+    Returns:
+        str: output_filepath
+    """
+    formats = {_mp3_format(path) for path in segment_filepaths}
+    if len(formats) > 1:
+        from pydub import AudioSegment
+        logger.info(f"Re-encoding {len(segment_filepaths)} segments in {len(formats)} formats into {output_filepath}")
+        segments = [AudioSegment.from_file(path, format="mp3") for path in segment_filepaths]
+        frame_rate = max(segment.frame_rate for segment in segments)
+        channels = max(segment.channels for segment in segments)
+        combined = sum(
+            (segment.set_frame_rate(frame_rate).set_channels(channels) for segment in segments),
+            AudioSegment.empty()
+        )
+        combined.export(output_filepath, format="mp3", bitrate="128k")
+        return output_filepath
+    with open(output_filepath, "wb") as combined:
+        for path in segment_filepaths:
+            with open(path, "rb") as segment:
+                shutil.copyfileobj(segment, combined)
+    return output_filepath
+
+# Sample rates by MPEG version bits of an MP3 frame header (MPEG 2.5, reserved, MPEG 2, MPEG 1)
+MP3_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+def _mp3_format(filepath):
+    """
+    Read the sample rate and channel count from an MP3 file's first frame header.
+    
+    Returns:
+        tuple: (sample rate, channels), or None if no frame header was found
+    """
+    with open(filepath, "rb") as f:
+        head = f.read(10)
+        if head[:3] == b"ID3" and len(head) == 10:
+            # Skip the ID3v2 tag; its size is four 7-bit bytes
+            size = 0
+            for byte in head[6:10]:
+                size = (size << 7) | (byte & 0x7F)
+            f.seek(10 + size)
+        else:
+            f.seek(0)
+        data = f.read(4096)
+    for i in range(len(data) - 3):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 0x03
+        rate_index = (data[i + 2] >> 2) & 0x03
+        if version not in MP3_SAMPLE_RATES or rate_index == 3:
+            continue
+        channels = 1 if data[i + 3] >> 6 == 3 else 2
+        return MP3_SAMPLE_RATES[version][rate_index], channels
+    return None
+
+class SpeechPipeline:
+    """
+    Synthesize speech sentence by sentence while the response is still being written.
+    
+    Text is fed in as it streams from the model; each complete sentence is
+    synthesized on a worker thread (ElevenLabs, hedged with gTTS within the
+    TTS latency budget) so synthesis overlaps generation. Segments
+    are delivered in order as they finish and can be joined into a single file.
+    Short sentences are merged (except the first, which is sent straight away
+    to keep time-to-first-audio low) to avoid one request per fragment.
+    """
+    
+    def __init__(self, output_filepath, voice="Aria", model="eleven_turbo_v2", max_workers=3, min_segment_chars=60):
+        """
+        Args:
+            output_filepath (str): Path of the combined audio file
+            voice (str): Voice ID or name to use
+            model (str): Model to use for synthesis
+            max_workers (int): Number of segments synthesized concurrently
+            min_segment_chars (int): Minimum length of every segment after the first
+        """
+        self.output_filepath = output_filepath
+        self.voice = voice
+        self.model = model
+        self.min_segment_chars = min_segment_chars
+        self.max_workers = max_workers
+        base, ext = os.path.splitext(output_filepath)
+        self._segment_template = f"{base}_part{{:03d}}{ext or '.mp3'}"
+        self._executor = None
+        self._futures = []
+        self._delivered = 0
+        self._buffer = ""
+        self._pending = ""
+    
+    def feed(self, text):
+        """Add streamed text, queueing synthesis for every sentence it completes."""
+        self._buffer += text
+        parts = SENTENCE_BOUNDARY.split(self._buffer)
+        # The last part may still be an unfinished sentence
+        self._buffer = parts.pop()
+        for sentence in parts:
+            self._queue_sentence(sentence)
+    
+    def close(self):
+        """Flush any remaining text; no more text may be fed afterwards."""
+        self._queue_sentence(self._buffer)
+        self._buffer = ""
+        if self._pending:
+            self._submit(self._pending)
+            self._pending = ""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+    
+    def abort(self):
+        """Stop the pipeline, cancelling segments that have not started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+    
+    def ready_segments(self):
+        """
+        Return newly finished segment paths in order, without blocking.
+        
+        Returns:
+            list: Paths of segments not yet delivered whose predecessors are all done
+        """
+        ready = []
+        while self._delivered < len(self._futures) and self._futures[self._delivered].done():
+            path = self._futures[self._delivered].result()
+            self._delivered += 1
+            if path:
+                ready.append(path)
+        return ready
+    
+    def remaining_segments(self):
+        """Yield the undelivered segment paths in order, waiting for each one."""
+        while self._delivered < len(self._futures):
+            path = self._futures[self._delivered].result()
+            self._delivered += 1
+            if path:
+                yield path
+    
+    def segment_counts(self):
+        """
+        Returns:
+            tuple: (segments finished, segments queued so far)
+        """
+        return sum(1 for future in self._futures if future.done()), len(self._futures)
+    
+    def combine(self):
+        """
+        Join all synthesized segments into the output file (see join_segments).
+        
+        Returns:
+            str: Path to the combined audio file
+        """
+        paths = [future.result() for future in self._futures]
+        return join_segments([path for path in paths if path], self.output_filepath)
+    
+    def _queue_sentence(self, sentence):
+        sentence = sentence.strip()
+        if not sentence:
+            return
+        if get_tts_cache().contains(sentence, "elevenlabs", self.voice, self.model, ELEVENLABS_OUTPUT_FORMAT):
+            # Keep cached sentences (disclaimers, canned messages) as their own segment so they stay free
+            if self._pending:
+                self._submit(self._pending)
+                self._pending = ""
+            self._submit(sentence)
+            return
+        self._pending = f"{self._pending} {sentence}".strip()
+        if self._futures and len(self._pending) < self.min_segment_chars:
+            return
+        self._submit(self._pending)
+        self._pending = ""
+    
+    def _submit(self, text):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tts-segment")
+        segment_filepath = self._segment_template.format(len(self._futures))
+        self._futures.append(self._executor.submit(self._synthesize, text, segment_filepath))
+    
+    def _synthesize(self, text, segment_filepath):
+        return synthesize_speech(
+            input_text=text,
+            output_filepath=segment_filepath,
+            voice=self.voice,
+            model=self.model
+        ).path
+
+class AsyncSpeechPipeline(SpeechPipeline):
+    """
+    SpeechPipeline for the async consultation pipeline.
+    
+    Segments are synthesized as asyncio tasks with synthesize_speech_async,
+    at most max_workers at a time per pipeline. feed() and ready_segments() are
+    unchanged; remaining_segments() and combine() must be awaited. The
+    optional session keyword is passed on to the rate-limit scheduler.
+    """
+    
+    def __init__(self, *args, session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = session
+        self._slots = asyncio.Semaphore(self.max_workers)
+    
+    def close(self):
+        """Flush any remaining text; no more text may be fed afterwards."""
+        self._queue_sentence(self._buffer)
+        self._buffer = ""
+        if self._pending:
+            self._submit(self._pending)
+            self._pending = ""
+    
+    def abort(self):
+        """Stop the pipeline, cancelling segments that have not finished."""
+        for task in self._futures:
+            task.cancel()
+    
+    async def remaining_segments(self):
+        """Yield the undelivered segment paths in order, waiting for each one."""
+        while self._delivered < len(self._futures):
+            path = await self._futures[self._delivered]
+            self._delivered += 1
+            if path:
+                yield path
+    
+    async def combine(self):
+        """
+        Join all synthesized segments into the output file.
+        
+        Returns:
+            str: Path to the combined audio file
+        """
+        await asyncio.gather(*self._futures)
+        return await asyncio.to_thread(super().combine)
+    
+    def _submit(self, text):
+        segment_filepath = self._segment_template.format(len(self._futures))
+        self._futures.append(asyncio.ensure_future(self._synthesize_async(text, segment_filepath)))
+    
+    async def _synthesize_async(self, text, segment_filepath):
+        async with self._slots:
+            result = await synthesize_speech_async(
+                input_text=text,
+                output_filepath=segment_filepath,
+                voice=self.voice,
+                model=self.model,
+                session=self.session
+            )
+        return result.path
 
 # Example usage (commented out for import)
 """
@@ -1,20 +1,82 @@
 # voice_of_the_patient.py
 
-from dotenv import load_dotenv
-load_dotenv()
+from bootstrap import load_environment
+load_environment()
 
 import logging
-import speech_recognition as sr
 from pydub import AudioSegment
 from io import BytesIO
 import os
-import tempfile
-from groq import Groq
+import re
+import wave
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from pydub.silence import detect_silence, detect_nonsilent
+from pydub.utils import get_encoder_name
+
+try:
+    import audioop
+except ImportError:
+    import pyaudioop as audioop
+from clients import get_groq_client, get_async_groq_client
+from model_health import get_model_health
+from rate_limiter import get_scheduler, SchedulerOverloaded
+from upload_limits import probe_duration
+from metrics import MODEL_CALLS
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("VoiceOfPatient")
 
+# Maximum number of transcriptions in flight at once in the async pipeline
+STT_CONCURRENCY = int(os.environ.get("STT_CONCURRENCY", "8"))
+_stt_slots = asyncio.Semaphore(STT_CONCURRENCY)
+
+# Whisper models in preference order; models found unavailable are skipped
+STT_MODELS = ["whisper-large-v3", "whisper-large-v3-turbo"]
+
+# Compressed formats Whisper accepts that are uploaded exactly as recorded
+COMPACT_UPLOAD_FORMATS = {".flac", ".mp3", ".m4a", ".mp4", ".mpeg", ".mpga", ".ogg", ".opus", ".webm"}
+
+# Codec used when a recording has to be transcoded: "flac" (lossless) or "opus"
+STT_UPLOAD_CODEC = os.environ.get("STT_UPLOAD_CODEC", "flac").lower()
+
+# ffmpeg output arguments and upload file name for each codec; audio is
+# downmixed to 16 kHz mono, which is what Whisper resamples to anyway
+UPLOAD_CODECS = {
+    "flac": (["-c:a", "flac", "-f", "flac"], "audio.flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "24k", "-f", "ogg"], "audio.ogg")
+}
+
+# Silence trimming before upload: leading/trailing silence is cut and pauses
+# are shortened. Audio quieter than the recording's average level minus
+# STT_SILENCE_OFFSET_DB for at least STT_MIN_SILENCE_MS counts as silence;
+# STT_KEEP_SILENCE_MS is kept around speech and inner pauses are capped at
+# STT_MAX_PAUSE_MS
+STT_TRIM_SILENCE = os.environ.get("STT_TRIM_SILENCE", "1") == "1"
+STT_SILENCE_OFFSET_DB = float(os.environ.get("STT_SILENCE_OFFSET_DB", "16"))
+STT_MIN_SILENCE_MS = int(os.environ.get("STT_MIN_SILENCE_MS", "300"))
+STT_KEEP_SILENCE_MS = int(os.environ.get("STT_KEEP_SILENCE_MS", "200"))
+STT_MAX_PAUSE_MS = int(os.environ.get("STT_MAX_PAUSE_MS", "700"))
+
+# A compact recording is only re-encoded if trimming saves at least this much
+STT_TRIM_MIN_SAVING_MS = 1000
+
+# Long-audio mode: recordings longer than STT_LONG_AUDIO_SECONDS are split on
+# silence into segments of at most STT_SEGMENT_SECONDS and transcribed
+# STT_SEGMENT_WORKERS at a time
+STT_LONG_AUDIO_SECONDS = float(os.environ.get("STT_LONG_AUDIO_SECONDS", "60"))
+STT_SEGMENT_SECONDS = float(os.environ.get("STT_SEGMENT_SECONDS", "30"))
+STT_SEGMENT_WORKERS = int(os.environ.get("STT_SEGMENT_WORKERS", "4"))
+# Overlap added where no pause was found and a segment has to be cut mid-speech
+STT_SEGMENT_OVERLAP_MS = 1000
+
+# Whisper's working format: recordings are decoded straight to 16 kHz mono 16-bit PCM
+STT_SAMPLE_RATE = 16000
+STT_SAMPLE_WIDTH = 2
+
+# Frames read at a time when converting a WAV file, so only the converted audio is held in full
+WAV_CHUNK_FRAMES = 64 * 1024
+
 def record_audio(file_path, timeout=20, phrase_time_limit=None):
     """
     Enhanced function to record audio from the microphone with better user feedback.
@@ -24,6 +86,9 @@ def record_audio(file_path, timeout=20, phrase_time_limit=None):
         timeout (int): Maximum time to wait for a phrase to start (in seconds).
         phrase_time_limit (int): Maximum time for the phrase to be recorded (in seconds).
     """
+    # Only needed for local microphone recording, never by the web app
+    import speech_recognition as sr
+    
     recognizer = sr.Recognizer()
     
     try:
@@ -37,9 +102,7 @@ def record_audio(file_path, timeout=20, phrase_time_limit=None):
             logger.info("Recording complete.")
             
             # Convert the recorded audio to an MP3 file
-            wav_data = audio_data.get_wav_data()
-            audio_segment = AudioSegment.from_wav(BytesIO(wav_data))
-            audio_segment.export(file_path, format="mp3", bitrate="128k")
+            save_wav_as_mp3(audio_data.get_wav_data(), file_path)
             
             logger.info(f"Audio saved to {file_path}")
             return True
@@ -54,6 +117,18 @@ def record_audio(file_path, timeout=20, phrase_time_limit=None):
         logger.error(f"An error occurred: {e}")
         return False
 
+def save_wav_as_mp3(wav_data, file_path, bitrate="128k"):
+    """
+    Encode WAV bytes from the microphone to an MP3 file.
+    
+    Args:
+        wav_data (bytes): Complete WAV file contents
+        file_path (str): Path to save the MP3 file
+        bitrate (str): MP3 bitrate
+    """
+    audio_segment = AudioSegment.from_wav(BytesIO(wav_data))
+    audio_segment.export(file_path, format="mp3", bitrate=bitrate)
+
 def transcribe_with_groq(GROQ_API_KEY, audio_filepath, stt_model="whisper-large-v3"):
     """
     Enhanced function to transcribe audio using Groq's Whisper model.
@@ -66,48 +141,429 @@ def transcribe_with_groq(GROQ_API_KEY, audio_filepath, stt_model="whisper-large-
     Returns:
         str: Transcribed text
     """
-    client = Groq(api_key=GROQ_API_KEY)
+    client = get_groq_client(GROQ_API_KEY)
     
     try:
-        if not os.path.exists(audio_filepath):
-            raise FileNotFoundError(f"Audio file not found: {audio_filepath}")
-            
-        # Check file size and format
-        audio = AudioSegment.from_file(audio_filepath)
+        if _is_long_recording(audio_filepath):
+            text = transcribe_long_audio(GROQ_API_KEY, audio_filepath, stt_model=stt_model)
+            _record_stt_success(stt_model)
+            return text
         
-        # Convert to required format if necessary
-        if audio_filepath.endswith('.mp3'):
-            # Create a temporary WAV file if needed
-            temp_file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-            temp_filepath = temp_file.name
-            temp_file.close()
-            
-            # Convert MP3 to WAV for better compatibility
-            audio.export(temp_filepath, format="wav")
-            process_filepath = temp_filepath
-        else:
-            process_filepath = audio_filepath
+        upload = _prepare_audio_for_upload(audio_filepath)
         
         # Perform transcription
         logger.info(f"Transcribing audio with {stt_model}...")
-        with open(process_filepath, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
+        transcription = client.audio.transcriptions.create(
+            model=stt_model,
+            file=upload,
+            language="en"
+        )
+            
+        logger.info("Transcription complete")
+        _record_stt_success(stt_model)
+        return transcription.text
+        
+    except Exception as e:
+        logger.error(f"Transcription error: {str(e)}")
+        _record_stt_failure(stt_model, e)
+        raise
+
+async def transcribe_with_groq_async(GROQ_API_KEY, audio_filepath, stt_model="whisper-large-v3", session=None):
+    """
+    Async version of transcribe_with_groq for the async consultation pipeline.
+    
+    Transcoding runs in a worker thread so it does not stall the event loop,
+    and the upload uses the pooled AsyncGroq client once the model's rate
+    budget allows it (see rate_limiter).
+    
+    Args:
+        GROQ_API_KEY (str): API key for Groq
+        audio_filepath (str): Path to the audio file
+        stt_model (str): Model to use for transcription
+        session (Session): Caller, for fair queueing and queue position updates
+        
+    Returns:
+        str: Transcribed text
+    """
+    client = get_async_groq_client(GROQ_API_KEY)
+    
+    try:
+        if await asyncio.to_thread(_is_long_recording, audio_filepath):
+            # Takes a slot per segment upload, like the short path below
+            text = await transcribe_long_audio_async(GROQ_API_KEY, audio_filepath, stt_model=stt_model, session=session)
+            _record_stt_success(stt_model)
+            return text
+        
+        async with _stt_slots:
+            upload = await asyncio.to_thread(_prepare_audio_for_upload, audio_filepath)
+        
+        # The slot is not held while waiting for a turn within the model's budget,
+        # and a recording that fails to decode never spends one
+        await get_scheduler().acquire(f"groq:{stt_model}", session=session)
+        async with _stt_slots:
+            logger.info(f"Transcribing audio with {stt_model}...")
+            transcription = await client.audio.transcriptions.create(
                 model=stt_model,
-                file=audio_file,
+                file=upload,
                 language="en"
             )
         
-        # Clean up temporary file if created
-        if 'temp_filepath' in locals():
-            os.unlink(temp_filepath)
-            
         logger.info("Transcription complete")
+        _record_stt_success(stt_model)
         return transcription.text
         
+    except SchedulerOverloaded:
+        raise
     except Exception as e:
         logger.error(f"Transcription error: {str(e)}")
+        _record_stt_failure(stt_model, e)
         raise
 
+def preferred_stt_model():
+    """Return the first model in STT_MODELS not known to be unavailable."""
+    models = get_model_health().ordered(STT_MODELS)
+    return models[0] if models else STT_MODELS[0]
+
+def _record_stt_success(stt_model):
+    get_model_health().record_success(stt_model)
+    MODEL_CALLS.inc(stage="stt", model=stt_model, outcome="ok")
+
+def _record_stt_failure(stt_model, error):
+    # A decommissioned Whisper model is then skipped by preferred_stt_model()
+    verdict = get_model_health().record_failure(stt_model, error)
+    MODEL_CALLS.inc(stage="stt", model=stt_model, outcome=verdict)
+
+def _prepare_audio_for_upload(audio_filepath):
+    """
+    Produce the in-memory file to upload for a recording.
+    
+    With STT_TRIM_SILENCE the recording is decoded to 16 kHz mono, silence is
+    trimmed and the result is encoded to STT_UPLOAD_CODEC. Otherwise, and when
+    trimming saves little on a recording already in a compact format Whisper
+    accepts, the file is sent unchanged; anything else (typically WAV from the
+    microphone) is transcoded by ffmpeg through a pipe, without temporary files.
+    
+    Returns:
+        tuple: (file name, audio bytes) as accepted by the Groq client
+    """
+    if not os.path.exists(audio_filepath):
+        raise FileNotFoundError(f"Audio file not found: {audio_filepath}")
+    
+    extension = os.path.splitext(audio_filepath)[1].lower()
+    if STT_TRIM_SILENCE:
+        audio = _load_for_stt(audio_filepath)
+        trimmed, removed_ms = trim_silence(audio)
+        if not (extension in COMPACT_UPLOAD_FORMATS and removed_ms < STT_TRIM_MIN_SAVING_MS):
+            return _encode_segment(trimmed, "audio")
+    
+    if extension in COMPACT_UPLOAD_FORMATS:
+        with open(audio_filepath, "rb") as audio_file:
+            return os.path.basename(audio_filepath), audio_file.read()
+    
+    return transcode_for_upload(audio_filepath)
+
+def trim_silence(audio, silence_offset_db=STT_SILENCE_OFFSET_DB, min_silence_ms=STT_MIN_SILENCE_MS, keep_ms=STT_KEEP_SILENCE_MS, max_pause_ms=STT_MAX_PAUSE_MS):
+    """
+    Remove leading and trailing silence and shorten long pauses.
+    
+    Args:
+        audio (AudioSegment): Audio to trim
+        silence_offset_db (float): How far below the average level counts as silence
+        min_silence_ms (int): Shortest quiet stretch treated as silence
+        keep_ms (int): Silence kept before and after each stretch of speech
+        max_pause_ms (int): Longest pause kept between stretches of speech
+        
+    Returns:
+        tuple: (trimmed AudioSegment, milliseconds removed)
+    """
+    if audio.dBFS == float("-inf"):
+        logger.warning("Recording is completely silent, leaving it untrimmed")
+        return audio, 0
+    
+    speech = detect_nonsilent(audio, min_silence_len=min_silence_ms, silence_thresh=audio.dBFS - silence_offset_db, seek_step=10)
+    if not speech:
+        logger.warning("No speech detected in recording, leaving it untrimmed")
+        return audio, 0
+    
+    # Pad each stretch of speech and merge the ones that now touch
+    regions = []
+    for start, end in speech:
+        start, end = max(0, start - keep_ms), min(len(audio), end + keep_ms)
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    
+    frame_bytes = audio.frame_width
+    pieces = []
+    for index, (start, end) in enumerate(regions):
+        if index:
+            pause_ms = min(start - regions[index - 1][1], max_pause_ms)
+            pieces.append(b"\x00" * (int(audio.frame_rate * pause_ms / 1000) * frame_bytes))
+        pieces.append(audio[start:end].raw_data)
+    trimmed = audio._spawn(b"".join(pieces))
+    
+    removed_ms = len(audio) - len(trimmed)
+    logger.info(f"Trimmed {removed_ms / 1000:.1f}s of silence from {len(audio) / 1000:.1f}s of audio ({100 * removed_ms / max(len(audio), 1):.0f}%)")
+    return trimmed, removed_ms
+
+def _load_for_stt(audio_filepath):
+    """
+    Decode a recording to 16 kHz mono 16-bit PCM, the format Whisper works at.
+    
+    PCM WAV is converted chunk by chunk and anything else is converted by
+    ffmpeg on the way out of the decoder, so the recording is never held at
+    its original rate and channel count.
+    """
+    try:
+        return _load_wav_for_stt(audio_filepath)
+    except (wave.Error, EOFError):
+        pass
+    command = [
+        get_encoder_name(), "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-i", audio_filepath,
+        "-ac", "1", "-ar", str(STT_SAMPLE_RATE), "-f", f"s{STT_SAMPLE_WIDTH * 8}le", "pipe:1"
+    ]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Audio decoding failed: {result.stderr.decode(errors='replace').strip()}")
+    return AudioSegment(data=result.stdout, sample_width=STT_SAMPLE_WIDTH, frame_rate=STT_SAMPLE_RATE, channels=1)
+
+def _load_wav_for_stt(audio_filepath):
+    """Convert a PCM WAV file in chunks; raises wave.Error for WAV variants the wave module cannot read."""
+    converted = bytearray()
+    state = None
+    with wave.open(audio_filepath, "rb") as wav_file:
+        channels = wav_file.getnchannels()
+        width = wav_file.getsampwidth()
+        rate = wav_file.getframerate()
+        while True:
+            chunk = wav_file.readframes(WAV_CHUNK_FRAMES)
+            if not chunk:
+                break
+            if width == 1:
+                # 8-bit WAV is unsigned; audioop works on signed samples
+                chunk = audioop.bias(chunk, 1, -128)
+            if width != STT_SAMPLE_WIDTH:
+                chunk = audioop.lin2lin(chunk, width, STT_SAMPLE_WIDTH)
+            if channels == 2:
+                chunk = audioop.tomono(chunk, STT_SAMPLE_WIDTH, 0.5, 0.5)
+            elif channels > 2:
+                raise wave.Error(f"{channels}-channel WAV")
+            if rate != STT_SAMPLE_RATE:
+                # The state carries the filter across chunks, so the result matches a one-shot conversion
+                chunk, state = audioop.ratecv(chunk, STT_SAMPLE_WIDTH, 1, rate, STT_SAMPLE_RATE, state)
+            converted += chunk
+    return AudioSegment(data=bytes(converted), sample_width=STT_SAMPLE_WIDTH, frame_rate=STT_SAMPLE_RATE, channels=1)
+
+def transcode_for_upload(audio_filepath, codec=None):
+    """
+    Transcode a recording to 16 kHz mono compressed audio in memory.
+    
+    Args:
+        audio_filepath (str): Path to the audio file
+        codec (str): "flac" or "opus"; defaults to STT_UPLOAD_CODEC
+        
+    Returns:
+        tuple: (file name, encoded audio bytes)
+    """
+    codec = codec or STT_UPLOAD_CODEC
+    if codec not in UPLOAD_CODECS:
+        raise ValueError(f"Unsupported upload codec: {codec}")
+    codec_args, upload_name = UPLOAD_CODECS[codec]
+    
+    command = [
+        get_encoder_name(), "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-i", audio_filepath,
+        "-ac", "1", "-ar", "16000"
+    ] + codec_args + ["pipe:1"]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Audio transcoding failed: {result.stderr.decode(errors='replace').strip()}")
+    
+    logger.info(f"Transcoded {audio_filepath}: {os.path.getsize(audio_filepath)} -> {len(result.stdout)} bytes ({codec})")
+    return upload_name, result.stdout
+
+def transcribe_long_audio(GROQ_API_KEY, audio_filepath, stt_model="whisper-large-v3", max_workers=STT_SEGMENT_WORKERS):
+    """
+    Transcribe a long recording as concurrently processed segments.
+    
+    The recording is split at pauses into segments of at most
+    STT_SEGMENT_SECONDS, each segment is transcribed on a worker thread, and the
+    texts are joined in order with words repeated across overlapping cuts removed.
+    
+    Args:
+        GROQ_API_KEY (str): API key for Groq
+        audio_filepath (str): Path to the audio file
+        stt_model (str): Model to use for transcription
+        max_workers (int): Segments transcribed at the same time
+        
+    Returns:
+        str: Transcribed text
+    """
+    client = get_groq_client(GROQ_API_KEY)
+    segments = _split_recording(audio_filepath)
+    logger.info(f"Transcribing {len(segments)} segments with {stt_model} ({max_workers} at a time)...")
+    
+    def transcribe_segment(upload):
+        return client.audio.transcriptions.create(model=stt_model, file=upload, language="en").text
+    
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stt-segment") as executor:
+        futures = [executor.submit(transcribe_segment, upload) for upload, _ in segments]
+        # The first failure fails the transcription, so segments not yet sent are dropped
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                for pending in futures:
+                    pending.cancel()
+                raise future.exception()
+        texts = [future.result() for future in futures]
+    
+    logger.info("Transcription complete")
+    return stitch_transcripts(texts, [overlapped for _, overlapped in segments])
+
+async def transcribe_long_audio_async(GROQ_API_KEY, audio_filepath, stt_model="whisper-large-v3", max_workers=STT_SEGMENT_WORKERS, session=None):
+    """
+    Async version of transcribe_long_audio; every segment waits for the model's rate budget.
+    
+    Splitting and each segment's upload take an STT_CONCURRENCY slot; waiting
+    for a turn within the budget does not, so a long recording cannot hold
+    slots that short transcriptions need.
+    
+    Args:
+        GROQ_API_KEY (str): API key for Groq
+        audio_filepath (str): Path to the audio file
+        stt_model (str): Model to use for transcription
+        max_workers (int): Segments transcribed at the same time
+        session (Session): Caller, for fair queueing and queue position updates
+        
+    Returns:
+        str: Transcribed text
+    """
+    client = get_async_groq_client(GROQ_API_KEY)
+    async with _stt_slots:
+        segments = await asyncio.to_thread(_split_recording, audio_filepath)
+    logger.info(f"Transcribing {len(segments)} segments with {stt_model} ({max_workers} at a time)...")
+    slots = asyncio.Semaphore(max_workers)
+    
+    async def transcribe_segment(upload):
+        await get_scheduler().acquire(f"groq:{stt_model}", session=session)
+        async with slots, _stt_slots:
+            transcription = await client.audio.transcriptions.create(model=stt_model, file=upload, language="en")
+            return transcription.text
+    
+    tasks = [asyncio.ensure_future(transcribe_segment(upload)) for upload, _ in segments]
+    try:
+        # The first failure fails the transcription, so the other segments are not left running
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        texts = [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info("Transcription complete")
+    return stitch_transcripts(texts, [overlapped for _, overlapped in segments])
+
+def split_on_pauses(audio, max_segment_ms, overlap_ms=STT_SEGMENT_OVERLAP_MS, min_silence_ms=400, silence_thresh=None):
+    """
+    Split audio into segments no longer than max_segment_ms, cutting at pauses.
+    
+    Each cut is placed in the middle of the last pause found in the second half
+    of the allowed window. If there is no pause, the segment is cut at the limit
+    and the next one starts overlap_ms earlier so no word is lost at the seam.
+    
+    Args:
+        audio (AudioSegment): Audio to split
+        max_segment_ms (int): Maximum segment length in milliseconds
+        overlap_ms (int): Overlap used for hard cuts
+        min_silence_ms (int): Shortest pause that counts as a cut point
+        silence_thresh (float): Silence level in dBFS; defaults to 16 dB below the average
+        
+    Returns:
+        list: (AudioSegment, overlaps previous segment) tuples in order
+    """
+    if silence_thresh is None:
+        silence_thresh = audio.dBFS - 16 if audio.dBFS != float("-inf") else -60
+    pauses = detect_silence(audio, min_silence_len=min_silence_ms, silence_thresh=silence_thresh, seek_step=10)
+    cut_points = [(start + end) // 2 for start, end in pauses]
+    
+    segments = []
+    start = 0
+    overlapped = False
+    while len(audio) - start > max_segment_ms:
+        limit = start + max_segment_ms
+        candidates = [cut for cut in cut_points if start + max_segment_ms // 2 <= cut <= limit]
+        if candidates:
+            segments.append((audio[start:candidates[-1]], overlapped))
+            start = candidates[-1]
+            overlapped = False
+        else:
+            segments.append((audio[start:limit], overlapped))
+            start = limit - overlap_ms
+            overlapped = True
+    segments.append((audio[start:], overlapped))
+    return segments
+
+def stitch_transcripts(texts, overlapped):
+    """
+    Join segment transcripts, dropping words repeated across overlapping cuts.
+    
+    Args:
+        texts (list): Transcript of each segment, in order
+        overlapped (list): Whether each segment overlaps the previous one
+        
+    Returns:
+        str: The combined transcript
+    """
+    words = []
+    for text, overlaps_previous in zip(texts, overlapped):
+        new_words = text.split()
+        if overlaps_previous and words:
+            new_words = new_words[_repeated_word_count(words, new_words):]
+        words.extend(new_words)
+    return " ".join(words)
+
+def _repeated_word_count(previous, following, max_words=12):
+    """Length of the longest run ending previous that also starts following, ignoring case and punctuation."""
+    def normalize(word):
+        return re.sub(r"[^\w']", "", word.lower())
+    for count in range(min(max_words, len(previous), len(following)), 0, -1):
+        if [normalize(w) for w in previous[-count:]] == [normalize(w) for w in following[:count]]:
+            return count
+    return 0
+
+def _split_recording(audio_filepath):
+    """Decode a recording to 16 kHz mono, trim silence and encode its segments for upload."""
+    audio = _load_for_stt(audio_filepath)
+    if STT_TRIM_SILENCE:
+        audio, _ = trim_silence(audio)
+    segments = split_on_pauses(audio, int(STT_SEGMENT_SECONDS * 1000))
+    return [(_encode_segment(segment, f"segment{index:03d}"), overlapped) for index, (segment, overlapped) in enumerate(segments)]
+
+def _encode_segment(segment, name, codec=None):
+    """Encode an AudioSegment's PCM to STT_UPLOAD_CODEC through an ffmpeg pipe."""
+    codec = codec or STT_UPLOAD_CODEC
+    codec_args, upload_name = UPLOAD_CODECS[codec]
+    command = [
+        get_encoder_name(), "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-f", f"s{segment.sample_width * 8}le", "-ar", str(segment.frame_rate), "-ac", str(segment.channels),
+        "-i", "pipe:0"
+    ] + codec_args + ["pipe:1"]
+    result = subprocess.run(command, input=segment.raw_data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Audio transcoding failed: {result.stderr.decode(errors='replace').strip()}")
+    return f"{name}{os.path.splitext(upload_name)[1]}", result.stdout
+
+def _is_long_recording(audio_filepath):
+    """True when the recording is longer than STT_LONG_AUDIO_SECONDS."""
+    # File size says little about length for compressed formats, so every
+    # recording is probed; the result is cached for the upload check
+    duration = probe_duration(audio_filepath)
+    return duration is not None and duration > STT_LONG_AUDIO_SECONDS
+
 # Example usage (commented out for import)
 """
 if __name__ == "__main__":
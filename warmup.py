@@ -0,0 +1,210 @@
+# warmup.py
+
+from bootstrap import load_environment
+load_environment()
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from clients import get_groq_client, get_async_groq_client, get_elevenlabs_client, get_async_elevenlabs_client
+from model_health import get_model_health
+from brain_of_the_doctor import MODELS_TO_TRY
+from voice_of_the_patient import STT_MODELS
+
+logger = logging.getLogger("WarmUp")
+
+# Warm up before reporting ready; with WARMUP=0 a worker is ready as soon as it starts
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") == "1"
+
+# Seconds a single warm-up step may take before it is given up on
+WARMUP_STEP_TIMEOUT = float(os.environ.get("WARMUP_STEP_TIMEOUT", "30"))
+
+# Seconds a model missing from Groq's model listing is skipped; a listing can
+# be incomplete for a while, so the model is tried again afterwards
+MODEL_LISTING_SKIP_SECONDS = float(os.environ.get("MODEL_LISTING_SKIP_SECONDS", "600"))
+
+class Readiness:
+    """
+    Outcome of each warm-up step and whether the worker is ready for traffic.
+
+    The worker is ready once every step has finished. A failed step (say,
+    ElevenLabs unreachable) is reported but does not hold readiness back:
+    the request path has its own fallbacks, and a worker that never became
+    ready would only move its share of traffic onto the others.
+    """
+
+    def __init__(self):
+        self._steps = OrderedDict()
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def record(self, name, status, seconds=0.0, detail=None):
+        """Record a step as "ok", "failed" or "skipped"."""
+        with self._lock:
+            self._steps[name] = {"status": status, "seconds": round(seconds, 3), "detail": detail}
+
+    def finish(self):
+        with self._lock:
+            self.finished_at = time.monotonic()
+
+    @property
+    def ready(self):
+        return self.finished_at is not None
+
+    def check(self):
+        """
+        Status for a readiness probe.
+
+        Returns:
+            tuple: (ready, details dict with the per-step outcomes)
+        """
+        with self._lock:
+            end = self.finished_at if self.finished_at is not None else time.monotonic()
+            return self.finished_at is not None, {
+                "ready": self.finished_at is not None,
+                "warmup_seconds": round(end - self.started_at, 3),
+                "steps": {name: dict(step) for name, step in self._steps.items()}
+            }
+
+_readiness = None
+_readiness_lock = threading.Lock()
+
+def get_readiness():
+    """Return the process-wide Readiness."""
+    global _readiness
+    if _readiness is None:
+        with _readiness_lock:
+            if _readiness is None:
+                _readiness = Readiness()
+    return _readiness
+
+def build_clients():
+    """Create the pooled provider clients (importing their SDKs) ahead of the first request."""
+    built = ["groq", "groq-async"]
+    get_groq_client()
+    get_async_groq_client()
+    if os.environ.get("ELEVENLABS_API_KEY"):
+        get_elevenlabs_client()
+        get_async_elevenlabs_client()
+        built += ["elevenlabs", "elevenlabs-async"]
+    return built
+
+async def probe_groq_models(models=None):
+    """
+    List the models Groq serves and skip missing ones for a while.
+
+    Missing models are marked unavailable for MODEL_LISTING_SKIP_SECONDS
+    rather than for good, and the health registry never empties a chain, so
+    a listing that is briefly wrong cannot take the service down.
+    The request also opens a connection in the async Groq pool, so the first
+    consultation skips DNS and the TLS handshake.
+
+    Args:
+        models (list): Models to check; defaults to the vision and STT chains
+
+    Returns:
+        list: Models marked unavailable
+    """
+    models = list(models) if models is not None else MODELS_TO_TRY + STT_MODELS
+    listing = await get_async_groq_client().models.list()
+    served = {model.id for model in listing.data if getattr(model, "active", True) is not False}
+    if not served:
+        # An empty listing says more about the endpoint than about our models
+        logger.warning("Groq returned no active models; leaving the fallback chains as they are")
+        return []
+    health = get_model_health()
+    missing = [model for model in models if model not in served]
+    for model in missing:
+        health.mark_unavailable(model, "not listed by the Groq models endpoint", seconds=MODEL_LISTING_SKIP_SECONDS)
+    return missing
+
+async def open_elevenlabs_connection():
+    """Open a connection in the async ElevenLabs pool with a cheap voice listing."""
+    await get_async_elevenlabs_client().voices.get_all()
+
+async def warm_up(prewarm_speech=None, readiness=None, step_timeout=WARMUP_STEP_TIMEOUT):
+    """
+    Run the warm-up steps and mark the worker ready.
+
+    Must run on the event loop that serves requests: the async clients'
+    connections belong to the loop that opened them.
+
+    Args:
+        prewarm_speech (callable): Blocking function filling the TTS cache; None skips the step
+        readiness (Readiness): Where to record the outcome; defaults to get_readiness()
+        step_timeout (float): Seconds each step may take
+
+    Returns:
+        Readiness: The recorded outcome
+    """
+    readiness = readiness or get_readiness()
+
+    async def step(name, work):
+        started = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(work, step_timeout)
+            readiness.record(name, "ok", time.monotonic() - started, detail)
+        except Exception as e:
+            reason = str(e) or type(e).__name__
+            readiness.record(name, "failed", time.monotonic() - started, reason)
+            logger.warning(f"Warm-up step {name} failed: {reason}")
+
+    await step("clients", asyncio.to_thread(build_clients))
+    steps = [step("groq_models", probe_groq_models())]
+    if os.environ.get("ELEVENLABS_API_KEY"):
+        steps.append(step("elevenlabs_connection", open_elevenlabs_connection()))
+    else:
+        readiness.record("elevenlabs_connection", "skipped", detail="ELEVENLABS_API_KEY not set")
+    if prewarm_speech is not None:
+        steps.append(step("tts_prewarm", asyncio.to_thread(prewarm_speech)))
+    else:
+        readiness.record("tts_prewarm", "skipped")
+    await asyncio.gather(*steps)
+
+    readiness.finish()
+    _, details = readiness.check()
+    logger.info(f"Warm-up finished in {details['warmup_seconds']:.2f}s: " + ", ".join(f"{name} {step['status']}" for name, step in details["steps"].items()))
+    return readiness
+
+def warm_up_lifespan(prewarm_speech=None, warm=WARMUP_ENABLED):
+    """
+    Build a FastAPI lifespan that warms up in the background on the server's loop.
+
+    The server starts accepting requests straight away. It also serves the
+    readiness probe at /ready, which answers 503 until warm-up has finished
+    and 200 afterwards, on the same port as the app, so a load balancer that
+    can reach the app can reach the probe.
+
+    Args:
+        prewarm_speech (callable): Passed to warm_up()
+        warm (bool): Run the warm-up; otherwise the server is ready straight away
+
+    Returns:
+        callable: Lifespan for gr.Blocks.launch(app_kwargs={"lifespan": ...})
+    """
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        from fastapi.responses import JSONResponse
+
+        def ready():
+            ok, details = get_readiness().check()
+            return JSONResponse(details, status_code=200 if ok else 503)
+
+        app.add_api_route("/ready", ready, methods=["GET"], include_in_schema=False)
+        task = None
+        if warm:
+            task = asyncio.ensure_future(warm_up(prewarm_speech))
+        else:
+            get_readiness().finish()
+        try:
+            yield
+        finally:
+            if task is not None:
+                task.cancel()
+
+    return lifespan